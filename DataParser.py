@@ -10,14 +10,45 @@ Formatting reference: https://docs.python.org/3/library/time.html#time.strftime
 
 CSV_TYPE_FORMAT refers to the CSV column name containing the decimal ror value.
 
-All functions assume the CSV has NO missing values!
+All functions assume the CSV has NO missing values! Each CSV must also have exactly one row per month from its first
+month to its last (see Entities.check_months): a missing or duplicate month raises a ValueError when the CSV is
+loaded, instead of misaligning the program's rors with the other programs' later.
+
+Parsed CSVs can be cached on disk (see DataParser.cache_dir). The cache is opt-in: nothing is written unless a
+cache folder is given, e.g. the per-user CACHE_DIR. Each cache entry stores the parsed dates and rors as two
+memory-mappable .npy arrays, plus a small .json file with the manager and program name. Entries are keyed by the
+CSV's path and columns, and checked against its modification time and size, so an unchanged CSV is never parsed
+twice and a changed CSV is parsed again automatically. The cache folder can be deleted at any time.
+
+Consolidated long-format files (the same headers, with the rows of many funds in one file) are streamed in chunks
+by read_long_format, without splitting them into one CSV per program first.
+
+A folder of CSVs can be parsed concurrently by parse_csvs: reading files is mostly waiting on I/O (especially on
+network-mounted folders), so a bounded thread pool overlaps the reads. Files that fail to parse are reported
+instead of stopping the others.
 """
 
-from Entities import Timeseries
+from Entities import Timeseries, Benchmark, to_months, check_months
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import threading
+import numpy as np
 import pandas as pd
 
 CSV_DATETIME_FORMAT = '%Y-%m-%d'
 CSV_TYPE_FORMAT = {'Change': 'float64'}
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'emp')  # Per-user cache folder, for callers that opt in
+DEFAULT_BENCHMARKS = {'S&P 500': 'data/sp500.csv'}  # Benchmark name: filepath to its CSV
+CSV_COLUMNS = ['Manager', 'Fund', 'Date', 'Change']  # Columns of a program CSV, read by position
+BENCHMARK_COLUMNS = ['Benchmark', 'Date', 'Change']  # Columns of a benchmark CSV, read by position
+LONG_FORMAT_COLUMNS = CSV_COLUMNS
+PARSE_MAX_WORKERS = 8  # Default number of threads of parse_csvs
+LONG_FORMAT_CHUNKSIZE = 100000  # Rows read at a time from a long-format file
+
+# Benchmarks loaded in this process, keyed by their CSV's path, modification time and size (see load_benchmark)
+_loaded_benchmarks = {}
 
 class DataParser:
     """Data Access Object that contains information parsed from monthly ror CSVs.
@@ -27,19 +58,149 @@ class DataParser:
     - manager_name: name of the manager in the CSV
     - program_name: name of the fund in the CSV
     - time_series: a list of Ror entities, parsed from CSV
+    - data: date-indexed rors of the whole CSV, parsed once and shared by every window
+    - cache_dir: folder of the on-disk cache of parsed CSVs, or None to always parse the CSV
+    - columns: names of the CSV's columns, read by position (CSV_COLUMNS, or BENCHMARK_COLUMNS for a benchmark)
     """
 
     path: str
     manager_name: str
     program_name: str
     time_series: Timeseries
+    data: pd.Series
+    cache_dir: str
+    columns: list
 
-    def __init__(self, path: str, manager_name=None, program_name=None, time_series=None):
+    def __init__(self, path: str, manager_name=None, program_name=None, time_series=None, cache_dir=None,
+                 columns=CSV_COLUMNS):
         self.path = path
         self.manager_name = manager_name or ''
         self.program_name = program_name or ''
         self.time_series = time_series or []
+        self.data = None
+        self.cache_dir = cache_dir
+        self.columns = columns
     
+    def parse(self) -> pd.Series:
+        """
+        Reads the CSV with filepath self.path exactly once and updates self.manager_name and self.program_name.
+        Rows without a date (e.g. trailing blank lines) are dropped and the returns are sorted by date so that
+        date windows can be taken as slices of a single array.
+
+        Returns:
+            pd.Series: Date-indexed series of rors for the whole CSV.
+
+        Raises:
+            ValueError: If a month is missing or appears more than once (see Entities.check_months).
+        """
+        if self.cache_dir:
+            entry, version = self._cache_entry()
+            if self._load_cache(entry, version):
+                check_months(to_months(self.data.index.values), self.path)
+                return self.data
+
+        # Columns are read by position with explicit types, so neither the header's spelling (some exports
+        # misname a column or start with a byte order mark) nor type and date format inference matter
+        names = dict.fromkeys(self.columns[:-1], str)
+        df = pd.read_csv(self.path, header=0, names=self.columns, usecols=range(len(self.columns)),
+                         dtype={**names, **CSV_TYPE_FORMAT})
+        df['Date'] = pd.to_datetime(df['Date'], format=CSV_DATETIME_FORMAT)
+
+        # Get manager and program name from first row, without surrounding whitespace as in read_long_format, so
+        # a fund has the same name whether it is read from its own CSV or from a long-format file
+        self.manager_name = _strip_name(df.iloc[0, 0])
+        self.program_name = _strip_name(df.iloc[0, 1]) if 'Fund' in self.columns else ''
+
+        df = df[df['Date'].notna()]
+        data = pd.Series(df['Change'].to_numpy(), index=pd.DatetimeIndex(df['Date']))
+        if not data.index.is_monotonic_increasing:
+            data = data.sort_index(kind='stable')
+        check_months(to_months(data.index.values), self.path)
+
+        self.data = data
+        if self.cache_dir:
+            self._save_cache(entry, version)
+        return self.data
+
+    def _cache_entry(self):
+        """
+        Returns the cache entry of self.path and self.columns (path prefix of its files inside self.cache_dir) and
+        the version of the CSV (modification time and size) that a valid entry must have been built from. The same
+        file read with other columns (e.g. as a benchmark) has its own entry.
+        """
+        stat = os.stat(self.path)
+        key = hashlib.sha1('\0'.join([os.path.abspath(self.path), *self.columns]).encode()).hexdigest()
+        return os.path.join(self.cache_dir, key), {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+    def _load_cache(self, entry: str, version: dict) -> bool:
+        """
+        Loads self.data, self.manager_name and self.program_name from the cache, if the CSV is unchanged since
+        it was cached. The arrays are memory-mapped.
+
+        Parameters:
+            entry: The cache entry of self.path (see _cache_entry).
+            version: The current version of the CSV (see _cache_entry).
+
+        Returns:
+            bool: Whether a valid cache entry was found.
+        """
+        try:
+            with open(entry + '.json') as f:
+                meta = json.load(f)
+            if meta['mtime_ns'] != version['mtime_ns'] or meta['size'] != version['size']:
+                return False
+            dates = np.load(entry + '.dates.npy', mmap_mode='r')
+            rors = np.load(entry + '.rors.npy', mmap_mode='r')
+        except (OSError, ValueError, KeyError):
+            return False
+
+        # Entries cached before the names were stripped are stripped here
+        self.manager_name = _strip_name(meta['manager_name'])
+        self.program_name = _strip_name(meta['program_name'])
+        self.data = pd.Series(rors, index=pd.DatetimeIndex(dates))
+        return True
+
+    def _save_cache(self, entry: str, version: dict) -> None:
+        """
+        Stores self.data in the cache. Each file is written under a temporary name and then renamed, and the .json
+        file (which holds the CSV version) is written last, so a partly written entry is never loaded.
+
+        Parameters:
+            entry: The cache entry of self.path (see _cache_entry).
+            version: The version of the CSV that self.data was parsed from (see _cache_entry).
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        arrays = {'.dates.npy': self.data.index.values.astype('datetime64[ns]'),
+                  '.rors.npy': self.data.to_numpy(dtype='float64')}
+        temp = f'.{os.getpid()}.{threading.get_ident()}.tmp'  # Unique to this process and thread
+
+        for suffix, array in arrays.items():
+            with open(entry + suffix + temp, 'wb') as f:
+                np.save(f, array, allow_pickle=False)
+            os.replace(entry + suffix + temp, entry + suffix)
+
+        meta = dict(version, path=os.path.abspath(self.path), manager_name=self.manager_name,
+                    program_name=self.program_name)
+        with open(entry + '.json' + temp, 'w') as f:
+            json.dump(meta, f, default=str)
+        os.replace(entry + '.json' + temp, entry + '.json')
+
+    def get_window(self, start_date=None, end_date=None) -> Timeseries:
+        """
+        Returns the rors between start_date and end_date as a Timeseries whose data is a slice (view) of the
+        parsed CSV. The CSV is only read on the first call.
+
+        Parameters:
+            start_date: Start date for filtering (inclusive), a string in 'YYYY-MM-DD' format.
+            end_date: End date for filtering (inclusive), a string in 'YYYY-MM-DD' format.
+
+        Returns:
+            Timeseries: Timeseries object containing dates and rors for the fund.
+        """
+        if self.data is None:
+            self.parse()
+        return Timeseries(data=self.data).get_window(start_date=start_date, end_date=end_date)
+
     def get_timeseries(self, start_date=None, end_date=None):
         """
         Parses CSV with filepath self.path and updates self.manager_name, self.program_name, and self.time_series
@@ -52,22 +213,166 @@ class DataParser:
         Returns:
             Timeseries: Timeseries object containing dates and rors for the fund.
         """
-        df = pd.read_csv(self.path, header=0)
-        df = df.astype(CSV_TYPE_FORMAT)  # Prev: Ensure the 'Change' column is converted correctly
-        df['Date'] = pd.to_datetime(df['Date'])
-        
-        # Get manager and program name from first row
-        self.manager_name = df.iloc[0, 0]
-        self.program_name = df.iloc[0, 1]
-        
-        if start_date:
-            df = df[df['Date'] >= start_date]
-        if end_date:
-            df = df[df['Date'] <= end_date]
-
-        dates = df['Date'].tolist()
-        rors = df['Change'].tolist()
-        time_series = Timeseries(dates=dates, rors=rors)
-
-        self.time_series = time_series
+        self.time_series = self.get_window(start_date=start_date, end_date=end_date)
         return self.time_series
+
+
+def load_benchmark(path: str, name=None, cache_dir=None) -> Benchmark:
+    """
+    Loads a benchmark CSV (same format as the program CSVs, e.g. 'Benchmark,Date,Change'). Each CSV is only
+    parsed once per process; it is parsed again if it changes.
+
+    Parameters:
+        path: Filepath to the benchmark CSV.
+        name: Name of the benchmark. Defaults to the name in the CSV's first column.
+        cache_dir: Folder of the on-disk cache of parsed CSVs, or None to always parse the CSV.
+
+    Returns:
+        Benchmark: The benchmark's timeseries.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, name)
+    if key not in _loaded_benchmarks:
+        dp = DataParser(path, cache_dir=cache_dir, columns=BENCHMARK_COLUMNS)
+        timeseries = dp.get_timeseries()
+        _loaded_benchmarks[key] = Benchmark(name or dp.manager_name, timeseries)
+    return _loaded_benchmarks[key]
+
+
+def load_benchmarks(benchmarks: dict, cache_dir=None) -> dict:
+    """
+    Loads several benchmarks (see load_benchmark).
+
+    Parameters:
+        benchmarks: Maps each benchmark's name to the filepath of its CSV.
+        cache_dir: Folder of the on-disk cache of parsed CSVs, or None to always parse the CSVs.
+
+    Returns:
+        dict: Maps each benchmark's name to its Benchmark, in the same order.
+    """
+    return {name: load_benchmark(path, name, cache_dir) for name, path in benchmarks.items()}
+
+
+def _parse_csv(path: str, cache_dir=None) -> tuple:
+    """
+    Parses one program CSV (see DataParser.parse).
+
+    Returns:
+        tuple(DataParser, str): The CSV's parser and None, or None and the error message if it failed.
+    """
+    try:
+        dp = DataParser(path, cache_dir=cache_dir)
+        dp.parse()
+        return dp, None
+    except Exception as error:  # Any error of one file is reported by parse_csvs, not raised
+        return None, f'{type(error).__name__}: {error}'
+
+
+def parse_csvs(paths: list, cache_dir=None, max_workers=PARSE_MAX_WORKERS) -> tuple:
+    """
+    Parses many program CSVs concurrently with a bounded thread pool. pandas releases the GIL while it reads and
+    tokenizes a file, and most of the time of a small CSV is spent opening and reading it, so the threads overlap
+    the I/O of up to max_workers files.
+
+    The results are in the order of paths, whatever order the files finish in. A file that fails to parse (e.g. a
+    missing month, see DataParser.parse, or a value that is not a number) is reported instead of stopping the
+    other files.
+
+    Parameters:
+        paths: Filepaths of the CSVs.
+        cache_dir: Folder of the on-disk cache of parsed CSVs, or None to always parse the CSVs.
+        max_workers: Maximum number of files read at the same time. 1 reads them one after another.
+
+    Returns:
+        list: The parser of each CSV that was parsed (see DataParser), in the order of paths.
+        dict: Maps the path of each CSV that failed to its error message, in the order of paths.
+    """
+    if max_workers < 1:
+        raise ValueError('max_workers must be at least 1.')
+
+    if max_workers == 1 or len(paths) <= 1:
+        results = [_parse_csv(path, cache_dir) for path in paths]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(paths))) as executor:
+            results = list(executor.map(lambda path: _parse_csv(path, cache_dir), paths))
+
+    parsers = [dp for dp, error in results if dp is not None]
+    errors = {path: error for path, (_, error) in zip(paths, results) if error is not None}
+    return parsers, errors
+
+
+def _strip_name(name):
+    """Returns a manager or fund name without surrounding whitespace. Missing names (nan) are returned as is."""
+    return name.strip() if isinstance(name, str) else name
+
+
+def _long_format_series(dates: list, rors: list, name: str) -> pd.Series:
+    """
+    Joins the pieces of one fund's rors read from a long-format file into a date-sorted series, checked for
+    missing and duplicate months as in DataParser.parse.
+    """
+    data = pd.Series(np.concatenate(rors), index=pd.DatetimeIndex(np.concatenate(dates), name='Date'))
+    if not data.index.is_monotonic_increasing:
+        data = data.sort_index(kind='stable')
+    check_months(to_months(data.index.values), name)
+    return data
+
+
+def read_long_format(path: str, chunksize=LONG_FORMAT_CHUNKSIZE, grouped=True):
+    """
+    Streams a consolidated long-format CSV (headers Manager, Fund, Date, Change; the rows of many funds in one file)
+    and yields each fund's rors.
+
+    The file is read chunksize rows at a time and only the parsed dates and rors of the funds not yet yielded are
+    kept, never the raw text. If the file is grouped by fund (all rows of a fund are consecutive, as delivered
+    by the vendor), a fund is yielded as soon as the next fund starts, so memory stays bounded by the chunk size
+    and the longest fund, whatever the size of the file. Leading and trailing spaces of the names are ignored.
+    Each fund is checked for missing and duplicate months, as in DataParser.parse.
+
+    Parameters:
+        path: Filepath to the long-format CSV.
+        chunksize: Number of rows read at a time.
+        grouped: If True, the file must be grouped by fund; a ValueError is raised if a fund's rows appear
+            again after another fund. If False, the funds can be in any order and are all yielded at the end
+            of the file (memory then grows with the file).
+
+    Yields:
+        tuple(str, str, pd.Series): The manager name, fund name and date-indexed rors of each fund, in the order
+            of the fund's first row.
+    """
+    pending = {}  # (manager name, fund name): (list of date arrays, list of ror arrays), in order of first row
+    yielded = set()
+    # Columns are read by position, as in DataParser.parse, so a misspelled header does not matter
+    reader = pd.read_csv(path, header=0, names=LONG_FORMAT_COLUMNS, usecols=range(4), chunksize=chunksize,
+                         dtype={'Manager': str, 'Fund': str, 'Date': str, **CSV_TYPE_FORMAT})
+    for chunk in reader:
+        chunk = chunk[chunk['Date'].notna()]
+        # Surrounding whitespace is not part of a name: exports often pad some rows of a fund but not others
+        funds = chunk['Fund'].str.strip().to_numpy()
+        managers = chunk['Manager'].str.strip().to_numpy()
+        dates = pd.to_datetime(chunk['Date'], format=CSV_DATETIME_FORMAT).to_numpy()
+        rors = chunk['Change'].to_numpy(dtype='float64')
+
+        # Runs of consecutive rows of the same fund. Funds of different managers may have the same name.
+        changes = (funds[1:] != funds[:-1]) | (managers[1:] != managers[:-1])
+        starts = np.flatnonzero(np.r_[True, changes]) if len(funds) else np.zeros(0, dtype=int)
+        ends = np.r_[starts[1:], len(funds)]
+        for start, end in zip(starts, ends):
+            key = (managers[start], funds[start])
+            if grouped and key not in pending:
+                if key in yielded:
+                    raise ValueError(f"{path} is not grouped by fund: '{key[1]}' ({key[0]}) appears again after "
+                                     f"other funds")
+                # A new fund starts, so the pending funds are complete
+                for done in list(pending):
+                    done_dates, done_rors = pending.pop(done)
+                    yielded.add(done)
+                    yield *done, _long_format_series(done_dates, done_rors, f"{path}: '{done[1]}' ({done[0]})")
+
+            fund_dates, fund_rors = pending.setdefault(key, ([], []))
+            # Copies, so the chunk can be freed
+            fund_dates.append(dates[start:end].copy())
+            fund_rors.append(rors[start:end].copy())
+
+    for key, (fund_dates, fund_rors) in pending.items():
+        yield *key, _long_format_series(fund_dates, fund_rors, f"{path}: '{key[1]}' ({key[0]})")
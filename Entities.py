@@ -1,9 +1,13 @@
 """
-This file contains all Entity classes.
+This file contains all Entity classes, and the global month calendar they are aligned on: every date maps to an
+integer month (see to_months), so two monthly series align by integer offsets instead of by date labels.
 """
 
 from datetime import datetime
 from dataclasses import dataclass
+import json
+import os
+import numpy as np
 import pandas as pd
 
 
@@ -11,6 +15,8 @@ import pandas as pd
 class Timeseries:
     """
     A simple class for representing a timeseries.
+
+    Its rors on the global month calendar (see get_monthly) are calculated on first use and kept until update.
     """
     data: pd.Series
 
@@ -23,6 +29,13 @@ class Timeseries:
             if rors is None:
                 rors = []
             self.data = pd.Series(rors, index=dates)
+        self._monthly = None  # The MonthlySeries of get_monthly, False if the months are not contiguous
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return self.data.equals(other.data)
+        else:
+            return False
 
     def get_dates(self):
         if not isinstance(self.data.index, pd.DatetimeIndex):
@@ -37,36 +50,461 @@ class Timeseries:
         date = pd.Timestamp(date)
         return self.data.get(date, None)
 
+    def get_monthly(self):
+        """
+        Returns the series on the global month calendar as a MonthlySeries (a start month and a view of the rors),
+        or None if it does not have exactly one ror per month from its first month to its last. Two series then
+        overlap on a pair of month bounds (see MonthlySeries.overlap) instead of by date labels.
+        """
+        if self._monthly is None:
+            months = to_months(self.data.index.values)
+            if (np.diff(months) == 1).all():
+                self._monthly = MonthlySeries(months[0] if len(months) else 0, self.data.to_numpy(dtype=float))
+            else:
+                self._monthly = False
+        return self._monthly or None
+
+    def update(self, dates, rors) -> None:
+        """
+        Sets the rors of several dates at once. Dates are matched by month (see to_months), so the series keeps one
+        ror per month: the ror of a month the series already has is overwritten (its date is kept), and new months
+        are added, with a single sort (only if a new month comes before the last date). If several dates fall in
+        the same month, the last one wins.
+
+        Parameters:
+            dates: The dates to set.
+            rors: The rate of return of each date.
+        """
+        new = pd.Series(np.asarray(rors, dtype=float), index=pd.DatetimeIndex(dates))
+        months = to_months(new.index.values)
+        kept = ~pd.Index(months).duplicated(keep='last')
+        new, months = new[kept], months[kept]
+        positions = pd.Index(to_months(self.data.index.values)).get_indexer(months)
+        existing = positions >= 0
+        data = self.data
+        if existing.any():
+            # The data may be a view shared with other windows (see get_window), so it is copied before writing
+            data = data.copy()
+            data.iloc[positions[existing]] = new[existing].to_numpy()
+        if not existing.all():
+            data = pd.concat([data, new[~existing]])
+            if not data.index.is_monotonic_increasing:
+                data = data.sort_index(kind='stable')
+        self.data = data
+        self._monthly = None
+
     def add_to_series(self, date: datetime, ror: float):
         """
-        Add a new date and rate of return to the series.
+        Add a new date and rate of return to the series. To add several dates, use update.
 
         Parameters:
             date: A datetime object representing the date.
             ror: A float representing the rate of return for the date.
         """
-        # Convert date to pandas.Timestamp for compatibility with the index
-        timestamp = pd.Timestamp(date)
-        
-        # Check if the date already exists in the series
-        if timestamp in self.data.index:
-            # Update the existing value 
-            self.data[timestamp] = ror
-        else: # Add new entry
-            self.data.at[timestamp] = ror
-            # Re-sort the index to maintain chronological order
-            self.data.sort_index(inplace=True)
+        self.update([date], [ror])
 
     def get_len(self):
         return len(self.data)
 
+    def get_window(self, start_date=None, end_date=None):
+        """
+        Returns the dates between start_date and end_date (both inclusive) as a new Timeseries whose data is a
+        slice (view) of this one. The index must be sorted.
+
+        Parameters:
+            start_date: Start date of the window, a string in 'YYYY-MM-DD' format.
+            end_date: End date of the window, a string in 'YYYY-MM-DD' format.
+        """
+        index = self.data.index
+        start = index.searchsorted(pd.Timestamp(start_date), side='left') if start_date else 0
+        end = index.searchsorted(pd.Timestamp(end_date), side='right') if end_date else len(index)
+        window = Timeseries(data=self.data.iloc[start:end])
+        if self._monthly:
+            # A window of a contiguous series is contiguous, so its months follow from this series' months
+            window._monthly = MonthlySeries(self._monthly.start + start, self._monthly.rors[start:end])
+        return window
+
+
+MAX_REPORTED_MONTHS = 5  # Number of missing or duplicate months named in a calendar error
+
+
+def to_months(dates) -> np.ndarray:
+    """
+    Returns the position of each date on the global month calendar: the number of months since January 1970. Every
+    date of a month has the same position.
+
+    Parameters:
+        dates: datetime64 values (or anything numpy converts to them, e.g. a DatetimeIndex or 'YYYY-MM-DD' strings).
+    """
+    return np.asarray(dates).astype('datetime64[M]').astype(np.int64)
+
+
+def check_months(months: np.ndarray, name: str) -> None:
+    """
+    Checks that a monthly series has exactly one ror per month, from its first month to its last, so it can be
+    stored as a start month and a contiguous array (see MonthlySeries).
+
+    Parameters:
+        months: The month (see to_months) of each ror, in date order.
+        name: Name of the series (e.g. the path of its CSV), used in the error message.
+
+    Raises:
+        ValueError: If a month appears more than once, or if a month between the first and the last is missing.
+    """
+    steps = np.diff(months)
+    if len(steps) and (steps < 0).any():
+        raise ValueError(f'{name}: the dates are not sorted.')
+    problems = []
+    duplicates = months[1:][steps == 0]
+    if len(duplicates):
+        problems.append(f'{len(duplicates)} duplicate month(s) ('
+                        + ', '.join(str(month) for month in duplicates[:MAX_REPORTED_MONTHS].astype('datetime64[M]'))
+                        + ')')
+    gaps = np.flatnonzero(steps > 1)
+    if len(gaps):
+        missing = np.concatenate([np.arange(months[gap] + 1, months[gap + 1]) for gap in gaps])
+        problems.append(f'{len(missing)} missing month(s) ('
+                        + ', '.join(str(month) for month in missing[:MAX_REPORTED_MONTHS].astype('datetime64[M]'))
+                        + ')')
+    if problems:
+        raise ValueError(f'{name}: ' + ' and '.join(problems) + '.')
+
+
+class MonthlySeries:
+    """
+    A monthly series on the global month calendar, stored as the month of its first ror and a contiguous array of
+    rors (one per month, see check_months). The overlap of two series is a pair of month bounds, found in O(1).
+    Program timeseries keep one (see Timeseries.get_monthly), which sync_returns and calc_gain_to_pain use.
+
+    Instance Attributes:
+    - start: month (see to_months) of the first ror
+    - rors: the rors, one per month
+    """
+    __slots__ = ('start', 'rors')
+    start: int
+    rors: np.ndarray
+
+    def __init__(self, start: int, rors: np.ndarray) -> None:
+        self.start = int(start)
+        self.rors = rors
+
+    @classmethod
+    def from_timeseries(cls, timeseries: Timeseries, name='series'):
+        """
+        Stores a timeseries on the month calendar. Raises a ValueError if it has duplicate or missing months.
+        """
+        months = to_months(timeseries.data.index.values)
+        check_months(months, name)
+        return cls(months[0] if len(months) else 0, timeseries.data.to_numpy(dtype=float))
+
+    @property
+    def end(self) -> int:
+        """Month after the last ror."""
+        return self.start + len(self.rors)
+
+    def overlap(self, other) -> tuple:
+        """
+        Returns the (start, end) months (end exclusive) where both series have rors. start >= end if they do not
+        overlap.
+        """
+        return max(self.start, other.start), min(self.end, other.end)
+
+    def get_rors(self, start: int, end: int) -> np.ndarray:
+        """Returns the rors from month start to month end (exclusive), a view. The months must be in the series."""
+        return self.rors[start - self.start:end - self.start]
+
+
+@dataclass
+class Drawdown:
+    """
+    The drawdown analysis of a timeseries, calculated in one pass (see StatsCalculations.calc_drawdown).
+
+    Instance Attributes:
+    - dd_series: drawdown after each ror
+    - max_drawdown: the lowest drawdown
+    - trough_index: index of the max. drawdown
+    - peak_index: index of the last peak before the trough
+    - start_index: index of the last recovered point before the trough (start of the drawdown duration)
+    - recovery_index: index of the first recovered point after the trough, or len(dd_series) if it never recovers
+    - length: length (in months) of max. drawdown, from peak to trough
+    - duration: duration/recovery time (in months) of max. drawdown. If it never recovers, measured up to the trough.
+    - weighted_area: weighted area under the drawdown curve
+    """
+    dd_series: np.ndarray
+    max_drawdown: float
+    trough_index: int
+    peak_index: int
+    start_index: int
+    recovery_index: int
+    length: int
+    duration: int
+    weighted_area: float
+
+
+class ReturnsPanel:
+    """
+    Columnar storage for the rors of many programs: one (dates x programs) float64 matrix instead of one pd.Series
+    per program. Date windows are row slices of the same matrix (views, not copies).
+
+    Instance Attributes:
+    - dates: sorted datetime64 array, the date of each row
+    - rors: (dates x programs) matrix of rors, 0 where a program has no data
+    - mask: (dates x programs) boolean availability matrix, True where a program has data
+    - names: the program name of each column
+    - index: maps each program name to its (first) column
+
+    New rows are appended by update into preallocated buffers (dates, rors and mask are views of their first rows),
+    so adding one month to a panel is amortized O(programs).
+    """
+    dates: np.ndarray
+    rors: np.ndarray
+    mask: np.ndarray
+    names: list
+    index: dict
+
+    def __init__(self, dates, rors, mask, names) -> None:
+        self.dates = dates
+        self.rors = rors
+        self.mask = mask
+        self.names = list(names)
+        self.index = {}
+        for column, name in enumerate(self.names):
+            self.index.setdefault(name, column)
+        self._buffers = None  # (dates, rors, mask) buffers owned by this panel, allocated by the first update
+
+    def _reserve(self, num_dates: int) -> None:
+        """
+        Makes sure the panel owns writable buffers with room for num_dates rows. The first call copies the data
+        (it may be a view of another panel, or a read-only memory map); the buffers then grow geometrically.
+        """
+        if self._buffers is not None and len(self._buffers[0]) >= num_dates:
+            return
+        capacity = max(num_dates, 2 * len(self.dates), 12)
+        dates = np.empty(capacity, dtype=self.dates.dtype)
+        rors = np.zeros((capacity, self.rors.shape[1]))
+        mask = np.zeros((capacity, self.mask.shape[1]), dtype=bool)
+        size = len(self.dates)
+        dates[:size], rors[:size], mask[:size] = self.dates, self.rors, self.mask
+        self._buffers = (dates, rors, mask)
+
+    def update(self, dates, columns, rors) -> np.ndarray:
+        """
+        Sets a batch of rors in place: rors[i] becomes the ror of column columns[i] in the month of dates[i]. Dates
+        are matched to rows by month (see to_months), so a date in a month the panel already has (e.g. a month end
+        when the panel's dates are the 1st) updates that month's row. Months that are not in the panel yet are
+        appended as new rows, dated with the first of their dates in the batch; they must come after the panel's
+        last month (e.g. a new month end).
+
+        Parameters:
+            dates: The date of each ror.
+            columns: The column of each ror.
+            rors: The new rors.
+
+        Returns:
+            np.ndarray: The sorted columns that were updated.
+        """
+        dates = pd.DatetimeIndex(dates).values.astype(self.dates.dtype)
+        columns = np.asarray(columns, dtype=np.int64)
+        rors = np.asarray(rors, dtype=float)
+
+        # The row of each date's month, if the panel has it: the first row on or after the month's first day
+        months = to_months(dates)
+        rows = np.searchsorted(self.dates, dates.astype('datetime64[M]'))
+        existing = rows < len(self.dates)
+        existing[existing] = to_months(self.dates[rows[existing]]) == months[existing]
+
+        new_months, first = np.unique(months[~existing], return_index=True)
+        new_dates = dates[~existing][first]
+        if len(new_months) and len(self.dates) and new_months[0] <= to_months(self.dates[-1:])[0]:
+            raise ValueError(f'Cannot insert {new_dates[0]} before the last month of the panel ({self.dates[-1]}). '
+                             f'Only months after it can be added.')
+
+        size = len(self.dates) + len(new_dates)
+        self._reserve(size)
+        buffer_dates, buffer_rors, buffer_mask = self._buffers
+        buffer_dates[len(self.dates):size] = new_dates
+        self.dates, self.rors, self.mask = buffer_dates[:size], buffer_rors[:size], buffer_mask[:size]
+
+        rows[~existing] = len(self.dates) - len(new_months) + np.searchsorted(new_months, months[~existing])
+        self.rors[rows, columns] = rors
+        self.mask[rows, columns] = True
+        return np.unique(columns)
+
+    @classmethod
+    def from_timeseries(cls, names, timeseries_list):
+        """
+        Stacks a list of monthly timeseries into one panel with a row per month that any of them has. Rows are
+        placed by month offsets on the global month calendar (see to_months), so dates of the same month align
+        even if their days differ; the date of a row is its date in the first timeseries that has that month.
+
+        Parameters:
+            names: The name of each timeseries' program.
+            timeseries_list: The timeseries to stack, one column each.
+
+        Raises:
+            ValueError: If a timeseries has more than one ror in a month.
+        """
+        indexes = [timeseries.data.index.values for timeseries in timeseries_list]
+        months = [to_months(index) for index in indexes]
+        names = list(names)
+        for name, program_months in zip(names, months):
+            # Unsorted months are allowed, as long as there are no duplicates
+            if (np.diff(program_months) <= 0).any() and (np.diff(np.sort(program_months)) == 0).any():
+                raise ValueError(f"'{name}' has more than one ror in a month.")
+
+        # Rank of each month of the calendar between the first and last month among the months present
+        first = min((program_months.min() for program_months in months if len(program_months)), default=0)
+        last = max((program_months.max() for program_months in months if len(program_months)), default=-1)
+        present = np.zeros(last - first + 1, dtype=bool)
+        for program_months in months:
+            present[program_months - first] = True
+        row_of_month = np.cumsum(present) - 1
+
+        dtype = np.result_type(*indexes) if indexes else np.dtype('datetime64[ns]')
+        dates = np.empty(int(present.sum()), dtype=dtype)
+        rors = np.zeros((len(dates), len(timeseries_list)))
+        mask = np.zeros((len(dates), len(timeseries_list)), dtype=bool)
+        rows = [row_of_month[program_months - first] for program_months in months]
+        for column, (program_rows, timeseries) in enumerate(zip(rows, timeseries_list)):
+            rors[program_rows, column] = timeseries.get_rors()
+            mask[program_rows, column] = True
+        # Written last to first, so each row has the date of the first timeseries with that month
+        for program_rows, index in zip(reversed(rows), reversed(indexes)):
+            dates[program_rows] = index
+
+        return cls(dates, rors, mask, names)
+
+    def window(self, start_date=None, end_date=None):
+        """
+        Returns the rows between start_date and end_date (both inclusive) as a panel of views over this panel.
+
+        Parameters:
+            start_date: Start date of the window, a string in 'YYYY-MM-DD' format.
+            end_date: End date of the window, a string in 'YYYY-MM-DD' format.
+        """
+        start = np.searchsorted(self.dates, np.datetime64(start_date), side='left') if start_date else 0
+        end = np.searchsorted(self.dates, np.datetime64(end_date), side='right') if end_date else len(self.dates)
+        return ReturnsPanel(self.dates[start:end], self.rors[start:end], self.mask[start:end], self.names)
+
+    def select(self, columns):
+        """
+        Returns a panel holding only the given columns, dropping the dates where none of them has data.
+
+        Parameters:
+            columns: Column indices to keep.
+        """
+        mask = self.mask[:, columns]
+        rows = mask.any(axis=1)
+        return ReturnsPanel(self.dates[rows], self.rors[rows][:, columns], mask[rows],
+                            [self.names[column] for column in columns])
+
+    def get_rors(self, column) -> np.ndarray:
+        """Returns the available rors of a column, in date order."""
+        return self.rors[self.mask[:, column], column]
+
+    def get_timeseries(self, column) -> Timeseries:
+        """Returns a column as a Timeseries."""
+        available = self.mask[:, column]
+        return Timeseries(data=pd.Series(self.rors[available, column], index=pd.DatetimeIndex(self.dates[available])))
+
+    def get_counts(self) -> np.ndarray:
+        """Returns the number of available rors in each column."""
+        return self.mask.sum(axis=0)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Returns the panel as a date-indexed DataFrame with one column per program and NaN where there is no data."""
+        df = pd.DataFrame(np.where(self.mask, self.rors, np.nan), index=pd.DatetimeIndex(self.dates, name='Date'),
+                          columns=self.names)
+        return df
+
+    def get_len(self):
+        return len(self.names)
+
+    def save(self, folder: str) -> None:
+        """
+        Writes the panel to a folder as .npy arrays (dates, rors, mask) and a .json list of names, so other
+        processes can memory-map it with load instead of receiving a pickled copy.
+
+        Parameters:
+            folder: The folder to write to. It is created if needed.
+        """
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, 'dates.npy'), self.dates.astype('datetime64[ns]'), allow_pickle=False)
+        np.save(os.path.join(folder, 'rors.npy'), np.ascontiguousarray(self.rors), allow_pickle=False)
+        np.save(os.path.join(folder, 'mask.npy'), np.ascontiguousarray(self.mask), allow_pickle=False)
+        with open(os.path.join(folder, 'names.json'), 'w') as f:
+            json.dump([str(name) for name in self.names], f)
+
+    @classmethod
+    def load(cls, folder: str, mmap_mode='r'):
+        """
+        Reads a panel written by save. By default the arrays are memory-mapped read-only, so every process that
+        loads the same folder shares one copy of the data.
+
+        Parameters:
+            folder: The folder written by save.
+            mmap_mode: Passed to np.load. None reads the arrays into memory.
+        """
+        with open(os.path.join(folder, 'names.json')) as f:
+            names = json.load(f)
+        return cls(np.load(os.path.join(folder, 'dates.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(folder, 'rors.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(folder, 'mask.npy'), mmap_mode=mmap_mode), names)
+
+
+class Benchmark:
+    """
+    An index (e.g. the S&P 500) that programs are compared to, such as for gain to pain.
+
+    Instance Attributes:
+    - name: the name of the benchmark
+    - timeseries: monthly ror timeseries
+    - dates: dates of the timeseries (datetime64), sorted
+    - rors: rors of the timeseries
+    - monthly: the rors on the global month calendar (see MonthlySeries)
+    """
+    name: str
+    timeseries: Timeseries
+    dates: np.ndarray
+    rors: np.ndarray
+    monthly: MonthlySeries
+
+    def __init__(self, name: str, timeseries: Timeseries) -> None:
+        self.name = name
+        self.timeseries = timeseries
+        self.dates = timeseries.data.index.values
+        self.rors = np.asarray(timeseries.get_rors(), dtype=float)
+        self.monthly = MonthlySeries.from_timeseries(timeseries, f"Benchmark '{name}'")
+
+    def align(self, dates: np.ndarray) -> np.ndarray:
+        """
+        Returns the benchmark's rors on the given calendar (e.g. a ReturnsPanel's dates), nan on months without
+        benchmark data. Each date's ror is found by its month offset from the benchmark's first month.
+        """
+        positions = to_months(dates) - self.monthly.start
+        found = (positions >= 0) & (positions < len(self.rors))
+        aligned = np.full(len(positions), np.nan)
+        aligned[found] = self.rors[positions[found]]
+        return aligned
+
+    def down_mask(self, dates: np.ndarray) -> np.ndarray:
+        """
+        Returns a boolean array, True on the given dates when the benchmark is down. Dates without benchmark data
+        are False.
+        """
+        return self.align(dates) < 0
+
 
 class Program:
     """
     Contains all necessary information for an emerging manager.
     TODO: Prev: add equality functions? Like to see whether Manager 1 > Manager 2. Maybe based on overall_score.
 
+    Programs are compared and hashed by their ID, so sets and dicts of programs never compare timeseries.
+    Unregistered programs (id None) are only equal to themselves.
+
     Instance Attributes:
+    - id: the program's integer ID in its ProgramRegistry, or None if it is not registered
     - name: the name of the program
     - manager: the name of the manager
     - timeseries: monthly ror timeseries
@@ -78,7 +516,16 @@ class Program:
     - max_drawdown: manager's maximum drawdown
     - max_drawdown_length: length (in months) of maximum drawdown. Measured from peak to trough.
     - max_drawdown_duration: duration/recovery time (in months) of maximum drawdown
+    - stability: standard deviation of the rolling Sharpe ratios, if the universe scores it (see
+      ManagerUniverse.stability_window)
+    - window_metrics: metrics of the in-sample (False) and full (True) windows, see ManagerUniverse.calculate_windows
     """
+    __slots__ = ('id', 'name', 'manager', 'full_timeseries', 'timeseries', 'test_timeseries', 'omega_score',
+                 'sharpe_ratio', 'scores', 'overall_score', 'overall_weight', 'vol_weight', 'max_drawdown',
+                 'max_drawdown_length', 'max_drawdown_duration', 'pop_to_drop', 'gain_to_pain', 'stability',
+                 'window_metrics')
+
+    id: int
     name: str
     manager: str
     full_timeseries: Timeseries
@@ -95,9 +542,12 @@ class Program:
     max_drawdown_duration: int
     pop_to_drop: float
     gain_to_pain: float
+    stability: float
+    window_metrics: dict
 
     def __init__(self, manager: str, fund_name: str,
-                 full_timeseries: Timeseries, timeseries: Timeseries, test_timeseries=None) -> None:
+                 full_timeseries: Timeseries, timeseries: Timeseries, test_timeseries=None, program_id=None) -> None:
+        self.id = program_id
         self.name = fund_name
         self.manager = manager
         self.full_timeseries = full_timeseries
@@ -114,31 +564,103 @@ class Program:
         self.max_drawdown_duration = None
         self.pop_to_drop = None
         self.gain_to_pain = None
+        self.stability = None
+        self.window_metrics = {}
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
-            return self.__dict__ == other.__dict__
+            return self is other or (self.id is not None and self.id == other.id)
         else:
             return False
 
     def __hash__(self):
-        return hash(self.name)
+        return hash(self.id) if self.id is not None else object.__hash__(self)
+
+    def __repr__(self):
+        return f'Program(id={self.id!r}, name={self.name!r})'
+
+
+class ProgramRegistry:
+    """
+    Gives each Program a stable integer ID, in the order the programs are added. IDs are never reused, so they
+    can index arrays of per-program values.
+
+    Instance Attributes:
+    - programs: the registered Programs; programs[i].id == i. These are the Programs as they were registered (by
+      the universe that loaded them). Windows of a universe share its registry but have their own Programs with
+      the same IDs, so a window's program compares equal to registry[program.id] without being the same object.
+    - name_ids: integer code of each program's name (the same for programs with the same name), in ID order
+    """
+    __slots__ = ('programs', '_name_codes', '_name_ids')
+
+    programs: list
+
+    def __init__(self) -> None:
+        self.programs = []
+        self._name_codes = {}
+        self._name_ids = []
+
+    def add(self, program: Program) -> int:
+        """
+        Registers a program and sets its ID.
+
+        Returns:
+            int: The program's ID.
+        """
+        program.id = len(self.programs)
+        self.programs.append(program)
+        self._name_ids.append(self._name_codes.setdefault(program.name, len(self._name_codes)))
+        return program.id
+
+    def get_name_ids(self, program_ids) -> np.ndarray:
+        """
+        Returns the integer code of each given program's name. Programs with the same name have the same code,
+        so names can be compared as integers.
+        """
+        return np.asarray(self._name_ids, dtype=np.int64)[np.asarray(program_ids, dtype=np.int64)]
+
+    def __getitem__(self, program_id: int) -> Program:
+        return self.programs[program_id]
+
+    def __len__(self) -> int:
+        return len(self.programs)
 
 
-@dataclass
 class Cluster:
     """
     Contains information for a cluster of Managers.
 
     Instance Attributes:
-    - programs: the set of Programs in this Cluster
     - head: head Program in this Cluster
+    - members: columns (following ManagerUniverse.get_panel's columns) of the Programs in this Cluster, sorted,
+      head included
+    - programs: read-only list of the Programs in this Cluster, the head first and then the other members in
+      column order. Kept for code written against the former set of Programs.
     - TODO: Prev: add a correlation matrix for all programs in Cluster?
     """
+    __slots__ = ('head', 'members', '_programs')
 
-    programs: set
     head: Program
+    members: np.ndarray
 
-    def __init__(self, head_program, programs) -> None:
+    def __init__(self, head_program, members, programs=None) -> None:
+        """
+        Parameters:
+            head_program: head Program of the cluster.
+            members: columns of the Programs in the cluster, head included.
+            programs: Programs of the universe, following get_panel's columns, so that members can be turned back
+                into Programs. Without it, programs only holds the head.
+        """
         self.head = head_program
-        self.programs = programs
+        self.members = np.asarray(members, dtype=np.int64)
+        self._programs = programs
+
+    @property
+    def programs(self) -> list:
+        if self._programs is None:
+            return [self.head]
+        return [self.head] + [self._programs[column] for column in self.members
+                              if self._programs[column] is not self.head]
+
+    def __len__(self) -> int:
+        return len(self.members)
@@ -0,0 +1,89 @@
+"""
+This file runs the universe's per-program calculations on an execution backend:
+
+- 'serial': everything runs in the calling thread (the default).
+- 'thread': a thread pool. numpy releases the GIL inside its kernels, so the blocks of programs run in parallel
+  without copying the returns.
+- 'process': a process pool. The panel is written once to a temporary folder as .npy arrays (see ReturnsPanel.save)
+  that every worker memory-maps read-only, so the returns are shared instead of being pickled to each worker.
+
+The programs (or correlation rows) are split into contiguous blocks, one task per block, and the results are
+returned in block order, so they are the same whatever the backend and the number of workers.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+import tempfile
+import numpy as np
+
+from Entities import ReturnsPanel
+
+BACKENDS = ('serial', 'thread', 'process')
+
+# Panel of the worker process, loaded by _init_worker
+_worker_panel = None
+
+
+def get_num_blocks(backend: str, max_workers=None) -> int:
+    """
+    Returns the number of blocks to split the work into: 1 for the serial backend, otherwise one per worker.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}'. Expected one of {BACKENDS}.")
+    if backend == 'serial':
+        return 1
+    return max_workers or os.cpu_count() or 1
+
+
+def split_blocks(n: int, num_blocks: int) -> list:
+    """
+    Splits range(n) into at most num_blocks contiguous slices of nearly equal size. There is always at least one
+    (possibly empty) slice.
+    """
+    bounds = np.linspace(0, n, max(1, min(num_blocks, n)) + 1).round().astype(int)
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def _init_worker(panel_folder) -> None:
+    """
+    Loads the shared panel (memory-mapped) in a worker process.
+    """
+    global _worker_panel
+    _worker_panel = ReturnsPanel.load(panel_folder)
+
+
+def _run_task(func, args):
+    """
+    Runs one task on the worker process's panel.
+    """
+    return func(_worker_panel, *args)
+
+
+def map_panel(func, panel: ReturnsPanel, tasks: list, backend='serial', max_workers=None) -> list:
+    """
+    Calls func(panel, *args) for every args in tasks on the given backend.
+
+    Parameters:
+        func: A module-level function (so it can be sent to worker processes). It must not modify the panel.
+        panel: The panel shared by every task.
+        tasks: The arguments of each call.
+        backend: One of BACKENDS.
+        max_workers: Number of threads or processes. Defaults to the number of CPUs.
+
+    Returns:
+        list: The result of each task, in the order of tasks.
+    """
+    get_num_blocks(backend, max_workers)  # Checks the backend
+    if backend == 'serial' or len(tasks) <= 1:
+        return [func(panel, *args) for args in tasks]
+
+    max_workers = min(max_workers or os.cpu_count() or 1, len(tasks))
+    if backend == 'thread':
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda args: func(panel, *args), tasks))
+
+    with tempfile.TemporaryDirectory(prefix='emp_panel_') as panel_folder:
+        panel.save(panel_folder)
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(panel_folder,)) as executor:
+            return list(executor.map(_run_task, [func] * len(tasks), tasks))
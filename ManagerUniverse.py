@@ -14,16 +14,36 @@ These Clusters are accessed through the Universe.
 5: Calculate weights for each Program based on its performance relative to its cluster peers.
 """
 import os
-from Entities import Program, Cluster
-from DataParser import DataParser
+from Entities import Program, ProgramRegistry, Cluster, ReturnsPanel, Timeseries
+from DataParser import DataParser, DEFAULT_BENCHMARKS, LONG_FORMAT_CHUNKSIZE, PARSE_MAX_WORKERS, \
+    load_benchmarks, parse_csvs, read_long_format
+from Trace import Trace, NO_TRACE
+from Execution import get_num_blocks, split_blocks, map_panel
 from StatsCalculations import *
-from scipy.stats import percentileofscore
 from itertools import chain
 import numpy as np
 
 import pandas as pd
 
 OMEGA_ANNUALIZED_THRESHOLD = 0.01  
+# Column name suffix of each weighting scheme's portfolio dataframe (see weighted_portfolios)
+PORTFOLIO_COLUMN_SUFFIXES = {'EMP': ' Weighted Returns', 'Vol': ' Weighted Returns', 'Equal': ' Equal Weighted Returns'}
+
+def _calc_block_metrics(panel: ReturnsPanel, block: slice, ends: list, threshold: float, benchmark_rors: dict) -> list:
+    """
+    Calculates the window metrics (see calc_window_metrics) of a block of the panel's columns. A task of
+    ManagerUniverse._calc_window_metrics.
+    """
+    return calc_window_metrics(panel.rors[:, block], panel.mask[:, block], ends, threshold, benchmark_rors)
+
+
+def _calc_block_correlations(panel: ReturnsPanel, rows: np.ndarray, ends: list) -> list:
+    """
+    Calculates the correlations between some rows and every column of the panel (see
+    calc_pearson_correlation_matrices). A task of ManagerUniverse._calc_correlation_matrices.
+    """
+    return calc_pearson_correlation_matrices(panel.rors, panel.mask, ends, rows=rows)
+
 
 class ManagerUniverse:
     """ Maintains all entities.
@@ -32,21 +52,89 @@ class ManagerUniverse:
     - _emerging_programs: The emerging managers that we are buiding clusters around and evaluating.
     - _other_programs: The other managers in the universe.
     - correlation_value: The minimum correlation between each program in a cluster.
+    - _panel: Columnar (dates x programs) rors of every program's full timeseries. Emerging programs come first.
+    - _end_date: End date of the in-sample window.
+    - _metrics: Program metrics of each window (False: in-sample, True: full), calculated once (see calculate_windows).
+    - _correlation_matrices: Head x program correlation matrix of each window, calculated once.
+    - _rolling_metrics: Rolling metrics of every program, by (window, full_timeseries) (see get_rolling_metrics).
+    - stability_window: If set, the scores also rank each program's stability: the standard deviation of its rolling
+      Sharpe ratios over windows of this many months (see get_stabilities), lower being more stable. Off by default.
+    - _cluster_heads: Column (following get_panel's columns) of the head of each cluster in _clusters.
+    - _cluster_pairs: (cluster, column) pairs of the members of _clusters, sorted by cluster then column.
+    - correlation_block_size: If set, the correlations are calculated in tiles of this many heads x programs and
+      only the pairs above correlation_value are kept (see calc_correlation_neighbors), instead of the dense
+      matrices. For universes too large for a head x program matrix.
+    - spill_dir: In blockwise mode, optional folder where the kept pairs are written as they are found.
+    - screening_recall: In blockwise mode, if set, the pairs are first screened with sketches of the rors and only
+      the candidates' exact correlations are calculated (see calc_screened_correlation_neighbors). This is the
+      fraction of the pairs above correlation_value that the screening should keep.
+    - _correlation_neighbors: In blockwise mode, the (heads, columns, correlations) pairs of each window above
+      _neighbors_threshold.
+    - backend: Execution backend of the per-program calculations ('serial', 'thread' or 'process', see Execution).
+    - max_workers: Number of threads or processes of the backend. Defaults to the number of CPUs.
+    - registry: Integer IDs of the programs (see ProgramRegistry). Windows of the universe share its registry, so
+      a program keeps its ID in every window.
+    - cache_dir: Folder of the on-disk cache of parsed CSVs (see DataParser), e.g. DataParser.CACHE_DIR. None (the
+      default) disables it.
+    - trace: Stage timers, counters and events of the universe's calculations (see Trace). Disabled by default.
+    - benchmarks: Maps each benchmark's name to the filepath of its CSV. Metrics relative to every benchmark are
+      calculated; the first benchmark is used for the programs' gain to pain.
     """
     _emerging_programs: list
     _other_programs: list
     _clusters: list
+    _cluster_heads: np.ndarray
+    _cluster_pairs: tuple
+    correlation_block_size: int
+    spill_dir: str
+    screening_recall: float
+    _correlation_neighbors: dict
+    registry: ProgramRegistry
+    _panel: ReturnsPanel
+    _end_date: str
+    _metrics: dict
+    _correlation_matrices: dict
+    _rolling_metrics: dict
+    stability_window: int
+    cache_dir: str
+    trace: Trace
+    benchmarks: dict
+    backend: str
+    max_workers: int
     # Prev: add cluster definite corr?
     correlation_value: float
 
-    def __init__(self, correlation_value=0.5) -> None:
+    def __init__(self, correlation_value=0.5, cache_dir=None, trace=None, benchmarks=None, registry=None,
+                 backend='serial', max_workers=None, correlation_block_size=None, spill_dir=None,
+                 screening_recall=None, stability_window=None) -> None:
         """Initialize a new Emerging Managers universe.
         The universe starts with no entities.
         """
         self._emerging_programs = []
         self._other_programs = []
         self._clusters = []
+        self._cluster_heads = np.zeros(0, dtype=int)
+        self._cluster_pairs = (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+        self.registry = registry or ProgramRegistry()
+        self._panel = None
+        self._end_date = None
+        self._metrics = {}
+        self._correlation_matrices = {}
+        self._correlation_neighbors = {}
+        self._rolling_metrics = {}
         self.corr = correlation_value
+        self.cache_dir = cache_dir
+        self.trace = trace or NO_TRACE
+        self.benchmarks = dict(benchmarks or DEFAULT_BENCHMARKS)
+        get_num_blocks(backend)  # Checks the backend
+        self.backend = backend
+        self.max_workers = max_workers
+        self.correlation_block_size = correlation_block_size
+        self.spill_dir = spill_dir
+        self.screening_recall = screening_recall
+        self.stability_window = stability_window
+        self._correlation_neighbors = {}
+        self._neighbors_threshold = None
 
     def populate_programs(self, path: str, is_emerging: bool, start_date=None, end_date=None, test_start_date=None, test_end_date=None) -> None:
         """
@@ -59,116 +147,638 @@ class ManagerUniverse:
             test_start_date: Start date for validation data.
             test_end_date: End date for validation data.
         """
+        self._panel = None
+        self._end_date = end_date
+        self._metrics = {}
+        self._correlation_matrices = {}
+        self._correlation_neighbors = {}
+        self._rolling_metrics = {}
         for i, filename in enumerate(os.listdir(path)):
             if filename == '.DS_Store':
                 continue
-            # print(i, filename)
 
-            dp = DataParser(path + '/' + filename)  # complete filepath to CSV from source]
+            dp = DataParser(path + '/' + filename, cache_dir=self.cache_dir)  # complete filepath to CSV from source]
+            self.trace.count('files_parsed')
+
+            # Read the CSV once; the full, in-sample and test timeseries are views over the same data
+            dp.parse()
+            self._add_program(dp.manager_name, dp.program_name, dp.data, is_emerging, start_date, end_date,
+                              test_start_date, test_end_date)
+
+
+    def populate_programs_concurrently(self, path: str, is_emerging: bool, start_date=None, end_date=None,
+                                      test_start_date=None, test_end_date=None,
+                                      max_workers=PARSE_MAX_WORKERS) -> dict:
+        """
+        Create Program objects from all CSVs in provided folder, like populate_programs, but read the files
+        concurrently (see DataParser.parse_csvs). The programs are added in the order of the sorted filenames, so
+        the universe is the same whatever order the files finish in. A file that fails to parse does not stop the
+        others: it is left out and reported.
+
+        Parameters:
+            path: Filepath to data folder. Hidden files (e.g. '.DS_Store') and sub-folders are skipped.
+            start_date: Start date for filtering (inclusive), a string in 'YYYY-MM-DD' format.
+            end_date: End date for filtering (inclusive), a string in 'YYYY-MM-DD' format.
+            test_start_date: Start date for validation data.
+            test_end_date: End date for validation data.
+            max_workers: Maximum number of files read at the same time.
+
+        Returns:
+            dict: Maps the filepath of each CSV that failed to its error message.
+        """
+        self._panel = None
+        self._end_date = end_date
+        self._metrics = {}
+        self._correlation_matrices = {}
+        self._correlation_neighbors = {}
+        self._rolling_metrics = {}
+        paths = [path + '/' + filename for filename in sorted(os.listdir(path))
+                 if not filename.startswith('.') and os.path.isfile(path + '/' + filename)]
+        with self.trace.stage('parse_csvs'):
+            parsers, errors = parse_csvs(paths, cache_dir=self.cache_dir, max_workers=max_workers)
+        self.trace.count('files_parsed', len(parsers))
+        for filepath, error in errors.items():
+            self.trace.event('csv_error', f'{filepath}: {error}')
+
+        for dp in parsers:
+            self._add_program(dp.manager_name, dp.program_name, dp.data, is_emerging, start_date, end_date,
+                              test_start_date, test_end_date)
+        return errors
+
+
+    def populate_programs_from_long_format(self, path: str, is_emerging, start_date=None, end_date=None,
+                                           test_start_date=None, test_end_date=None, chunksize=LONG_FORMAT_CHUNKSIZE,
+                                           grouped=True) -> None:
+        """
+        Create Program objects from a consolidated long-format CSV (the rows of many funds in one file, see
+        DataParser.read_long_format). The file is streamed in chunks, so it is never held in memory as a whole.
 
-            full_timeseries = dp.get_timeseries(start_date=start_date, end_date=None)
+        Parameters:
+            path: Filepath to the long-format CSV.
+            is_emerging: Whether the file's programs are emerging programs, or a collection of the names of the
+                emerging funds (the other funds of the file are added as other programs).
+            start_date: Start date for filtering (inclusive), a string in 'YYYY-MM-DD' format.
+            end_date: End date for filtering (inclusive), a string in 'YYYY-MM-DD' format.
+            test_start_date: Start date for validation data.
+            test_end_date: End date for validation data.
+            chunksize: Number of rows read at a time.
+            grouped: Whether the file is grouped by fund (see DataParser.read_long_format).
+        """
+        self._panel = None
+        self._end_date = end_date
+        self._metrics = {}
+        self._correlation_matrices = {}
+        self._correlation_neighbors = {}
+        self._rolling_metrics = {}
+        emerging_funds = None if isinstance(is_emerging, bool) else set(is_emerging)
+        for manager_name, fund_name, data in read_long_format(path, chunksize=chunksize, grouped=grouped):
+            self.trace.count('funds_streamed')
+            self._add_program(manager_name, fund_name, data,
+                              is_emerging if emerging_funds is None else fund_name in emerging_funds,
+                              start_date, end_date, test_start_date, test_end_date)
+
+
+    def _add_program(self, manager_name: str, fund_name: str, data: pd.Series, is_emerging: bool, start_date,
+                     end_date, test_start_date, test_end_date) -> None:
+        """
+        Creates a Program from a fund's date-indexed rors and adds it to the universe, unless its in-sample window
+        has fewer than 2 months.
+        """
+        # The full, in-sample and test timeseries are views over the same data
+        full_timeseries = Timeseries(data=data).get_window(start_date=start_date)
+        timeseries = Timeseries(data=data).get_window(start_date=start_date, end_date=end_date)
+        test_timeseries = Timeseries(data=data).get_window(start_date=test_start_date, end_date=test_end_date)
+        if timeseries.get_len() < 2:
+            self.trace.event('insufficient_data', fund_name)
+            self.trace.count('programs_dropped')
+            return
+
+        if test_timeseries.get_len() < 1:
+            test_timeseries = None
+
+        # Generate a new Program object for each fund and append this new program into the universe program list.
+        new_program = Program(manager_name, fund_name, full_timeseries, timeseries, test_timeseries)
+        self.registry.add(new_program)
+        if is_emerging:
+            self._emerging_programs.append(new_program)
+        else:
+            self._other_programs.append(new_program)
+
+
+    @classmethod
+    def from_panel(cls, panel: ReturnsPanel, num_emerging: int, managers=None, correlation_value=0.5,
+                   cache_dir=None, trace=None, benchmarks=None, backend='serial', max_workers=None,
+                   correlation_block_size=None, spill_dir=None, screening_recall=None, stability_window=None):
+        """
+        Creates a universe from a ReturnsPanel of full timeseries (e.g. one loaded with ReturnsPanel.load in
+        another process), without reading any program CSV.
+
+        Parameters:
+            panel: The rors of every program. The first num_emerging columns are the emerging programs.
+            num_emerging: Number of emerging programs.
+            managers: Manager name of each column. Defaults to the program names.
+            correlation_value: The minimum correlation between each program in a cluster.
+            cache_dir: Folder of the on-disk cache of parsed CSVs (used for the benchmark).
+            trace: Trace of the universe's calculations, or None to disable it.
+            benchmarks: Maps each benchmark's name to the filepath of its CSV. Defaults to DEFAULT_BENCHMARKS.
+            backend: Execution backend of the per-program calculations (see Execution).
+            max_workers: Number of threads or processes of the backend.
+            correlation_block_size: Tile size of the blockwise correlations, or None for the dense matrices.
+            spill_dir: In blockwise mode, optional folder where the kept correlation pairs are written.
+            screening_recall: In blockwise mode, the target recall of the sketch screening, or None to calculate
+                every pair exactly.
+            stability_window: Months per rolling window of the stability measure of the scores, or None to leave it
+                out.
+
+        Returns:
+            ManagerUniverse: A universe whose panel is the given panel.
+        """
+        universe = cls(correlation_value, cache_dir=cache_dir, trace=trace, benchmarks=benchmarks, backend=backend,
+                       max_workers=max_workers, correlation_block_size=correlation_block_size, spill_dir=spill_dir,
+                       screening_recall=screening_recall, stability_window=stability_window)
+        managers = managers or panel.names
+        for column, name in enumerate(panel.names):
+            timeseries = panel.get_timeseries(column)
+            new_program = Program(managers[column], name, timeseries, timeseries)
+            universe.registry.add(new_program)
+            if column < num_emerging:
+                universe._emerging_programs.append(new_program)
+            else:
+                universe._other_programs.append(new_program)
+        universe._panel = panel
+        return universe
+
+
+    def get_panel(self, full_timeseries: bool) -> ReturnsPanel:
+        """
+        Returns the rors of every program in the universe as one ReturnsPanel. Columns follow
+        chain(self._emerging_programs, self._other_programs).
+
+        Parameters:
+            full_timeseries: If True, return the full timeseries window. Otherwise return the in-sample window
+                (a view over the first rows of the full window).
+        """
+        if self._panel is None:
+            programs = list(chain(self._emerging_programs, self._other_programs))
+            self._panel = ReturnsPanel.from_timeseries([program.name for program in programs],
+                                                       [program.full_timeseries for program in programs])
+        if full_timeseries:
+            return self._panel
+        return self._panel.window(end_date=self._end_date)
 
-            timeseries = dp.get_timeseries(start_date=start_date, end_date=end_date)
+
+    def get_name_ids(self) -> np.ndarray:
+        """
+        Returns the integer code of each program's name (see ProgramRegistry.get_name_ids), following get_panel's
+        columns.
+        """
+        return self.registry.get_name_ids([program.id for program in chain(self._emerging_programs,
+                                                                           self._other_programs)])
+
+
+    def window(self, start_date=None, end_date=None):
+        """
+        Creates a universe of the same programs restricted to a date window, without reading any CSV again.
+        This gives the same universe as calling populate_programs with start_date and end_date, so a universe
+        loaded once (without dates) can be reused for any window.
+
+        Parameters:
+            start_date: Start date for filtering (inclusive), a string in 'YYYY-MM-DD' format.
+            end_date: End date of the in-sample window (inclusive), a string in 'YYYY-MM-DD' format.
+
+        Returns:
+            ManagerUniverse: A new universe. Its timeseries are views over this universe's timeseries.
+        """
+        universe = ManagerUniverse(self.corr, cache_dir=self.cache_dir, trace=self.trace,
+                                   benchmarks=self.benchmarks, registry=self.registry, backend=self.backend,
+                                   max_workers=self.max_workers, correlation_block_size=self.correlation_block_size,
+                                   spill_dir=self.spill_dir, screening_recall=self.screening_recall,
+                                   stability_window=self.stability_window)
+        universe._end_date = end_date
+        columns = []
+        for column, program in enumerate(chain(self._emerging_programs, self._other_programs)):
+            full_timeseries = program.full_timeseries.get_window(start_date=start_date)
+            timeseries = full_timeseries.get_window(end_date=end_date)
             if timeseries.get_len() < 2:
-                print(f'Insufficient data for {dp.program_name}.')
+                self.trace.event('insufficient_data', program.name)
+                self.trace.count('programs_dropped')
                 continue
 
-            test_timeseries = dp.get_timeseries(start_date=test_start_date, end_date=test_end_date)
-            if test_timeseries.get_len() < 1:
-                test_timeseries = None
+            columns.append(column)
+            new_program = Program(program.manager, program.name, full_timeseries, timeseries, program_id=program.id)
+            if column < len(self._emerging_programs):
+                universe._emerging_programs.append(new_program)
+            else:
+                universe._other_programs.append(new_program)
 
-            manager_name: str = dp.manager_name
-            fund_name: str = dp.program_name
+        universe._panel = self.get_panel(full_timeseries=True).window(start_date=start_date).select(columns)
+        return universe
 
-            # Generate a new Program object for each CSV and append this new program into the universe program list.
-            new_program = Program(manager_name, fund_name, full_timeseries, timeseries, test_timeseries)
-            if is_emerging:
-                self._emerging_programs.append(new_program)
-            else:
-                self._other_programs.append(new_program)
 
+    def calculate_windows(self) -> None:
+        """
+        Calculates the metrics and the head x program correlation matrix of both the in-sample and the full window
+        in one pass. The in-sample window is a prefix of the full window, so the sums, products and drawdown
+        curves of the full window are built from the in-sample window's (see calc_window_metrics and
+        calc_pearson_correlation_matrices) instead of being calculated again.
 
-    def perform_program_stats_calculations(self, full_timeseries: bool):
+        Each program's metrics of both windows are also stored in its window_metrics.
+        """
+        panel = self.get_panel(full_timeseries=True)
+        ends = [len(self.get_panel(full_timeseries=False).dates), len(panel.dates)]
+
+        with self.trace.stage('metrics'):
+            in_sample_metrics, full_metrics = self._calc_window_metrics(panel, ends)
+            self._metrics = {False: in_sample_metrics, True: full_metrics}
+
+            for column, program in enumerate(chain(self._emerging_programs, self._other_programs)):
+                program.window_metrics = {
+                    full_timeseries: {name: values[column] for name, values in metrics.items()}
+                    for full_timeseries, metrics in self._metrics.items()
+                }
+
+        with self.trace.stage('correlation'):
+            # Emerging programs are the first columns, so the head rows are 0 .. len(self._emerging_programs) - 1
+            heads = np.arange(len(self._emerging_programs))
+            self.trace.count('correlation_pairs', 2 * len(heads) * panel.get_len())
+            if self.correlation_block_size:
+                self._calc_correlation_neighbors(panel, ends)
+                return
+
+            in_sample_matrix, full_matrix = self._calc_correlation_matrices(panel, ends, heads)
+            self._correlation_matrices = {False: in_sample_matrix, True: full_matrix}
+            if self.trace.enabled:
+                # Pairs with fewer than 2 overlapping dates get a correlation of 0 (see calc_pearson_correlation_matrix)
+                available = panel.mask.astype(float)
+                in_sample_overlap = available[:ends[0], heads].T @ available[:ends[0]]
+                full_overlap = in_sample_overlap + available[ends[0]:, heads].T @ available[ends[0]:]
+                self.trace.count('correlation_pairs_insufficient_overlap',
+                                 np.sum(in_sample_overlap < 2) + np.sum(full_overlap < 2))
+
+
+    def _calc_window_metrics(self, panel: ReturnsPanel, ends: list) -> list:
+        """
+        Calculates the metrics of every column of a panel on the prefix windows ending at ends (see
+        calc_window_metrics), relative to every benchmark.
+        """
+        # Benchmark rors aligned on the panel's dates (loaded once per process). Months without benchmark data
+        # are never counted.
+        benchmarks = load_benchmarks(self.benchmarks, cache_dir=self.cache_dir)
+        benchmark_rors = {name: benchmark.align(panel.dates) for name, benchmark in benchmarks.items()}
+
+        # Programs are independent, so each block of columns is one task of the backend
+        blocks = split_blocks(panel.get_len(), get_num_blocks(self.backend, self.max_workers))
+        tasks = [(block, ends, OMEGA_ANNUALIZED_THRESHOLD, benchmark_rors) for block in blocks]
+        results = map_panel(_calc_block_metrics, panel, tasks, self.backend, self.max_workers)
+        window_metrics = [{name: np.concatenate([result[window][name] for result in results])
+                           for name in results[0][window]} for window in range(len(ends))]
+        for metrics in window_metrics:
+            metrics['gain_to_pain'] = metrics[f'gain_to_pain ({next(iter(self.benchmarks))})']
+        return window_metrics
+
+
+    def _calc_correlation_matrices(self, panel: ReturnsPanel, ends: list, rows: np.ndarray) -> list:
+        """
+        Calculates the correlation between the given rows (columns of the panel) and every column of the panel on
+        the prefix windows ending at ends (see calc_pearson_correlation_matrices). Each block of rows is one task of
+        the backend.
+        """
+        blocks = split_blocks(len(rows), get_num_blocks(self.backend, self.max_workers))
+        tasks = [(rows[block], ends) for block in blocks]
+        results = map_panel(_calc_block_correlations, panel, tasks, self.backend, self.max_workers)
+        return [np.vstack([result[window] for result in results]) for window in range(len(ends))]
+
+
+    def _calc_correlation_neighbors(self, panel: ReturnsPanel, ends: list) -> None:
+        """
+        Calculates the head x program correlation pairs above self.corr of both windows, tile by tile (see
+        calc_correlation_neighbors), or only for the candidates of the sketch screening if screening_recall is set.
         """
-        Performs all stats calculations on each program in the universe.
+        heads = np.arange(len(self._emerging_programs))
+        if self.screening_recall:
+            (in_sample_neighbors, full_neighbors), _, num_candidates = calc_screened_correlation_neighbors(
+                panel.rors, panel.mask, ends, self.corr, rows=heads, recall=self.screening_recall,
+                block_size=self.correlation_block_size)
+            self.trace.count('correlation_candidates', num_candidates)
+        else:
+            in_sample_neighbors, full_neighbors = calc_correlation_neighbors(
+                panel.rors, panel.mask, ends, self.corr, rows=heads, block_size=self.correlation_block_size,
+                spill_dir=self.spill_dir)
+        self._correlation_neighbors = {False: in_sample_neighbors, True: full_neighbors}
+        self._neighbors_threshold = self.corr
+        self.trace.count('correlation_neighbors', len(in_sample_neighbors[0]) + len(full_neighbors[0]))
+
+
+    def get_correlation_neighbors(self, full_timeseries: bool) -> tuple:
+        """
+        Returns the (heads, columns, correlations) pairs with a correlation above self.corr on one window, in
+        blockwise mode (see correlation_block_size). They are calculated again only if self.corr is lowered below
+        the threshold they were calculated with.
+
+        Parameters:
+            full_timeseries: If True, use the full timeseries window. Otherwise use the in-sample window.
         """
-        dp = DataParser("data/sp500.csv")
-        s_and_p = dp.get_timeseries()
+        if full_timeseries not in self._correlation_neighbors or self.corr < self._neighbors_threshold:
+            panel = self.get_panel(full_timeseries=True)
+            ends = [len(self.get_panel(full_timeseries=False).dates), len(panel.dates)]
+            with self.trace.stage('correlation'):
+                self._calc_correlation_neighbors(panel, ends)
+        heads, columns, correlations = self._correlation_neighbors[full_timeseries]
+        above = correlations > self.corr
+        return heads[above], columns[above], correlations[above]
 
-        for program in chain(self._emerging_programs, self._other_programs):
-            if full_timeseries:
-                rors = program.timeseries.get_rors()
+
+    def update_returns(self, records) -> np.ndarray:
+        """
+        Adds a batch of new returns (e.g. one month end of every program) without reloading any CSV.
+
+        The rors are written in place into the panel, whose new rows are appended into preallocated storage (see
+        ReturnsPanel.update). If the windows were already calculated, only the metrics of the updated programs,
+        and the correlations between them and every other program, are calculated again; the rest of the
+        universe is left untouched. Clusters and scores must be calculated again to take the new returns into
+        account.
+
+        Parameters:
+            records: Iterable of (program, date, ror) tuples. program is a Program of this universe or its name.
+                Dates are matched by month; new months must come after the last month of the universe.
+
+        Returns:
+            np.ndarray: The columns (following get_panel's columns) of the updated programs.
+        """
+        programs = list(chain(self._emerging_programs, self._other_programs))
+        columns_by_id = {program.id: column for column, program in enumerate(programs)}
+        panel = self.get_panel(full_timeseries=True)
+
+        columns, dates, rors = [], [], []
+        for program, date, ror in records:
+            if isinstance(program, Program):
+                column = columns_by_id.get(program.id)
             else:
-                rors = program.full_timeseries.get_rors()                
-            program.omega_score = calc_omega_score(rors, OMEGA_ANNUALIZED_THRESHOLD)
-            if program.omega_score is None:
-                print(f"Could not calculate Omega score for {program.name}")
-            program.sharpe_ratio = calc_sharpe_ratio(rors)
+                column = panel.index.get(program)
+            if column is None:
+                raise KeyError(f'{program} is not in the universe.')
+            columns.append(column)
+            dates.append(date)
+            rors.append(ror)
+
+        with self.trace.stage('update'):
+            updated = panel.update(dates, columns, rors)
+            self._rolling_metrics = {}
+            self._correlation_neighbors = {}
+            self.trace.count('returns_updated', len(rors))
+            for column in updated:
+                program = programs[column]
+                program.full_timeseries = panel.get_timeseries(column)
+                program.timeseries = program.full_timeseries.get_window(end_date=self._end_date)
+
+            if self._metrics and len(updated):
+                ends = [len(self.get_panel(full_timeseries=False).dates), len(panel.dates)]
+                updated_panel = ReturnsPanel(panel.dates, panel.rors[:, updated], panel.mask[:, updated],
+                                             [panel.names[column] for column in updated])
+                for full_timeseries, metrics in zip((False, True), self._calc_window_metrics(updated_panel, ends)):
+                    for name, values in metrics.items():
+                        self._metrics[full_timeseries][name][updated] = values
+                for column in updated:
+                    programs[column].window_metrics = {
+                        full_timeseries: {name: values[column] for name, values in metrics.items()}
+                        for full_timeseries, metrics in self._metrics.items()
+                    }
+
+            if self._correlation_matrices and len(updated):
+                ends = [len(self.get_panel(full_timeseries=False).dates), len(panel.dates)]
+                heads = np.arange(len(self._emerging_programs))
+                # Columns of the updated programs: every head against them. The correlation only depends on the
+                # two columns, so the heads and the updated columns are enough.
+                columns = np.union1d(heads, updated)
+                column_panel = ReturnsPanel(panel.dates, panel.rors[:, columns], panel.mask[:, columns],
+                                            [panel.names[column] for column in columns])
+                column_matrices = self._calc_correlation_matrices(column_panel, ends, heads)
+                positions = np.searchsorted(columns, updated)
+                # Rows of the updated heads: the updated heads against every program
+                updated_heads = updated[updated < len(heads)]
+                row_matrices = self._calc_correlation_matrices(panel, ends, updated_heads)
+                for full_timeseries, column_matrix, row_matrix in zip((False, True), column_matrices, row_matrices):
+                    matrix = self._correlation_matrices[full_timeseries]
+                    matrix[:, updated] = column_matrix[:, positions]
+                    matrix[updated_heads] = row_matrix
+                self.trace.count('correlation_pairs', 2 * (len(heads) * len(updated)
+                                                           + len(updated_heads) * panel.get_len()))
+
+        return updated
+
+
+    def get_program_metrics(self, full_timeseries: bool) -> dict:
+        """
+        Returns the metrics of every program on one window. Both windows are calculated once, together
+        (see calculate_windows).
+
+        Parameters:
+            full_timeseries: If True, use the full timeseries window. Otherwise use the in-sample window.
+
+        Returns:
+            dict: Arrays (one value per program, following get_panel's columns) for 'count', 'omega_score',
+                'volatility', 'sharpe_ratio', 'max_drawdown' (weighted drawdown area), 'pop_to_drop',
+                'gain_to_pain' (relative to the first benchmark) and each benchmark's metrics, e.g.
+                'beta (S&P 500)' (see calc_window_metrics).
+        """
+        if full_timeseries not in self._metrics:
+            self.calculate_windows()
+        return self._metrics[full_timeseries]
+
+
+    def get_rolling_metrics(self, window=12, full_timeseries=True) -> dict:
+        """
+        Returns the rolling metrics of every program over its last window months (see calc_rolling_metrics), e.g.
+        to judge the stability of its performance. Each window is calculated once, in linear time.
+
+        Parameters:
+            window: Number of months per window, e.g. 12, 24 or 36.
+            full_timeseries: If True, use the full timeseries window. Otherwise use the in-sample window.
+
+        Returns:
+            dict: Maps each metric in ROLLING_METRICS to a date-indexed DataFrame with one column per program
+                (following get_panel's columns), nan where a program has no data or fewer than window months.
+        """
+        key = (window, full_timeseries)
+        if key not in self._rolling_metrics:
+            panel = self.get_panel(full_timeseries)
+            with self.trace.stage('rolling'):
+                rolling = calc_rolling_metrics(panel.rors, panel.mask, window, OMEGA_ANNUALIZED_THRESHOLD)
+            index = pd.DatetimeIndex(panel.dates, name='Date')
+            self._rolling_metrics[key] = {name: pd.DataFrame(values, index=index, columns=panel.names)
+                                          for name, values in rolling.items()}
+        return self._rolling_metrics[key]
+
+
+    def get_stabilities(self, full_timeseries: bool) -> np.ndarray:
+        """
+        Returns the stability of every program on one window: the standard deviation of its rolling Sharpe ratios
+        over stability_window months (see get_rolling_metrics and calc_rolling_stabilities). Lower is more stable.
+
+        Parameters:
+            full_timeseries: If True, use the full timeseries window. Otherwise use the in-sample window.
+
+        Returns:
+            np.ndarray: The stability of each program (following get_panel's columns), nan for programs with fewer
+                than 2 windows.
+        """
+        rolling_sharpe = self.get_rolling_metrics(self.stability_window, full_timeseries)['sharpe_ratio']
+        return calc_rolling_stabilities(rolling_sharpe.to_numpy())
+
+
+    def perform_program_stats_calculations(self, full_timeseries: bool):
+        """
+        Sets the stats of each program in the universe to its metrics on one window.
+
+        Parameters:
+            full_timeseries: If True, use the full timeseries window. Otherwise use the in-sample window.
+        """
+        metrics = self.get_program_metrics(full_timeseries)
+        stabilities = self.get_stabilities(full_timeseries) if self.stability_window else None
+
+        counts = metrics['count']
+        for column, program in enumerate(chain(self._emerging_programs, self._other_programs)):
+            program.omega_score = metrics['omega_score'][column]
+            if program.omega_score is None or np.isnan(program.omega_score):
+                self.trace.event('omega_score_unavailable', program.name)
+            program.sharpe_ratio = metrics['sharpe_ratio'][column] if counts[column] >= 2 else None
             if program.sharpe_ratio is None:
-                print(f"Could not calculate Sharpe ratio for {program.name}")
-            if len(rors) < 2:
-                print(f"Could not perform drawdown analysis for {program.name}")
+                self.trace.event('sharpe_ratio_unavailable', program.name)
+            if counts[column] < 2:
+                self.trace.event('drawdown_unavailable', program.name)
             else:
-                program.max_drawdown = calc_weighted_drawdown_area(rors, False, True)
-            program.pop_to_drop = calc_pop_to_drop(rors, 95, 5)
-            program.gain_to_pain = calc_gain_to_pain(program.full_timeseries, s_and_p)
+                program.max_drawdown = metrics['max_drawdown'][column]
+            program.pop_to_drop = metrics['pop_to_drop'][column]
+            program.gain_to_pain = metrics['gain_to_pain'][column]
+            if stabilities is not None:
+                program.stability = stabilities[column]
             
         # Flagged. Need to establish algorithm's behaviour when a score can't be calculated.
 
 
+    def get_correlation_matrix(self, full_timeseries: bool) -> np.ndarray:
+        """
+        Returns the correlation between every emerging program (rows) and every program (columns, following
+        get_panel's columns) on one window. Both windows are calculated once, together (see calculate_windows),
+        so changing self.corr only re-thresholds the same matrix.
+
+        Parameters:
+            full_timeseries: If True, use the full timeseries window. Otherwise use the in-sample window.
+        """
+        if self.correlation_block_size:
+            raise ValueError('The dense correlation matrices are not calculated in blockwise mode (see '
+                             'correlation_block_size). Use get_correlation_neighbors instead.')
+        if full_timeseries not in self._correlation_matrices:
+            self.calculate_windows()
+        return self._correlation_matrices[full_timeseries]
+
+
     def populate_clusters(self, full_timeseries: bool):
         """
-        For each program, create a set that contains all programs with corr > 0.65.
+        For each program, create a set that contains all programs with corr > self.corr.
         Then, create a cluster object that contains the head program and the set we just created. 
         Add this cluster into the cluster list.
 
+        The correlations between every head and every program are calculated at once from a date-aligned
+        matrix of all programs (see get_correlation_matrix), so the clusters are a threshold of the matrix. In
+        blockwise mode, they are the correlation pairs above self.corr (see get_correlation_neighbors).
+
         Prev: create eq and hash function for Program class?
         """
-        self._clusters = []
-        for head in self._emerging_programs:
-            cluster = set()
-            cluster.add(head)
-            for others in chain(self._emerging_programs, self._other_programs):
-                if others.name != head.name:
-                    # Get correlation between two program' synced rors
-                    if full_timeseries:
-                        corr = calc_pearson_correlation(head.full_timeseries, others.full_timeseries)
-                    else:
-                        corr = calc_pearson_correlation(head.timeseries, others.timeseries)
-                    if corr > self.corr:
-                        cluster.add(others)
-                
-            new_cluster = Cluster(head, cluster)
-            self._clusters.append(new_cluster)
+        # Programs with the same name as the head are left out of its cluster, except the head itself
+        names = self.get_name_ids()
+        heads = np.arange(len(self._emerging_programs))
+        if self.correlation_block_size:
+            clusters, columns, _ = self.get_correlation_neighbors(full_timeseries)
+            kept = names[columns] != names[heads[clusters]]
+            self.set_cluster_pairs(heads, np.concatenate([clusters[kept], np.arange(len(heads))]),
+                                   np.concatenate([columns[kept], heads]))
+            return
+
+        corr_matrix = self.get_correlation_matrix(full_timeseries)
+        members = (corr_matrix > self.corr) & (names[None, :] != names[heads, None])
+        members[heads, heads] = True
+        self.set_clusters(heads, members)
+
+
+    def set_clusters(self, heads: np.ndarray, members: np.ndarray) -> None:
+        """
+        Replaces the clusters with the clusters of a membership matrix.
 
+        Parameters:
+            heads: Column (following get_panel's columns) of each cluster's head program.
+            members: (clusters x programs) boolean matrix, True where a program is in a cluster. Each head is in
+                its own cluster.
+        """
+        self.set_cluster_pairs(heads, *np.nonzero(np.asarray(members, dtype=bool)))
 
-    def assign_scores(self):
+
+    def set_cluster_pairs(self, heads: np.ndarray, clusters: np.ndarray, columns: np.ndarray) -> None:
         """
-        Assigns scores to each program based on performance relative to its cluster.
+        Replaces the clusters with the clusters of a list of membership pairs.
+
+        Parameters:
+            heads: Column (following get_panel's columns) of each cluster's head program.
+            clusters: Cluster (position in heads) of each membership pair.
+            columns: Column of the program of each membership pair. Each head is in its own cluster.
         """
-        # Calculate the performance of the each program relative to the others in its cluster
-        for each_cluster in self._clusters:
-            percentile_list = []
-            
-            omega_data = [program.omega_score for program in each_cluster.programs]
-            head_omega_percentile = percentileofscore(omega_data, each_cluster.head.omega_score)
-            percentile_list.append(head_omega_percentile)
+        programs = list(chain(self._emerging_programs, self._other_programs))
+        clusters = np.asarray(clusters, dtype=int)
+        columns = np.asarray(columns, dtype=int)
+        order = np.lexsort((columns, clusters))
+        clusters, columns = clusters[order], columns[order]
+
+        self._cluster_heads = np.asarray(heads, dtype=int)
+        self._cluster_pairs = (clusters, columns)
+        bounds = np.searchsorted(clusters, np.arange(len(self._cluster_heads) + 1))
+        self._clusters = [Cluster(programs[head], columns[bounds[i]:bounds[i + 1]], programs)
+                          for i, head in enumerate(self._cluster_heads)]
+        self.trace.count('cluster_members', len(columns))
+
+
+    def get_cluster_programs(self, cluster: Cluster) -> list:
+        """
+        Returns the Programs of a cluster, head included.
+        """
+        programs = list(chain(self._emerging_programs, self._other_programs))
+        return [programs[column] for column in cluster.members]
 
-            max_dd_data = [program.max_drawdown for program in each_cluster.programs]
-            head_max_dd_percentile = percentileofscore(max_dd_data, each_cluster.head.max_drawdown)
-            percentile_list.append(head_max_dd_percentile)
 
-            sharpe_data = [program.sharpe_ratio for program in each_cluster.programs]
-            head_sharpe_percentile = percentileofscore(sharpe_data, each_cluster.head.sharpe_ratio)
-            percentile_list.append(head_sharpe_percentile)
+    def assign_scores(self):
+        """
+        Assigns scores to each program based on performance relative to its cluster.
 
-            ptd_data = [program.pop_to_drop for program in each_cluster.programs]
-            gtp_data = [program.gain_to_pain for program in each_cluster.programs]
-            head_ptd_percentile = percentileofscore(ptd_data, each_cluster.head.pop_to_drop)
-            head_gtp_percentile = percentileofscore(gtp_data, each_cluster.head.gain_to_pain)
-            percentile_list.append((head_ptd_percentile + head_gtp_percentile)/2)
+        The percentile of each head's metrics within its cluster is calculated for all clusters at once from the
+        membership pairs (see calc_sparse_cluster_percentiles), with the same values as
+        scipy.stats.percentileofscore.
 
-            each_cluster.head.scores.append(np.mean(percentile_list))
+        If stability_window is set, the stability (see get_stabilities) is a fifth measure, ranked among the
+        members that have one (a lower standard deviation ranks higher). Heads without one keep the mean of the
+        other four measures.
+        """
+        programs = list(chain(self._emerging_programs, self._other_programs))
+        heads, (clusters, columns) = self._cluster_heads, self._cluster_pairs
+        if len(heads) == 0:
+            return
+
+        # One column per metric: omega, max drawdown, sharpe, pop to drop, gain to pain. Unknown values are nan.
+        metrics = np.array([[program.omega_score, program.max_drawdown, program.sharpe_ratio, program.pop_to_drop,
+                             program.gain_to_pain] for program in programs], dtype=float)
+        omega, max_dd, sharpe, ptd, gtp = (calc_sparse_cluster_percentiles(metrics[:, i], clusters, columns,
+                                                                           metrics[heads, i])
+                                           for i in range(metrics.shape[1]))
+
+        # Calculate the performance of the each program relative to the others in its cluster.
+        # Pop to drop and gain to pain count as one measure.
+        head_scores = np.mean([omega, max_dd, sharpe, (ptd + gtp) / 2], axis=0)
+        if self.stability_window:
+            stabilities = np.array([program.stability for program in programs], dtype=float)
+            known = ~np.isnan(stabilities[columns])
+            stability = calc_sparse_cluster_percentiles(-stabilities, clusters[known], columns[known],
+                                                        -stabilities[heads])
+            head_scores = np.where(np.isnan(stability), head_scores, (4 * head_scores + stability) / 5)
+        for head, score in zip(heads, head_scores):
+            programs[head].scores.append(score)
 
 
     def ratings_df(self, w):
@@ -231,9 +841,7 @@ class ManagerUniverse:
         Parameters:
             ratings_df (pd.Dataframe): The dataframe that stores the weights.
         """
-        program_volatility = []
-        for program in self._emerging_programs:
-            program_volatility.append(np.std(program.timeseries.get_rors()))
+        program_volatility = self.get_program_metrics(full_timeseries=False)['volatility'][:len(self._emerging_programs)]
         
         # Invert the volatilities
         inv_vol_weights = [1 / vol if vol != 0 else 0 for vol in program_volatility]
@@ -274,24 +882,65 @@ class ManagerUniverse:
         Returns:
             pd.DataFrame: Rate of returns. Columns are programs, rows are months.
         """
-        program_df = pd.DataFrame({'Date': pd.to_datetime([])})
-        
-        for program in self._emerging_programs:
-            df = pd.DataFrame({
-                'Date': program.full_timeseries.get_dates(),
-                f'{program.name}': program.full_timeseries.get_rors(),
-            })
-            program_df = pd.merge(program_df, df, on='Date', how='outer')
-        
-        program_df['Date'] = pd.to_datetime(program_df['Date'])
-        program_df.set_index('Date', inplace=True)
-        return program_df
+        return self.get_portfolio_panel(iter=False).to_dataframe()
     
     
     ####
     # Weighted Portfolios
     ####
 
+    def get_portfolio_panel(self, iter: bool) -> ReturnsPanel:
+        """
+        Aligns the emerging programs' rors once, on the union of their dates.
+
+        Parameters:
+            iter: If True, use each program's test timeseries. Otherwise use its full timeseries.
+
+        Returns:
+            ReturnsPanel: (dates x emerging programs) rors.
+        """
+        if iter:
+            names = [program.name for program in self._emerging_programs]
+            timeseries_list = [program.test_timeseries or Timeseries() for program in self._emerging_programs]
+            return ReturnsPanel.from_timeseries(names, timeseries_list)
+        return self.get_panel(full_timeseries=True).select(np.arange(len(self._emerging_programs)))
+
+
+    def weighted_portfolios(self, iter: bool, weights=None) -> dict:
+        """
+        Creates a dataframe of weighted rate of returns for each program, for several weighting schemes at once.
+        The rors are aligned once and each scheme's weights are broadcast over the aligned matrix.
+
+        Parameters:
+            iter: If True, weight each program's test timeseries. Otherwise weight its full timeseries.
+            weights: Maps a scheme name to its weights (one per emerging program, in order). Defaults to the
+                'EMP' (overall_weight), 'Vol' (vol_weight) and 'Equal' weights.
+
+        Returns:
+            dict: Maps each scheme name to its pd.DataFrame of weighted rate of returns. Columns are programs,
+                rows are months.
+        """
+        if weights is None:
+            num_programs = len(self._emerging_programs)
+            weights = {
+                'EMP': [program.overall_weight for program in self._emerging_programs],
+                'Vol': [program.vol_weight for program in self._emerging_programs],
+                'Equal': [1 / num_programs] * num_programs,
+            }
+
+        panel = self.get_portfolio_panel(iter)
+        rors = np.where(panel.mask, panel.rors, np.nan)
+        index = pd.DatetimeIndex(panel.dates, name='Date')
+
+        portfolios = {}
+        for scheme, scheme_weights in weights.items():
+            suffix = PORTFOLIO_COLUMN_SUFFIXES.get(scheme, f' {scheme} Weighted Returns')
+            weighted_rors = rors * np.asarray(scheme_weights, dtype=float)[None, :]
+            portfolios[scheme] = pd.DataFrame(weighted_rors, index=index,
+                                              columns=[f'{name}{suffix}' for name in panel.names])
+        return portfolios
+
+
     def weighted_returns_portfolio(self, iter: bool):
         """
         Creates a dataframe of performance-weighted rate of returns for each program.
@@ -299,28 +948,8 @@ class ManagerUniverse:
         Returns:
             pd.DataFrame: Weighted rate of returns. Columns are program, rows are months.
         """
-        # Create a DataFrame to hold the weighted returns
-        weighted_returns_df = pd.DataFrame({'Date': pd.to_datetime([])})
-        
-        for program in self._emerging_programs:
-            # Calculate weighted returns for each program
-            if iter:
-                timeseries = program.test_timeseries
-            else:
-                timeseries = program.full_timeseries
-
-            weighted_rors = program.overall_weight * timeseries.get_rors()
-            weighted_program_df = pd.DataFrame({
-                'Date': timeseries.get_dates(),
-                f'{program.name} Weighted Returns': weighted_rors
-            })
-          
-            # Merge this program's weighted returns into the main DataFrame
-            weighted_returns_df = pd.merge(weighted_returns_df, weighted_program_df, on='Date', how='outer')
-            
-        weighted_returns_df['Date'] = pd.to_datetime(weighted_returns_df['Date'])
-        weighted_returns_df.set_index('Date', inplace=True)
-        return weighted_returns_df    
+        weights = {'EMP': [program.overall_weight for program in self._emerging_programs]}
+        return self.weighted_portfolios(iter, weights)['EMP']
     
     
     def volatility_weighted_returns_portfolio(self, iter: bool):
@@ -330,26 +959,8 @@ class ManagerUniverse:
         Returns:
             pd.DataFrame: Weighted rate of returns. Columns are program, rows are months.
         """
-        vol_weighted_returns_df = pd.DataFrame({'Date': pd.to_datetime([])})
-        
-        for program in self._emerging_programs:
-            if iter:
-                timeseries = program.test_timeseries
-            else:
-                timeseries = program.full_timeseries
-
-            vol_weighted_rors = program.vol_weight * timeseries.get_rors()
-
-            weighted_program_df = pd.DataFrame({
-                'Date': timeseries.get_dates(),
-                f'{program.name} Weighted Returns': vol_weighted_rors
-            })
-          
-            vol_weighted_returns_df = pd.merge(vol_weighted_returns_df, weighted_program_df, on='Date', how='outer')
-            
-        vol_weighted_returns_df['Date'] = pd.to_datetime(vol_weighted_returns_df['Date'])
-        vol_weighted_returns_df.set_index('Date', inplace=True)
-        return vol_weighted_returns_df    
+        weights = {'Vol': [program.vol_weight for program in self._emerging_programs]}
+        return self.weighted_portfolios(iter, weights)['Vol']
 
 
     def equal_weighted_returns_portfolio(self, iter: bool):
@@ -359,26 +970,6 @@ class ManagerUniverse:
         Returns:
             pd.DataFrame: Equal-weighted rate of returns. Columns are program, rows are months.
         """
-        weighted_returns_df = pd.DataFrame({'Date': pd.to_datetime([])})
-        
         num_programs = len(self._emerging_programs)
-        equal_weight = 1 / num_programs
-        
-        for program in self._emerging_programs:
-            if iter:
-                timeseries = program.test_timeseries
-            else:
-                timeseries = program.full_timeseries
-
-            weighted_rors = equal_weight * timeseries.get_rors()  
-
-            weighted_program_df = pd.DataFrame({
-                'Date': timeseries.get_dates(),
-                f'{program.name} Equal Weighted Returns': weighted_rors
-            })
-            
-            weighted_returns_df = pd.merge(weighted_returns_df, weighted_program_df, on='Date', how='outer')
-        
-        weighted_returns_df['Date'] = pd.to_datetime(weighted_returns_df['Date'])
-        weighted_returns_df.set_index('Date', inplace=True)
-        return weighted_returns_df
\ No newline at end of file
+        weights = {'Equal': [1 / num_programs] * num_programs}
+        return self.weighted_portfolios(iter, weights)['Equal']
@@ -0,0 +1,177 @@
+"""
+This file runs the main algorithm for a grid of parameters (correlation threshold, score blend weight and date
+window) and collects the results into one tidy dataframe.
+
+The program CSVs are read once. Their returns are written to a temporary folder as .npy arrays (see
+ReturnsPanel.save) that every worker process memory-maps, so the data is shared between the workers instead of
+being pickled to each of them. The scenarios are grouped by date window, so a worker prepares a window's metrics
+and correlation matrices once and only re-clusters and re-scores it for each of its (correlation, weight) pairs.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+import math
+import os
+import tempfile
+import pandas as pd
+
+from Entities import ReturnsPanel
+from ManagerUniverse import ManagerUniverse
+from main import load_universe, prepare_universe, score_universe, calculate_metrics
+
+SCENARIO_COLUMNS = ['start_date', 'end_date', 'corr', 'w']
+
+# Universe of the worker process, loaded from the shared panel by _init_worker, and its last prepared window
+_worker_universe = None
+_worker_window = (None, None)
+
+
+def make_scenarios(corrs, weights, date_windows) -> list:
+    """
+    Lists every combination of parameters.
+
+    Parameters:
+        corrs (list(float)): Correlation thresholds.
+        weights (list(float)): Weights of the first score (two-step weighting system).
+        date_windows (list(tuple)): (start_date, end_date) pairs in 'YYYY-MM-DD' format.
+
+    Returns:
+        list(dict): One dict per scenario with the keys in SCENARIO_COLUMNS.
+    """
+    return [{'start_date': start_date, 'end_date': end_date, 'corr': corr, 'w': w}
+            for (start_date, end_date), corr, w in product(date_windows, corrs, weights)]
+
+
+def score_scenario(universe, corr, w) -> list:
+    """
+    Scores a prepared universe (see main.prepare_universe) for one correlation threshold and weight.
+
+    Returns:
+        list(dict): One row per emerging program with its score, weights and the metrics of the EMP,
+            volatility and equal weighted portfolios.
+    """
+    df_list, scores_df = score_universe(universe, corr, w)
+
+    portfolio_metrics = {}
+    for scheme, df in zip(('EMP', 'Vol', 'Equal'), df_list):
+        _, metrics = calculate_metrics(df.sum(axis=1), decimals=None)
+        portfolio_metrics.update({f'{scheme} {name}': value for name, value in metrics.items()})
+
+    rows = []
+    for program in universe._emerging_programs:
+        row = {
+            'Name': program.name,
+            'Omega Value': program.omega_score,
+            'Sharpe Ratio': program.sharpe_ratio,
+            'Max Drawdown': program.max_drawdown,
+            'Score': program.overall_score,
+            'Weights': program.overall_weight,
+            'Vol Weights': program.vol_weight,
+        }
+        row.update(portfolio_metrics)
+        rows.append(row)
+    return rows
+
+
+def get_universe_settings(universe) -> dict:
+    """
+    Returns the settings of a universe that change its results or how they are calculated, as keyword arguments of
+    ManagerUniverse.from_panel, so a worker's universe is calculated like the given one.
+    """
+    return {'cache_dir': universe.cache_dir, 'benchmarks': universe.benchmarks, 'backend': universe.backend,
+            'max_workers': universe.max_workers, 'correlation_block_size': universe.correlation_block_size,
+            'spill_dir': universe.spill_dir, 'screening_recall': universe.screening_recall,
+            'stability_window': universe.stability_window}
+
+
+def _init_worker(panel_folder, num_emerging, managers, settings):
+    """
+    Loads the shared panel (memory-mapped) into the worker process's universe, with the settings of the sweep's
+    universe (see get_universe_settings).
+    """
+    global _worker_universe
+    panel = ReturnsPanel.load(panel_folder)
+    _worker_universe = ManagerUniverse.from_panel(panel, num_emerging, managers, **settings)
+
+
+def _run_window(start_date, end_date, parameters, universe=None) -> list:
+    """
+    Prepares one date window and scores it for every (corr, w) pair in parameters. In a worker process, the
+    window is reused by the next task if it has the same dates.
+    """
+    global _worker_window
+    if universe is not None:
+        windowed_universe = prepare_universe(universe, start_date, end_date)
+    elif _worker_window[0] == (start_date, end_date):
+        windowed_universe = _worker_window[1]
+    else:
+        windowed_universe = prepare_universe(_worker_universe, start_date, end_date)
+        _worker_window = ((start_date, end_date), windowed_universe)
+
+    rows = []
+    for corr, w in parameters:
+        for row in score_scenario(windowed_universe, corr, w):
+            rows.append({'start_date': start_date, 'end_date': end_date, 'corr': corr, 'w': w, **row})
+    return rows
+
+
+def run_sweep(emerging_programs, other_programs, corrs, weights=(0.8,), date_windows=(('2019-01-01', '2024-10-01'),),
+              max_workers=None, universe=None) -> pd.DataFrame:
+    """
+    Runs the main algorithm (as in main.Static_Performance) for every combination of parameters.
+
+    Parameters:
+        emerging_programs (string): File path to folder containing the emerging programs' csvs.
+        other_programs (string): File path to folder containing other programs' csvs.
+        corrs (list(float)): Correlation thresholds.
+        weights (list(float)): Weights of the first score (two-step weighting system).
+        date_windows (list(tuple)): (start_date, end_date) pairs in 'YYYY-MM-DD' format.
+        max_workers (int): Number of worker processes. Defaults to the number of CPUs. With 1, the scenarios are
+            run in this process.
+        universe (ManagerUniverse): An already loaded universe (see main.load_universe). The folders are not read
+            if it is given. The worker processes use its settings (benchmarks, backend, correlation mode...).
+
+    Returns:
+        pd.DataFrame: One row per scenario and emerging program. The columns are the scenario's parameters
+            (SCENARIO_COLUMNS), the program's name, metrics, score and weights, and the metrics of the scenario's
+            portfolios ('EMP Sharpe Ratio', 'Vol Ann Ret (%)', ...). The rows are in the order of make_scenarios.
+    """
+    if universe is None:
+        universe = load_universe(emerging_programs, other_programs)
+
+    # Group the scenarios by date window, keeping the order of make_scenarios
+    scenarios = make_scenarios(corrs, weights, date_windows)
+    windows = {}
+    for scenario in scenarios:
+        windows.setdefault((scenario['start_date'], scenario['end_date']), []).append((scenario['corr'], scenario['w']))
+
+    max_workers = min(max_workers or os.cpu_count() or 1, len(scenarios))
+    if max_workers <= 1:
+        results = [_run_window(start_date, end_date, parameters, universe)
+                   for (start_date, end_date), parameters in windows.items()]
+    else:
+        # Split the windows into tasks of at most task_size scenarios, so every worker gets some work even when
+        # there are fewer windows than workers
+        task_size = math.ceil(len(scenarios) / max_workers)
+        tasks = [(start_date, end_date, parameters[i:i + task_size])
+                 for (start_date, end_date), parameters in windows.items()
+                 for i in range(0, len(parameters), task_size)]
+
+        programs = universe._emerging_programs + universe._other_programs
+        managers = [program.manager for program in programs]
+        with tempfile.TemporaryDirectory(prefix='emp_sweep_') as panel_folder:
+            universe.get_panel(full_timeseries=True).save(panel_folder)
+            initargs = (panel_folder, len(universe._emerging_programs), managers, get_universe_settings(universe))
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=initargs) as executor:
+                futures = [executor.submit(_run_window, *task) for task in tasks]
+                results = [future.result() for future in futures]
+
+    return pd.DataFrame([row for rows in results for row in rows])
+
+
+if __name__ == '__main__':
+    results = run_sweep('data/core programs', 'data/other programs',
+                        corrs=[0.3, 0.4, 0.5, 0.6, 0.7], weights=[0.6, 0.7, 0.8, 0.9],
+                        date_windows=[('2019-01-01', '2024-10-01'), ('2021-01-01', '2024-10-01')])
+    summary = results.groupby(SCENARIO_COLUMNS)[['EMP Sharpe Ratio', 'Vol Sharpe Ratio', 'Equal Sharpe Ratio']].first()
+    print(summary)
@@ -0,0 +1,120 @@
+"""
+This file contains tests for parsing and caching program CSVs in 'DataParser.py'.
+"""
+
+import os
+import re
+import shutil
+import pandas as pd
+import pytest
+from DataParser import DataParser, BENCHMARK_COLUMNS, parse_csvs, read_long_format
+
+TEST_FOLDER = 'tests'
+TEST_FILE = 'Test Program.csv'
+
+class TestDataParser:
+
+
+    def setup_method(self):
+        self.path = TEST_FOLDER + '/' + TEST_FILE
+
+
+    def test_cache(self, tmp_path) -> None:
+        """Tests that a cached CSV gives the same data, and that the cache is rebuilt when the CSV changes."""
+        path = str(tmp_path / TEST_FILE)
+        cache_dir = str(tmp_path / 'cache')
+        shutil.copy(self.path, path)
+
+        parsed = DataParser(path).get_timeseries()
+        DataParser(path, cache_dir=cache_dir).get_timeseries()  # Build the cache
+        cached_dp = DataParser(path, cache_dir=cache_dir)
+        assert cached_dp._load_cache(*cached_dp._cache_entry())
+        assert cached_dp.get_timeseries() == parsed
+        assert cached_dp.program_name == 'Test Program'
+
+        # The same file read with other columns (e.g. as a benchmark) has its own entry
+        benchmark_dp = DataParser(path, cache_dir=cache_dir, columns=BENCHMARK_COLUMNS)
+        assert benchmark_dp._cache_entry()[0] != cached_dp._cache_entry()[0]
+        assert not benchmark_dp._load_cache(*benchmark_dp._cache_entry())
+
+        # Change the last ror of the CSV
+        with open(path) as f:
+            lines = f.read().splitlines()
+        lines[-1] = lines[-1].rsplit(',', 1)[0] + ',0.5'
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        changed_dp = DataParser(path, cache_dir=cache_dir)
+        assert not changed_dp._load_cache(*changed_dp._cache_entry())
+        assert changed_dp.get_timeseries().get_rors()[-1] == 0.5
+        assert DataParser(path, cache_dir=cache_dir).get_timeseries().get_rors()[-1] == 0.5
+
+        # The cache can be deleted at any time
+        shutil.rmtree(cache_dir)
+        assert DataParser(path, cache_dir=cache_dir).get_timeseries() == changed_dp.get_timeseries()
+        assert os.path.isdir(cache_dir)
+
+
+    def test_read_long_format(self, tmp_path) -> None:
+        """Tests that streaming a long-format file in chunks gives the same rors as parsing each fund's CSV."""
+        df = pd.read_csv(self.path)
+        other = df.assign(Manager='Other Manager', Fund='Other Program', Change=df['Change'] * 2)
+        path = str(tmp_path / 'long.csv')
+        pd.concat([df, other]).to_csv(path, index=False)
+
+        funds = list(read_long_format(path, chunksize=4))
+        expected = DataParser(self.path).parse()
+        assert [(manager, fund) for manager, fund, _ in funds] == [('Test Manager', 'Test Program'),
+                                                                   ('Other Manager', 'Other Program')]
+        pd.testing.assert_series_equal(funds[0][2], expected)
+        pd.testing.assert_series_equal(funds[1][2], expected * 2)
+
+        # Funds whose rows are interleaved can only be read with grouped=False
+        interleaved = pd.concat([df, other]).sort_values('Date', kind='stable')
+        interleaved.to_csv(path, index=False)
+        with pytest.raises(ValueError):
+            list(read_long_format(path, chunksize=4))
+        funds = list(read_long_format(path, chunksize=4, grouped=False))
+        pd.testing.assert_series_equal(funds[1][2], expected * 2)
+
+
+    def test_missing_and_duplicate_months(self, tmp_path) -> None:
+        """Tests that a CSV with a missing or a duplicate month is rejected when it is loaded."""
+        df = pd.read_csv(self.path)
+        path = str(tmp_path / TEST_FILE)
+        for bad, message in [(df.drop(index=[3, 4]), '2 missing month(s) (2023-04, 2023-05)'),
+                             (df.assign(Date=df['Date'].replace('2023-02-01', '2023-01-15')),
+                              '1 duplicate month(s) (2023-01) and 1 missing month(s) (2023-02)')]:
+            bad.to_csv(path, index=False)
+            with pytest.raises(ValueError, match=re.escape(message)):
+                DataParser(path).parse()
+            with pytest.raises(ValueError, match=re.escape(message)):
+                list(read_long_format(path))
+
+        # Days within a month do not matter
+        df.assign(Date=pd.to_datetime(df['Date']) + pd.offsets.MonthEnd(0)).to_csv(path, index=False)
+        assert DataParser(path).get_timeseries().get_len() == len(df)
+
+
+    def test_parse_csvs(self, tmp_path) -> None:
+        """Tests that concurrent parsing gives the same parsers in the order of the paths, and reports bad files."""
+        df = pd.read_csv(self.path)
+        paths = []
+        for i in range(6):
+            paths.append(str(tmp_path / f'Program {i}.csv'))
+            df.assign(Fund=f'Program {i}', Change=df['Change'] + i).to_csv(paths[-1], index=False)
+        df.assign(Change='unknown').to_csv(paths[2], index=False)
+        paths.append(str(tmp_path / 'Missing.csv'))
+
+        parsers, errors = parse_csvs(paths, max_workers=3)
+        assert [dp.program_name for dp in parsers] == ['Program 0', 'Program 1', 'Program 3', 'Program 4',
+                                                       'Program 5']
+        assert list(errors) == [paths[2], paths[-1]]
+        assert errors[paths[-1]].startswith('FileNotFoundError')
+        for dp, serial_dp in zip(parsers, parse_csvs(paths, max_workers=1)[0]):
+            pd.testing.assert_series_equal(dp.data, serial_dp.data)
+        pd.testing.assert_series_equal(parsers[0].data, DataParser(self.path).parse(), check_names=False)
+
+
+if __name__ == '__main__':
+    pytest.main(['TestDataParser.py', '-v'])
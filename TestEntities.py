@@ -0,0 +1,159 @@
+"""
+This file contains tests for the entities in 'Entities.py'.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from Entities import Timeseries, ReturnsPanel, Program, ProgramRegistry, Cluster, to_months
+
+class TestEntities:
+
+
+    def setup_method(self):
+        self.first = Timeseries(data=pd.Series([0.01, 0.02, 0.03],
+                                               index=pd.to_datetime(['2023-01-01', '2023-02-01', '2023-03-01'])))
+        self.second = Timeseries(data=pd.Series([-0.01, -0.02],
+                                                index=pd.to_datetime(['2023-02-28', '2023-04-30'])))
+
+
+    def test_update_same_month(self) -> None:
+        """Tests that updating a panel with a date in a month it already has updates that month's row instead of
+        adding a second row for the month."""
+        panel = ReturnsPanel.from_timeseries(['first', 'second'], [self.first, self.second])
+        dates = panel.dates.copy()
+
+        # A month end of an existing month, and two days of a new month
+        updated = panel.update(['2023-03-31', '2023-05-31', '2023-05-01'], [1, 0, 1], [0.5, 0.6, 0.7])
+        assert list(updated) == [0, 1]
+        assert list(to_months(panel.dates)) == list(to_months(dates)) + [to_months(['2023-05-31'])[0]]
+        np.testing.assert_array_equal(panel.dates[:-1], dates)
+        assert panel.dates[-1] == np.datetime64('2023-05-31')
+        assert panel.get_timeseries(1).get_ror_by_date('2023-03-01') == 0.5
+        assert list(panel.get_rors(0)) == [0.01, 0.02, 0.03, 0.6]
+
+        with pytest.raises(ValueError):
+            panel.update(['2022-12-31'], [0], [0.1])
+
+
+    def test_timeseries_update_same_month(self) -> None:
+        """Tests that updating a timeseries with a date in a month it already has overwrites that month's ror."""
+        self.first.update(['2023-02-28', '2023-04-30', '2023-04-01'], [0.5, 0.6, 0.7])
+        assert list(self.first.data.index) == list(pd.to_datetime(['2023-01-01', '2023-02-01', '2023-03-01',
+                                                                   '2023-04-01']))
+        assert list(self.first.get_rors()) == [0.01, 0.5, 0.03, 0.7]
+
+
+    def test_registry_ids(self) -> None:
+        """Tests that the registry numbers programs in the order they are added and codes their names."""
+        registry = ProgramRegistry()
+        programs = [Program('manager', name, self.first, self.first) for name in ('a', 'b', 'a')]
+        assert [registry.add(program) for program in programs] == [0, 1, 2]
+        assert [program.id for program in programs] == [0, 1, 2]
+        assert len(registry) == 3
+        assert all(registry[i] is program for i, program in enumerate(programs))
+        assert list(registry.get_name_ids([2, 1, 0])) == [0, 1, 0]
+
+
+    def test_program_eq_hash(self) -> None:
+        """Tests that programs are equal and hash alike when they have the same ID, and that unregistered
+        programs are only equal to themselves."""
+        registry = ProgramRegistry()
+        program = Program('manager', 'a', self.first, self.first)
+        other = Program('manager', 'b', self.second, self.second)
+        registry.add(program)
+        registry.add(other)
+
+        window = Program(program.manager, program.name, self.second, self.second, program_id=program.id)
+        assert window == program and hash(window) == hash(program)
+        assert window != other
+        assert {program, other, window} == {program, other}
+        assert window != program.id
+
+        unregistered = Program('manager', 'a', self.first, self.first)
+        assert unregistered == unregistered
+        assert unregistered != Program('manager', 'a', self.first, self.first)
+        assert len({unregistered, Program('manager', 'a', self.first, self.first)}) == 2
+
+
+    def test_cluster_programs(self) -> None:
+        """Tests that a cluster's programs are its head followed by its other members, and are read-only."""
+        programs = [Program('manager', name, self.first, self.first, program_id=i)
+                    for i, name in enumerate('abcd')]
+        cluster = Cluster(programs[2], [0, 2, 3], programs)
+        assert cluster.programs == [programs[2], programs[0], programs[3]]
+        assert Cluster(programs[1], [1]).programs == [programs[1]]
+        with pytest.raises(AttributeError):
+            cluster.programs = []
+
+
+    def test_from_timeseries(self) -> None:
+        """Tests that stacking timeseries aligns them by month, dating each row from the first timeseries with
+        that month."""
+        panel = ReturnsPanel.from_timeseries(['first', 'second'], [self.first, self.second])
+        assert list(panel.dates) == list(pd.to_datetime(['2023-01-01', '2023-02-01', '2023-03-01', '2023-04-30']))
+        assert panel.names == ['first', 'second'] and panel.index == {'first': 0, 'second': 1}
+        np.testing.assert_array_equal(panel.mask, [[True, False], [True, True], [True, False], [False, True]])
+        np.testing.assert_array_equal(panel.rors, [[0.01, 0], [0.02, -0.01], [0.03, 0], [0, -0.02]])
+        assert panel.get_timeseries(1).get_ror_by_date('2023-02-01') == -0.01
+
+        duplicate = Timeseries(data=pd.Series([0.01, 0.02], index=pd.to_datetime(['2023-01-01', '2023-01-31'])))
+        with pytest.raises(ValueError):
+            ReturnsPanel.from_timeseries(['first', 'duplicate'], [self.first, duplicate])
+
+
+    def test_window_select(self) -> None:
+        """Tests that a window is an inclusive row slice of views, and that select drops the rows where none of
+        the kept columns has data."""
+        panel = ReturnsPanel.from_timeseries(['first', 'second'], [self.first, self.second])
+        window = panel.window(start_date='2023-02-01', end_date='2023-03-01')
+        assert list(window.dates) == list(pd.to_datetime(['2023-02-01', '2023-03-01']))
+        assert np.shares_memory(window.rors, panel.rors)
+        assert len(panel.window(end_date='2023-04-29').dates) == 3
+        assert len(panel.window().dates) == len(panel.dates)
+
+        selected = panel.select([1])
+        assert selected.names == ['second']
+        assert list(selected.dates) == list(pd.to_datetime(['2023-02-01', '2023-04-30']))
+        assert list(selected.get_rors(0)) == [-0.01, -0.02]
+        assert selected.mask.all()
+
+
+    def test_save_load(self, tmp_path) -> None:
+        """Tests that a saved panel loads back memory-mapped and read-only, and that updating the loaded panel
+        copies it instead of writing to the files."""
+        panel = ReturnsPanel.from_timeseries(['first', 'second'], [self.first, self.second])
+        panel.save(str(tmp_path / 'panel'))
+        loaded = ReturnsPanel.load(str(tmp_path / 'panel'))
+        assert isinstance(loaded.rors, np.memmap) and not loaded.rors.flags.writeable
+        np.testing.assert_array_equal(loaded.dates, panel.dates)
+        np.testing.assert_array_equal(loaded.rors, panel.rors)
+        np.testing.assert_array_equal(loaded.mask, panel.mask)
+        assert loaded.names == panel.names
+
+        loaded.update(['2023-05-31'], [0], [0.5])
+        assert list(loaded.get_rors(0)) == [0.01, 0.02, 0.03, 0.5]
+        np.testing.assert_array_equal(ReturnsPanel.load(str(tmp_path / 'panel'), mmap_mode=None).rors, panel.rors)
+
+
+    def test_get_monthly(self) -> None:
+        """Tests that a timeseries is kept on the month calendar, that its windows derive their months from it,
+        and that an update recalculates it."""
+        monthly = self.first.get_monthly()
+        assert monthly.start == to_months(['2023-01-01'])[0] and list(monthly.rors) == [0.01, 0.02, 0.03]
+        assert self.first.get_monthly() is monthly
+        assert self.second.get_monthly() is None  # March is missing
+
+        window = self.first.get_window(start_date='2023-02-01')
+        assert window.get_monthly().start == monthly.start + 1 and list(window.get_monthly().rors) == [0.02, 0.03]
+        assert window.get_monthly().overlap(monthly) == (monthly.start + 1, monthly.end)
+        assert list(monthly.get_rors(monthly.start + 1, monthly.end)) == [0.02, 0.03]
+
+        self.first.update(['2023-04-30'], [0.04])
+        assert self.first.get_monthly().end == monthly.end + 1
+        self.second.update(['2023-03-31'], [0.5])
+        assert list(self.second.get_monthly().rors) == [-0.01, 0.5, -0.02]
+
+
+if __name__ == '__main__':
+    pytest.main(['TestEntities.py', '-v'])
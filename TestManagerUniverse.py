@@ -0,0 +1,277 @@
+"""
+This file contains tests for the incremental calculations of 'ManagerUniverse.py'.
+"""
+
+import csv
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import percentileofscore
+from DataParser import CSV_COLUMNS
+from Entities import ReturnsPanel
+from main import load_universe
+from ManagerUniverse import ManagerUniverse
+
+EMERGING_PROGRAMS = 'data/core programs'
+OTHER_PROGRAMS = 'data/other programs'
+
+def merge_portfolio(programs, weights, suffix, iter) -> pd.DataFrame:
+    """Builds a weighted portfolio the way the portfolio functions did before weighted_portfolios: one outer
+    merge on 'Date' per program."""
+    portfolio_df = pd.DataFrame({'Date': pd.to_datetime([])})
+    for program, weight in zip(programs, weights):
+        timeseries = program.test_timeseries if iter else program.full_timeseries
+        df = pd.DataFrame({'Date': timeseries.get_dates(), f'{program.name}{suffix}': weight * timeseries.get_rors()})
+        portfolio_df = pd.merge(portfolio_df, df, on='Date', how='outer')
+    portfolio_df['Date'] = pd.to_datetime(portfolio_df['Date'])
+    return portfolio_df.set_index('Date')
+
+
+def assert_portfolio_equal(df, expected_df) -> None:
+    """Checks two portfolio frames, ignoring the resolution of their dates (the merged frames' dates come from
+    datetime.date objects)."""
+    pd.testing.assert_frame_equal(df, expected_df, check_index_type=False, check_freq=False)
+
+
+class TestManagerUniverse:
+
+
+    def setup_method(self):
+        universe = load_universe(EMERGING_PROGRAMS, OTHER_PROGRAMS)
+        self.panel = universe.get_panel(full_timeseries=True)
+        self.num_emerging = len(universe._emerging_programs)
+
+
+    def make_universe(self, panel, end_date='2023-06-01') -> ManagerUniverse:
+        """Returns a universe over a copy of panel, with its windows calculated."""
+        panel = ReturnsPanel(panel.dates.copy(), panel.rors.copy(), panel.mask.copy(), panel.names)
+        universe = ManagerUniverse.from_panel(panel, self.num_emerging, cache_dir=None)
+        universe._end_date = end_date
+        universe.calculate_windows()
+        return universe
+
+
+    def test_populate_programs_concurrently(self) -> None:
+        """Tests that reading the CSVs concurrently gives the same programs as reading them one by one, in the
+        order of the filenames whatever the number of threads."""
+        expected = ManagerUniverse(cache_dir=None)
+        expected.populate_programs(EMERGING_PROGRAMS, is_emerging=True, end_date='2023-06-01')
+        expected_programs = {program.name: program for program in expected._emerging_programs}
+
+        names = []
+        for max_workers in (1, 4):
+            universe = ManagerUniverse(cache_dir=None)
+            errors = universe.populate_programs_concurrently(EMERGING_PROGRAMS, is_emerging=True,
+                                                             end_date='2023-06-01', max_workers=max_workers)
+            assert errors == {}
+            names.append([program.name for program in universe._emerging_programs])
+            for program in universe._emerging_programs:
+                assert program.timeseries == expected_programs[program.name].timeseries
+                assert program.full_timeseries == expected_programs[program.name].full_timeseries
+        assert names[0] == names[1]
+        assert sorted(names[0]) == sorted(expected_programs)
+
+
+    def test_populate_programs_from_long_format(self, tmp_path) -> None:
+        """Tests that filling a universe from one long-format file gives the same programs, windows and emerging
+        flags as reading each program's CSV, including for names with surrounding whitespace."""
+        # A long-format file has one run of rows per fund, so only the first CSV of each fund is used
+        frames, folders, funds = [], [], set()
+        for folder in (EMERGING_PROGRAMS, OTHER_PROGRAMS):
+            folders.append(tmp_path / os.path.basename(folder))
+            folders[-1].mkdir()
+            for filename in sorted(os.listdir(folder)):
+                df = pd.read_csv(folder + '/' + filename, header=0, names=CSV_COLUMNS, dtype=str)
+                fund = (df['Manager'].iloc[0].strip(), df['Fund'].iloc[0].strip())
+                if fund not in funds:
+                    # A CSV's names are those of its first row (some CSVs have a garbled name in a later row)
+                    funds.add(fund)
+                    frames.append(df.assign(Manager=df['Manager'].iloc[0], Fund=df['Fund'].iloc[0]))
+                    shutil.copy(folder + '/' + filename, folders[-1] / filename)
+
+        dates = {'start_date': '2015-01-01', 'end_date': '2023-06-01', 'test_start_date': '2023-07-01',
+                 'test_end_date': '2023-07-01'}
+        expected = ManagerUniverse(cache_dir=None)
+        expected.populate_programs(str(folders[0]), is_emerging=True, **dates)
+        expected.populate_programs(str(folders[1]), is_emerging=False, **dates)
+
+        df = pd.concat(frames, ignore_index=True)
+        df.loc[::2, 'Manager'] = ' ' + df.loc[::2, 'Manager'] + '  '
+        df.loc[1::2, 'Fund'] = df.loc[1::2, 'Fund'] + ' '
+        path = str(tmp_path / 'long.csv')
+        df.to_csv(path, index=False, quoting=csv.QUOTE_ALL)  # Some fund names hold line breaks
+
+        universe = ManagerUniverse(cache_dir=None)
+        emerging_funds = {program.name for program in expected._emerging_programs}
+        universe.populate_programs_from_long_format(path, emerging_funds, chunksize=100, **dates)
+
+        for programs, expected_programs in ((universe._emerging_programs, expected._emerging_programs),
+                                            (universe._other_programs, expected._other_programs)):
+            by_name = {(program.manager, program.name): program for program in expected_programs}
+            assert len(by_name) == len(expected_programs)
+            assert sorted(by_name) == sorted((program.manager, program.name) for program in programs)
+            for program in programs:
+                expected_program = by_name[(program.manager, program.name)]
+                for window in ('full_timeseries', 'timeseries', 'test_timeseries'):
+                    timeseries, expected_timeseries = getattr(program, window), getattr(expected_program, window)
+                    if expected_timeseries is None:
+                        assert timeseries is None
+                    else:
+                        pd.testing.assert_series_equal(timeseries.data, expected_timeseries.data,
+                                                       check_names=False, check_index_type=False)
+        assert len(universe._emerging_programs) > 0 and len(universe._other_programs) > 0
+
+
+    def test_update_returns(self) -> None:
+        """Tests that adding the last month to a universe gives the same metrics and correlations as a rebuild."""
+        panel = self.panel
+        universe = self.make_universe(panel.window(end_date=str(panel.dates[-2])[:10]))
+        programs = universe._emerging_programs + universe._other_programs
+
+        # The last month, and a correction of an earlier ror
+        records = [(programs[column], panel.dates[-1], panel.rors[-1, column])
+                   for column in np.flatnonzero(panel.mask[-1])]
+        records.append((panel.names[0], panel.dates[-3], 0.05))
+        updated = universe.update_returns(records)
+        assert list(updated) == sorted({0, *np.flatnonzero(panel.mask[-1])})
+
+        expected_panel = ReturnsPanel(panel.dates, panel.rors.copy(), panel.mask.copy(), panel.names)
+        expected_panel.rors[-3, 0], expected_panel.mask[-3, 0] = 0.05, True
+        expected = self.make_universe(expected_panel)
+        for full_timeseries in (False, True):
+            for name, values in expected.get_program_metrics(full_timeseries).items():
+                assert universe.get_program_metrics(full_timeseries)[name] == pytest.approx(values, nan_ok=True)
+            assert universe.get_correlation_matrix(full_timeseries) == pytest.approx(
+                expected.get_correlation_matrix(full_timeseries), nan_ok=True)
+        assert programs[0].full_timeseries.get_ror_by_date(panel.dates[-3]) == 0.05
+
+        with pytest.raises(ValueError):
+            universe.update_returns([(programs[0], panel.dates[0] - np.timedelta64(1, 'D'), 0.01)])
+
+
+    def test_window_registry(self) -> None:
+        """Tests that a window shares its universe's registry, and that its programs and clusters refer to the
+        registered programs by ID."""
+        universe = ManagerUniverse.from_panel(self.panel, self.num_emerging, cache_dir=None)
+        window = universe.window(end_date='2023-06-01')
+        assert window.registry is universe.registry
+        for program in window._emerging_programs + window._other_programs:
+            assert program == universe.registry[program.id]
+            assert program.name == universe.registry[program.id].name
+
+        window.perform_program_stats_calculations(full_timeseries=False)
+        window.populate_clusters(full_timeseries=False)
+        for cluster in window._clusters:
+            programs = window.get_cluster_programs(cluster)
+            assert cluster.programs[0] is cluster.head
+            assert sorted(program.id for program in cluster.programs) == sorted(program.id for program in programs)
+
+
+    @pytest.mark.parametrize('backend', ['thread', 'process'])
+    def test_backend(self, backend) -> None:
+        """Tests that the thread and process backends give the same metrics and correlations as the serial one."""
+        expected = self.make_universe(self.panel)
+        universe = ManagerUniverse.from_panel(expected.get_panel(full_timeseries=True), self.num_emerging,
+                                              cache_dir=None, backend=backend, max_workers=3)
+        universe._end_date = expected._end_date
+        for full_timeseries in (False, True):
+            for name, values in expected.get_program_metrics(full_timeseries).items():
+                np.testing.assert_array_equal(universe.get_program_metrics(full_timeseries)[name], values)
+            np.testing.assert_allclose(universe.get_correlation_matrix(full_timeseries),
+                                       expected.get_correlation_matrix(full_timeseries), rtol=1e-12)
+
+        with pytest.raises(ValueError):
+            ManagerUniverse(backend='gpu')
+
+
+    @pytest.mark.parametrize('screening_recall', [None, 1.0])
+    def test_blockwise_correlation(self, screening_recall) -> None:
+        """Tests that the blockwise correlation mode, with or without the sketch screening, gives the same clusters
+        and scores as the dense matrices."""
+        expected = self.make_universe(self.panel)
+        universe = ManagerUniverse.from_panel(expected.get_panel(full_timeseries=True), self.num_emerging,
+                                              cache_dir=None, correlation_block_size=7,
+                                              screening_recall=screening_recall)
+        universe._end_date = expected._end_date
+        for corr in (0.5, 0.3):
+            for u in (expected, universe):
+                u.corr = corr
+                for program in u._emerging_programs:
+                    program.scores = []
+                for full_timeseries in (False, True):
+                    u.perform_program_stats_calculations(full_timeseries=full_timeseries)
+                    u.populate_clusters(full_timeseries=full_timeseries)
+                    u.assign_scores()
+            for cluster, expected_cluster in zip(universe._clusters, expected._clusters):
+                np.testing.assert_array_equal(cluster.members, expected_cluster.members)
+            np.testing.assert_allclose([program.scores for program in universe._emerging_programs],
+                                       [program.scores for program in expected._emerging_programs])
+
+
+    def test_stability_scores(self) -> None:
+        """Tests that the stability measure ranks each head's rolling Sharpe dispersion within its cluster and
+        counts as a fifth measure of its score."""
+        expected = self.make_universe(self.panel)
+        universe = ManagerUniverse.from_panel(expected.get_panel(full_timeseries=True), self.num_emerging,
+                                              cache_dir=None, stability_window=24)
+        universe._end_date = expected._end_date
+        for u in (expected, universe):
+            u.corr = 0.3
+            for program in u._emerging_programs:
+                program.scores = []
+            u.perform_program_stats_calculations(full_timeseries=False)
+            u.populate_clusters(full_timeseries=False)
+            u.assign_scores()
+
+        rolling_sharpe = universe.get_rolling_metrics(24, full_timeseries=False)['sharpe_ratio']
+        rolling_sharpe = rolling_sharpe.replace([np.inf, -np.inf], np.nan)
+        stabilities = universe.get_stabilities(full_timeseries=False)
+        np.testing.assert_allclose(stabilities, rolling_sharpe.std(ddof=0).where(rolling_sharpe.count() >= 2))
+
+        num_ranked = 0
+        for head, (cluster, program) in enumerate(zip(universe._clusters, universe._emerging_programs)):
+            expected_score = expected._emerging_programs[head].scores[0]
+            members = stabilities[cluster.members]
+            members = members[~np.isnan(members)]
+            if np.isnan(stabilities[head]):
+                assert program.scores[0] == pytest.approx(expected_score, nan_ok=True)
+                continue
+            num_ranked += 1
+            stability = percentileofscore(-members, -stabilities[head])
+            assert program.scores[0] == pytest.approx((4 * expected_score + stability) / 5, nan_ok=True)
+        assert num_ranked > 0
+
+
+    @pytest.mark.parametrize('iter', [False, True])
+    def test_weighted_portfolios(self, iter) -> None:
+        """Tests that the portfolios built from one aligned matrix are the portfolios of the old merge-based
+        functions, for programs whose full and test date ranges differ."""
+        universe = ManagerUniverse(cache_dir=None)
+        universe.populate_programs(EMERGING_PROGRAMS, is_emerging=True, start_date='2019-01-01', end_date='2023-06-01',
+                                   test_start_date='2023-07-01', test_end_date='2024-12-01')
+        programs = universe._emerging_programs
+        weights = np.random.default_rng(0).random((2, len(programs)))
+        for program, overall_weight, vol_weight in zip(programs, *weights):
+            program.overall_weight, program.vol_weight = overall_weight, vol_weight
+
+        portfolios = universe.weighted_portfolios(iter=iter)
+        expected = {
+            'EMP': merge_portfolio(programs, weights[0], ' Weighted Returns', iter),
+            'Vol': merge_portfolio(programs, weights[1], ' Weighted Returns', iter),
+            'Equal': merge_portfolio(programs, [1 / len(programs)] * len(programs), ' Equal Weighted Returns', iter),
+        }
+        assert list(portfolios) == list(expected)
+        for scheme, expected_df in expected.items():
+            assert expected_df.isna().any().any()  # The date ranges differ
+            assert_portfolio_equal(portfolios[scheme], expected_df)
+        assert_portfolio_equal(universe.weighted_returns_portfolio(iter), expected['EMP'])
+        assert_portfolio_equal(universe.volatility_weighted_returns_portfolio(iter), expected['Vol'])
+        assert_portfolio_equal(universe.equal_weighted_returns_portfolio(iter), expected['Equal'])
+        if not iter:
+            assert_portfolio_equal(universe.original_portfolio(), merge_portfolio(programs, [1] * len(programs), '',
+                                                                                  iter))
+
+if __name__ == '__main__':
+    pytest.main(['TestManagerUniverse.py', '-v'])
@@ -0,0 +1,61 @@
+"""
+This file contains tests for the parameter sweep in 'ParameterSweep.py'.
+"""
+
+import pandas as pd
+import pytest
+from main import load_universe, Static_Performance
+from ParameterSweep import run_sweep, SCENARIO_COLUMNS
+
+EMERGING_PROGRAMS = 'data/core programs'
+OTHER_PROGRAMS = 'data/other programs'
+
+class TestParameterSweep:
+
+
+    def setup_method(self):
+        self.universe = load_universe(EMERGING_PROGRAMS, OTHER_PROGRAMS)
+        self.parameters = dict(corrs=[0.3, 0.6], weights=[0.8], date_windows=[('2021-01-01', '2024-10-01')])
+
+
+    def test_run_sweep(self) -> None:
+        """Tests that every scenario is scored as by Static_Performance, in one process or in several."""
+        results = run_sweep(EMERGING_PROGRAMS, OTHER_PROGRAMS, max_workers=1, universe=self.universe,
+                            **self.parameters)
+        assert results[SCENARIO_COLUMNS].drop_duplicates().shape[0] == 2
+
+        df_list, scores_df = Static_Performance(0.6, '2021-01-01', '2024-10-01', EMERGING_PROGRAMS, OTHER_PROGRAMS)
+        scenario = results[results['corr'] == 0.6].set_index('Name')
+        assert list(scenario.index) == list(scores_df.index)
+        assert scenario['Weights'].tolist() == pytest.approx(scores_df['Weights'].tolist())
+        assert scenario['EMP Total Ret (%)'].iloc[0] == pytest.approx((1 + df_list[0].sum(axis=1)).prod() - 1)
+
+        parallel_results = run_sweep(EMERGING_PROGRAMS, OTHER_PROGRAMS, max_workers=2, universe=self.universe,
+                                     **self.parameters)
+        pd.testing.assert_frame_equal(parallel_results, results)
+
+
+    def test_run_sweep_settings(self, tmp_path) -> None:
+        """Tests that the worker processes use the universe's settings: another benchmark and the screened
+        blockwise correlations give the same results in one process or in several."""
+        default_results = run_sweep(EMERGING_PROGRAMS, OTHER_PROGRAMS, max_workers=1, universe=self.universe,
+                                    **self.parameters)
+
+        # A benchmark that is down when the S&P 500 is up, so the programs' gain to pain changes
+        benchmark = pd.read_csv('data/sp500.csv')
+        benchmark = benchmark.assign(Benchmark='Inverse S&P 500', Change=-benchmark['Change'])
+        benchmark.to_csv(tmp_path / 'inverse.csv', index=False)
+        self.universe.benchmarks = {'Inverse S&P 500': str(tmp_path / 'inverse.csv')}
+        self.universe.correlation_block_size = 7
+        self.universe.screening_recall = 1.0
+
+        results = run_sweep(EMERGING_PROGRAMS, OTHER_PROGRAMS, max_workers=1, universe=self.universe,
+                            **self.parameters)
+        assert (results['Score'] != default_results['Score']).any()
+        parallel_results = run_sweep(EMERGING_PROGRAMS, OTHER_PROGRAMS, max_workers=2, universe=self.universe,
+                                     **self.parameters)
+        pd.testing.assert_frame_equal(parallel_results, results)
+
+
+if __name__ == '__main__':
+    pytest.main(['TestParameterSweep.py', '-v'])
@@ -4,10 +4,19 @@ This file contains tests for the statistical calculations performed in 'StatsCal
 
 import pytest
 import math
+import numpy as np
+import pandas as pd
 from DataParser import DataParser
+from Entities import Timeseries
 from StatsCalculations import calc_drawdown_series, calc_max_drawdown, \
     calc_omega_score, calc_cumulative_returns, calc_ann_return, calc_sharpe_ratio, \
-    calc_max_drawdown_length_index, calc_max_drawdown_duration_index, calc_weighted_drawdown_area
+    calc_max_drawdown_length_index, calc_max_drawdown_duration_index, calc_weighted_drawdown_area, \
+    calc_pearson_correlation, calc_pearson_correlation_matrix, align_timeseries, calc_pop_to_drop, \
+    calc_omega_scores, calc_ann_returns, calc_sharpe_ratios, calc_max_drawdowns, calc_weighted_drawdown_areas, \
+    calc_pop_to_drops, calc_drawdown, calc_window_metrics, calc_pearson_correlation_matrices, calc_benchmark_metrics, \
+    calc_gain_to_pain, calc_cluster_percentiles, calc_rolling_metrics, calc_correlation_neighbors, \
+    calc_sparse_cluster_percentiles, calc_screened_correlation_neighbors, sync_returns, sync_rors
+from scipy.stats import percentileofscore
 
 TEST_FOLDER = 'tests'
 TEST_FILE = 'Test Program.csv'
@@ -18,6 +27,7 @@ class TestStatsCalculations:
     def setup_method(self):
         monthly_ror_dao = DataParser(TEST_FOLDER + '/' + TEST_FILE)
         timeseries = monthly_ror_dao.get_timeseries()
+        self.timeseries = timeseries
         self.rors = timeseries.get_rors()
 
 
@@ -78,6 +88,260 @@ class TestStatsCalculations:
         weighted_area = calc_weighted_drawdown_area(self.rors, whole=True, duration=False, base=math.e)
         assert pytest.approx(weighted_area, 1e-3) == 0.0778
 
+
+    def test_calc_weighted_drawdown_area_long_history(self) -> None:
+        """Tests that the weighted drawdown area stays finite past the point where base ** (i + 1) overflows."""
+        rors = np.zeros(3000)
+        rors[0] = -0.5  # Constant drawdown of 50% after the first month
+        weighted_area = calc_weighted_drawdown_area(rors, whole=True, duration=False, base=math.e)
+        assert pytest.approx(weighted_area, 1e-9) == 0.5
+        mask = np.ones((len(rors), 1), dtype=bool)
+        assert pytest.approx(calc_weighted_drawdown_areas(rors[:, None], mask, True, False)[0], 1e-9) == 0.5
+
+
+    def test_calc_drawdown(self) -> None:
+        """Tests that one drawdown analysis gives every drawdown measure of a test manager."""
+        drawdown = calc_drawdown(self.rors, whole=True)
+        assert pytest.approx(drawdown.dd_series, 1e-3) == calc_drawdown_series(self.rors)
+        assert pytest.approx(drawdown.max_drawdown, 1e-3) == -0.209521156
+        assert (drawdown.peak_index, drawdown.trough_index) == (3, 6)
+        assert (drawdown.start_index, drawdown.recovery_index) == (3, 13)
+        assert drawdown.length == 3
+        assert drawdown.duration == 3  # Never recovers, so measured up to the trough
+        assert pytest.approx(drawdown.weighted_area, 1e-3) == 0.0778
+
+
+    def test_calc_pearson_correlation_matrix(self) -> None:
+        """Tests that the correlation matrix matches pairwise correlations of ragged, partially overlapping timeseries."""
+        data = self.timeseries.data
+        timeseries_list = [
+            self.timeseries,
+            Timeseries(data=data.iloc[4:] * 2 + 0.01),
+            Timeseries(data=data.iloc[:7].iloc[::-1].set_axis(data.index[:7])),
+            Timeseries(data=data.iloc[-1:]),  # Only 1 overlapping point with every other timeseries
+        ]
+        _, rors, mask = align_timeseries(timeseries_list)
+        corr_matrix = calc_pearson_correlation_matrix(rors, mask)
+
+        for i, first in enumerate(timeseries_list):
+            for j, second in enumerate(timeseries_list):
+                assert pytest.approx(corr_matrix[i, j], abs=1e-12) == calc_pearson_correlation(first, second)
+        assert corr_matrix[3, 0] == 0
+
+        # Timeseries are aligned by month, whatever the day
+        month_ends = Timeseries(data=data.set_axis(data.index + pd.offsets.MonthEnd(0)))
+        assert calc_pearson_correlation(self.timeseries, month_ends) == pytest.approx(1)
+        dates, _, mask = align_timeseries([self.timeseries, month_ends])
+        assert mask.all() and list(dates) == list(data.index.values)
+
+
+    def test_sync_rors(self) -> None:
+        """Tests that syncing on the month calendar gives the rors of the months both timeseries have, as the
+        date-based sync_returns does, for contiguous, month-end, windowed and gapped timeseries."""
+        data = self.timeseries.data
+        month_ends = Timeseries(data=data.set_axis(data.index + pd.offsets.MonthEnd(0)))
+        gapped = Timeseries(data=data.drop(data.index[[2, 5]]))
+        window = self.timeseries.get_window(start_date=str(data.index[3])[:10])
+        pairs = [(self.timeseries, month_ends), (month_ends.get_window(end_date=str(month_ends.data.index[6])[:10]),
+                 window), (self.timeseries, gapped), (gapped, window)]
+        assert window.get_monthly() is not None and gapped.get_monthly() is None
+        for first, second in pairs:
+            first_rors, second_rors = sync_rors(first, second)
+            first_synced, second_synced = sync_returns(first, second)
+            np.testing.assert_array_equal(first_rors, first_synced.get_rors())
+            np.testing.assert_array_equal(second_rors, second_synced.get_rors())
+
+        last = Timeseries(data=data.iloc[-1:])
+        assert sync_rors(self.timeseries, last) == (None, None)
+        assert sync_rors(self.timeseries.get_window(end_date=str(data.index[2])[:10]), window) == (None, None)
+
+
+    def test_batched_calculations(self) -> None:
+        """Tests that the batched calculations match the single-program calculations on ragged histories."""
+        size = len(self.rors)
+        rors = np.zeros((size + 4, 5))
+        mask = np.zeros((size + 4, 5), dtype=bool)
+        rors[:size, 0], mask[:size, 0] = self.rors, True  # full history
+        rors[4:, 1], mask[4:, 1] = self.rors[::-1], True  # late start
+        rors[2:9, 2], mask[2:9, 2] = self.rors[3:10], True  # short history
+        rors[:size, 3], mask[:size, 3] = self.rors * -1, True
+        mask[[5, 6, 11], 3] = False  # gaps inside the history
+        rors[:size, 4], mask[:size, 4] = np.abs(self.rors), True  # no drawdown
+
+        omega_scores = calc_omega_scores(rors, mask, 0.1)
+        ann_returns = calc_ann_returns(rors, mask)
+        sharpe_ratios = calc_sharpe_ratios(rors, mask)
+        max_drawdowns = calc_max_drawdowns(rors, mask)
+        pop_to_drops = calc_pop_to_drops(rors, mask, 95, 5)
+        drawdown_areas = {(whole, duration): calc_weighted_drawdown_areas(rors, mask, whole, duration)
+                          for whole, duration in [(True, False), (False, True), (False, False)]}
+
+        for column in range(rors.shape[1]):
+            program_rors = rors[mask[:, column], column]
+            assert pytest.approx(omega_scores[column], 1e-10) == calc_omega_score(program_rors, 0.1)
+            assert pytest.approx(ann_returns[column], 1e-10) == calc_ann_return(program_rors)
+            assert pytest.approx(sharpe_ratios[column], 1e-10) == calc_sharpe_ratio(program_rors)
+            assert pytest.approx(max_drawdowns[column], 1e-10) == calc_max_drawdown(program_rors)
+            assert pytest.approx(pop_to_drops[column], 1e-10) == calc_pop_to_drop(program_rors, 95, 5)
+            for (whole, duration), areas in drawdown_areas.items():
+                expected = calc_weighted_drawdown_area(program_rors, whole=whole, duration=duration)
+                assert pytest.approx(areas[column], 1e-10) == expected
+
+
+    def test_calc_window_metrics(self) -> None:
+        """Tests that the metrics and correlations of prefix windows match the batched calculations on each window."""
+        size = len(self.rors)
+        rors = np.zeros((size + 4, 3))
+        mask = np.zeros((size + 4, 3), dtype=bool)
+        rors[:size, 0], mask[:size, 0] = self.rors, True
+        rors[4:, 1], mask[4:, 1] = self.rors[::-1], True
+        rors[2:9, 2], mask[2:9, 2] = self.rors[3:10], True
+        benchmark_rors = np.where(np.arange(size + 4) % 3 == 0, -0.01, 0.02)
+        benchmark_rors[1] = np.nan
+        ends = [6, size + 4]
+
+        window_metrics = calc_window_metrics(rors, mask, ends, 0.1, {'Benchmark': benchmark_rors})
+        correlations = calc_pearson_correlation_matrices(rors, mask, ends, rows=[0])
+        for end, metrics, correlation in zip(ends, window_metrics, correlations):
+            window_rors, window_mask = rors[:end], mask[:end]
+            assert list(metrics['count']) == list(window_mask.sum(axis=0))
+            assert pytest.approx(metrics['omega_score'], 1e-10) == calc_omega_scores(window_rors, window_mask, 0.1)
+            assert pytest.approx(metrics['sharpe_ratio'], 1e-10, nan_ok=True) == \
+                calc_sharpe_ratios(window_rors, window_mask)
+            assert pytest.approx(metrics['max_drawdown'], 1e-10, nan_ok=True) == \
+                calc_weighted_drawdown_areas(window_rors, window_mask, False, True)
+            assert pytest.approx(metrics['pop_to_drop'], 1e-10, nan_ok=True) == \
+                calc_pop_to_drops(window_rors, window_mask, 95, 5)
+            assert pytest.approx(correlation, abs=1e-12, nan_ok=True) == \
+                calc_pearson_correlation_matrix(window_rors, window_mask, rows=[0])
+            benchmark_metrics = calc_benchmark_metrics(window_rors, window_mask, benchmark_rors[:end])
+            for metric, values in benchmark_metrics.items():
+                assert pytest.approx(metrics[f'{metric} (Benchmark)'], 1e-10, nan_ok=True) == values
+
+
+    def test_calc_benchmark_metrics(self) -> None:
+        """Tests the benchmark metrics against the single-program gain to pain and np.cov on a ragged history."""
+        size = len(self.rors)
+        rors = np.zeros((size, 2))
+        mask = np.zeros((size, 2), dtype=bool)
+        rors[:, 0], mask[:, 0] = self.rors, True
+        rors[3:, 1], mask[3:, 1] = self.rors[3:] * 2, True
+        benchmark_rors = np.linspace(-0.05, 0.05, size)[::-1]
+        benchmark_rors[[2, 7]] = np.nan  # months without benchmark data
+
+        metrics = calc_benchmark_metrics(rors, mask, benchmark_rors)
+        data = self.timeseries.data
+        benchmark = Timeseries(data=pd.Series(benchmark_rors, index=data.index).dropna())
+        for column in range(2):
+            program = Timeseries(data=pd.Series(rors[mask[:, column], column], index=data.index[mask[:, column]]))
+            assert pytest.approx(metrics['gain_to_pain'][column], 1e-10) == calc_gain_to_pain(program, benchmark)
+
+            both = mask[:, column] & ~np.isnan(benchmark_rors)
+            program_rors, index_rors = rors[both, column], benchmark_rors[both]
+            expected_beta = np.cov(program_rors, index_rors)[0, 1] / np.var(index_rors, ddof=1)
+            assert pytest.approx(metrics['beta'][column], 1e-10) == expected_beta
+            up, down = index_rors > 0, index_rors < 0
+            assert pytest.approx(metrics['up_capture'][column], 1e-10) == program_rors[up].mean() / index_rors[up].mean()
+            assert pytest.approx(metrics['down_capture'][column], 1e-10) == \
+                program_rors[down].mean() / index_rors[down].mean()
+
+
+    def test_calc_cluster_percentiles(self) -> None:
+        """Tests that the cluster percentiles match scipy's percentileofscore, including ties, inf and nan."""
+        values = np.array([1.0, 2.0, 2.0, np.inf, 0.5, np.nan, 2.0])
+        members = np.array([
+            [True, True, True, True, False, False, False],
+            [False, True, True, False, True, False, True],  # ties with the score
+            [True, False, False, True, True, True, False],  # a nan value
+            [False, False, False, False, False, False, False],  # empty cluster
+        ])
+        scores = np.array([1.0, 2.0, np.inf, 1.0])
+
+        percentiles = calc_cluster_percentiles(values, members, scores)
+        for i in range(3):
+            assert percentiles[i] == pytest.approx(percentileofscore(values[members[i]], scores[i]), nan_ok=True)
+        assert np.isnan(percentiles[2]) and np.isnan(percentiles[3])
+        np.testing.assert_array_equal(calc_sparse_cluster_percentiles(values, *np.nonzero(members), scores),
+                                      percentiles)
+
+
+    def test_calc_correlation_neighbors(self, tmp_path) -> None:
+        """Tests that the blockwise correlation pairs are the pairs of the dense matrices above the threshold."""
+        rng = np.random.default_rng(0)
+        rors = rng.normal(0, 0.03, (40, 23)) + rng.normal(0, 0.03, (40, 1))
+        mask = rng.random((40, 23)) > 0.3
+        rows = np.array([0, 3, 5, 8, 21])
+        ends = [25, 40]
+
+        matrices = calc_pearson_correlation_matrices(rors, mask, ends, rows=rows)
+        for spill_dir in (None, str(tmp_path)):
+            neighbors = calc_correlation_neighbors(rors, mask, ends, 0.4, rows=rows, block_size=4,
+                                                   spill_dir=spill_dir)
+            for matrix, (row_positions, columns, correlations) in zip(matrices, neighbors):
+                order = np.lexsort((columns, row_positions))
+                expected_rows, expected_columns = np.nonzero(matrix > 0.4)
+                np.testing.assert_array_equal(row_positions[order], expected_rows)
+                np.testing.assert_array_equal(columns[order], expected_columns)
+                assert correlations[order] == pytest.approx(matrix[expected_rows, expected_columns])
+
+
+    def test_calc_screened_correlation_neighbors(self) -> None:
+        """Tests that the screened pairs are exact pairs, and all of them when the histories have no gaps."""
+        rng = np.random.default_rng(0)
+        rors = rng.normal(0, 0.03, (60, 40)) + rng.normal(0, 0.03, (60, 4)).repeat(10, axis=1)
+        mask = np.arange(60)[:, None] >= rng.integers(0, 40, 40)  # ragged starts
+        ends = [48, 60]
+
+        expected = calc_correlation_neighbors(rors, mask, ends, 0.4)
+        neighbors, margins, num_candidates = calc_screened_correlation_neighbors(
+            rors, mask, ends, 0.4, recall=1, calibration_rows=5, block_size=8)
+        assert margins == pytest.approx([0, 0], abs=1e-9)
+        assert num_candidates < 40 * 40
+        for (row_positions, columns, correlations), (expected_rows, expected_columns, expected_correlations) in \
+                zip(neighbors, expected):
+            np.testing.assert_array_equal(row_positions, expected_rows)
+            np.testing.assert_array_equal(columns, expected_columns)
+            assert correlations == pytest.approx(expected_correlations)
+
+        # With gaps, the estimates are approximate: the pairs are still exact pairs
+        mask &= rng.random(mask.shape) > 0.2
+        rows = np.arange(0, 40, 3)
+        expected = calc_correlation_neighbors(rors, mask, ends, 0.4, rows=rows)
+        neighbors, margins, _ = calc_screened_correlation_neighbors(rors, mask, ends, 0.4, rows=rows, recall=0.9)
+        for (row_positions, columns, correlations), (expected_rows, expected_columns, expected_correlations) in \
+                zip(neighbors, expected):
+            expected_pairs = dict(zip(zip(expected_rows.tolist(), expected_columns.tolist()), expected_correlations))
+            for row_position, column, correlation in zip(row_positions, columns, correlations):
+                assert correlation == pytest.approx(expected_pairs[row_position, column])
+
+        with pytest.raises(ValueError):
+            calc_screened_correlation_neighbors(rors, mask, ends, 0.4, recall=0)
+
+
+    def test_calc_rolling_metrics(self) -> None:
+        """Tests that every rolling window matches the single-program functions applied to its rors."""
+        rng = np.random.default_rng(0)
+        rors = rng.normal(0.005, 0.04, (60, 4))
+        mask = rng.random((60, 4)) > 0.2
+        mask[:30, 1] = False  # starts late
+        window = 12
+
+        rolling = calc_rolling_metrics(rors, mask, window, 0.01)
+        for column in range(4):
+            program_rors = rors[mask[:, column], column]
+            for k, row in enumerate(np.flatnonzero(mask[:, column])):
+                if k < window - 1:
+                    assert np.isnan(rolling['sharpe_ratio'][row, column])
+                    continue
+                window_rors = program_rors[k - window + 1:k + 1]
+                assert rolling['ann_return'][row, column] == pytest.approx(calc_ann_return(window_rors))
+                assert rolling['volatility'][row, column] == pytest.approx(window_rors.std())
+                assert rolling['sharpe_ratio'][row, column] == pytest.approx(calc_sharpe_ratio(window_rors))
+                assert rolling['omega_score'][row, column] == pytest.approx(calc_omega_score(window_rors, 0.01))
+                assert rolling['drawdown'][row, column] == pytest.approx(calc_drawdown_series(window_rors)[-1],
+                                                                         abs=1e-12)
+        assert np.isnan(rolling['volatility'][~mask]).all()
+
 ###
 # Currently unused functions
 ###
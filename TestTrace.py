@@ -0,0 +1,47 @@
+"""
+This file contains tests for the instrumentation in 'Trace.py'.
+"""
+
+import json
+import pytest
+from Trace import Trace
+
+class TestTrace:
+
+
+    def setup_method(self):
+        self.trace = Trace(memory=True)
+
+
+    def test_trace(self) -> None:
+        """Tests nested stages, counters and events, and that the trace is JSON."""
+        for _ in range(2):
+            with self.trace.stage('outer'):
+                with self.trace.stage('inner'):
+                    data = [0] * 100000
+                self.trace.count('items', len(data))
+        self.trace.event('insufficient_data', 'Program A')
+        self.trace.event('insufficient_data')
+        self.trace.stop()
+
+        trace = json.loads(self.trace.to_json())
+        assert trace['stages']['outer']['calls'] == 2
+        assert trace['stages']['outer/inner']['calls'] == 2
+        assert trace['stages']['outer']['seconds'] >= trace['stages']['outer/inner']['seconds']
+        # The inner list's memory counts towards the peak of both stages
+        assert trace['stages']['outer']['peak_memory'] >= trace['stages']['outer/inner']['peak_memory'] > 800000
+        assert trace['counters'] == {'items': 200000}
+        assert trace['events'] == {'insufficient_data': {'count': 2, 'subjects': ['Program A']}}
+
+
+    def test_disabled_trace(self) -> None:
+        """Tests that a disabled trace records nothing."""
+        trace = Trace(enabled=False)
+        with trace.stage('stage'):
+            trace.count('items')
+            trace.event('event')
+        assert trace.to_dict()['stages'] == trace.to_dict()['counters'] == trace.to_dict()['events'] == {}
+
+
+if __name__ == '__main__':
+    pytest.main(['TestTrace.py', '-v'])
@@ -0,0 +1,104 @@
+"""
+This file contains tests for the walk-forward engine in 'WalkForward.py'.
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from Entities import ReturnsPanel
+from ManagerUniverse import ManagerUniverse
+from StatsCalculations import calc_weighted_drawdown_areas
+from WalkForward import WalkForward
+
+EMERGING_PROGRAMS = 'data/core programs'
+OTHER_PROGRAMS = 'data/other programs'
+TRAIN_START_DATE = '2003-01-01'
+CORR = 0.3
+
+class TestWalkForward:
+
+
+    def setup_method(self):
+        self.universe = ManagerUniverse(CORR, cache_dir=None)
+        self.universe.populate_programs(EMERGING_PROGRAMS, is_emerging=True, start_date=TRAIN_START_DATE)
+        self.universe.populate_programs(OTHER_PROGRAMS, is_emerging=False, start_date=TRAIN_START_DATE)
+
+
+    def rebuild(self, end_date: str, test_date: str, stability_window=None) -> tuple:
+        """Scores one in-sample window the way Iterative_Performance did before the engine: a new universe read
+        from the CSVs and scored on its in-sample window."""
+        universe = ManagerUniverse(CORR, cache_dir=None, stability_window=stability_window)
+        universe.populate_programs(EMERGING_PROGRAMS, is_emerging=True, start_date=TRAIN_START_DATE,
+                                   end_date=end_date, test_start_date=test_date, test_end_date=test_date)
+        universe.populate_programs(OTHER_PROGRAMS, is_emerging=False, start_date=TRAIN_START_DATE,
+                                   end_date=end_date)
+        # Both scores on the in-sample window, so ratings_df's blend is the in-sample score for any w
+        for _ in range(2):
+            universe.perform_program_stats_calculations(full_timeseries=False)
+            universe.populate_clusters(full_timeseries=False)
+            universe.assign_scores()
+        ratings_df = universe.ratings_df(w=1)
+        portfolios = universe.weighted_portfolios(iter=True)
+        return [portfolios['EMP'], portfolios['Vol'], portfolios['Equal']], ratings_df
+
+
+    @pytest.mark.parametrize('stability_window', [None, 24])
+    def test_run(self, stability_window) -> None:
+        """Tests that walking forward gives the same weights and out-of-sample returns as rebuilding the universe
+        every month, with or without the stability measure."""
+        date_range = pd.date_range('2023-01-01', '2023-05-01', freq='MS')
+        self.universe.stability_window = stability_window
+        df_list, ratings_df = WalkForward(self.universe).run(date_range[0], date_range[-1])
+
+        expected = [[], [], []]
+        for end_date, test_date in zip(date_range[:-1], date_range[1:]):
+            expected_df_list, expected_ratings_df = self.rebuild(end_date.strftime('%Y-%m-%d'),
+                                                                 test_date.strftime('%Y-%m-%d'), stability_window)
+            for frames, df in zip(expected, expected_df_list):
+                frames.append(df)
+
+        for df, frames in zip(df_list, expected):
+            expected_df = pd.concat(frames).dropna(axis=1, how='all')
+            assert len(df) == len(date_range) - 1
+            assert sorted(df.columns) == sorted(expected_df.columns)
+            pd.testing.assert_frame_equal(df, expected_df[df.columns], check_freq=False, rtol=1e-9)
+
+        assert list(ratings_df.index) == list(expected_ratings_df.index)
+        for column in ('Score', 'Weights', 'Omega Value', 'Sharpe Ratio', 'Max Drawdown'):
+            assert ratings_df[column].tolist() == pytest.approx(expected_ratings_df[column].tolist(), rel=1e-9)
+
+
+    def test_month_end_dates(self) -> None:
+        """Tests that a panel dated at month ends walks forward like the same panel dated on the 1st: each
+        in-sample window ends with its month and the out-of-sample month is found by month."""
+        panel = self.universe.get_panel(full_timeseries=True)
+        managers = [program.manager for program in self.universe._emerging_programs + self.universe._other_programs]
+        num_emerging = len(self.universe._emerging_programs)
+        month_ends = ((panel.dates.astype('datetime64[M]') + 1).astype('datetime64[D]') - 1).astype(panel.dates.dtype)
+
+        df_lists = []
+        for dates in (panel.dates, month_ends):
+            universe = ManagerUniverse.from_panel(ReturnsPanel(dates, panel.rors, panel.mask, panel.names),
+                                                  num_emerging, managers, CORR)
+            df_list, ratings_df = WalkForward(universe).run('2023-01-01', '2023-05-01')
+            df_lists.append((df_list, ratings_df))
+
+        for df, expected_df in zip(df_lists[1][0], df_lists[0][0]):
+            assert len(df) == 4
+            pd.testing.assert_frame_equal(df, expected_df)
+        pd.testing.assert_frame_equal(df_lists[1][1], df_lists[0][1])
+
+
+    def test_weighted_drawdown_areas(self) -> None:
+        """Tests that the running drawdown state gives the weighted drawdown areas of the whole window."""
+        walk_forward = WalkForward(self.universe)
+        panel = walk_forward.panel
+        for end_date in panel.dates[::5]:
+            walk_forward.advance(end_date)
+            expected = calc_weighted_drawdown_areas(panel.rors[:walk_forward.end], panel.mask[:walk_forward.end],
+                                                    False, True)
+            np.testing.assert_allclose(walk_forward.get_weighted_drawdown_areas(), expected, rtol=1e-12)
+
+
+if __name__ == '__main__':
+    pytest.main(['TestWalkForward.py', '-v'])
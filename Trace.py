@@ -0,0 +1,143 @@
+"""
+This file contains Trace, the opt-in instrumentation of a run of the algorithm.
+
+A Trace records:
+- stages: wall time, number of calls and (optionally) peak traced memory of each named stage. Stages can be
+  nested; a nested stage is recorded under 'outer/inner'.
+- counters: named counts (files parsed, correlation pairs evaluated, programs dropped, ...).
+- events: counted occurrences of something worth reporting (e.g. a program without enough data), with the first
+  few subjects of each kind kept as examples.
+
+A disabled Trace (the default of ManagerUniverse) records nothing, so the instrumented code does not need to check
+whether tracing is on. Usage:
+
+    trace = Trace(memory=True)
+    Static_Performance(..., trace=trace)
+    trace.to_json('trace.json')
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import time
+import tracemalloc
+
+MAX_EVENT_SUBJECTS = 20  # Number of subjects kept per kind of event
+
+
+class Trace:
+    """
+    Stage timers, counters and events of one run.
+
+    Instance Attributes:
+    - enabled: if False, nothing is recorded
+    - memory: if True, the peak memory allocated by Python (tracemalloc) is recorded for every stage
+    - stages: maps a stage's path to its 'seconds', 'calls' and 'peak_memory' (bytes)
+    - counters: maps a counter's name to its count
+    - events: maps an event's name to its 'count' and the first MAX_EVENT_SUBJECTS 'subjects'
+    """
+    enabled: bool
+    memory: bool
+    stages: dict
+    counters: dict
+    events: dict
+
+    def __init__(self, enabled=True, memory=False) -> None:
+        self.enabled = enabled
+        self.memory = memory and enabled
+        self.stages = {}
+        self.counters = {}
+        self.events = {}
+        self._stack = []  # [path, peak memory] of each open stage
+        self._started_tracemalloc = False
+        self._created = datetime.now()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Times the code run inside the with block as the stage name.
+
+        Parameters:
+            name: Name of the stage. Inside another stage, it is recorded as 'outer/name'.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        path = self._stack[-1][0] + '/' + name if self._stack else name
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+            # The peak is reset for the new stage, so keep the enclosing stage's peak so far
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+        self._stack.append([path, 0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            _, peak = self._stack.pop()
+            stage = self.stages.setdefault(path, {'seconds': 0.0, 'calls': 0})
+            stage['seconds'] += seconds
+            stage['calls'] += 1
+            if self.memory:
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                stage['peak_memory'] = max(stage.get('peak_memory', 0), peak)
+                if self._stack:
+                    self._stack[-1][1] = max(self._stack[-1][1], peak)
+                tracemalloc.reset_peak()
+
+    def count(self, name: str, n=1) -> None:
+        """
+        Adds n to the counter name.
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def event(self, name: str, subject=None) -> None:
+        """
+        Records one occurrence of the event name, e.g. event('insufficient_data', program.name).
+        """
+        if not self.enabled:
+            return
+        event = self.events.setdefault(name, {'count': 0, 'subjects': []})
+        event['count'] += 1
+        if subject is not None and len(event['subjects']) < MAX_EVENT_SUBJECTS:
+            event['subjects'].append(str(subject))
+
+    def stop(self) -> None:
+        """
+        Stops tracing memory allocations, if this trace started it.
+        """
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def to_dict(self) -> dict:
+        """
+        Returns the trace as a JSON-serializable dict.
+        """
+        return {
+            'created': self._created.isoformat(timespec='seconds'),
+            'stages': self.stages,
+            'counters': self.counters,
+            'events': self.events,
+        }
+
+    def to_json(self, path=None, indent=2) -> str:
+        """
+        Returns the trace as JSON, and writes it to path if given.
+        """
+        text = json.dumps(self.to_dict(), indent=indent)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+
+# Shared disabled trace, used when no trace is given
+NO_TRACE = Trace(enabled=False)
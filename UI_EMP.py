@@ -6,17 +6,43 @@ How to run:
 2. Activate virtural environment (venv)
 3. cd folder path (C:...\GitHub\emerging_managers_project)
 4. run code: streamlit run UI_EMP.py
+
+The algorithm's stages are cached by their inputs, so only the stages whose inputs changed are rerun:
+- the program CSVs are loaded once (load_programs), from the per-user on-disk cache once parsed (see DataParser),
+- metrics and correlation matrices are calculated once per (start date, end date) (prepare_window),
+- moving the correlation slider only re-thresholds the cached correlation matrices (score_universe).
 """
 
+import threading
 import streamlit as st
 import pandas as pd
-import pandas as pd
 import matplotlib.pyplot as plt
 
-from main import Static_Performance, Portfolio_Performance
+from main import load_universe, prepare_universe, score_universe, Portfolio_Performance
+from DataParser import CACHE_DIR
+from StatsCalculations import ROLLING_METRICS
 # from tqdm import tqdm 
 # import seaborn as sns
 
+
+@st.cache_resource(show_spinner='Loading programs...')
+def load_programs(core_folder, other_folder):
+    """Loads every program's full history once per data folder."""
+    return load_universe(core_folder, other_folder, cache_dir=CACHE_DIR)
+
+
+@st.cache_resource(show_spinner='Calculating metrics and correlations...', max_entries=16)
+def prepare_window(core_folder, other_folder, start_date, end_date):
+    """Calculates the metrics and correlation matrices of a date window once."""
+    return prepare_universe(load_programs(core_folder, other_folder), start_date, end_date)
+
+
+@st.cache_resource
+def get_scoring_lock():
+    """Cached universes are shared between sessions, and scoring updates their programs, so score one at a time."""
+    return threading.Lock()
+
+
 # Streamlit interface
 st.title('Portfolio Analysis Tool')
 
@@ -32,7 +58,9 @@ core_folder = 'data/core programs'
 other_folder = 'data/other programs'
 
 # Get the weighted timeseries for each program from the main algorithm
-df_list, scores_df = Static_Performance(correlation_parameter, start_date, end_date, core_folder, other_folder)
+universe = prepare_window(core_folder, other_folder, start_date, end_date)
+with get_scoring_lock():
+    df_list, scores_df = score_universe(universe, correlation_parameter)
 EMP_df, vol_df, equal_df = df_list
 
 # Create a single hypothetical portfolio for each weighing method
@@ -52,4 +80,11 @@ st.subheader('Vol Weighted Portfolio Performance DataFrame')
 st.dataframe(vol_df)
 
 st.subheader('Equal Weighted Portfolio Performance DataFrame')
-st.dataframe(equal_df)
\ No newline at end of file
+st.dataframe(equal_df)
+
+# Rolling metrics of the emerging programs, calculated once per window length (see ManagerUniverse.get_rolling_metrics)
+st.subheader('Rolling Metrics')
+rolling_window = st.selectbox('Rolling Window (months)', [12, 24, 36])
+rolling_metric = st.selectbox('Metric', ROLLING_METRICS)
+rolling_df = universe.get_rolling_metrics(window=rolling_window)[rolling_metric]
+st.line_chart(rolling_df.iloc[:, :len(universe._emerging_programs)].dropna(how='all'))
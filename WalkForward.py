@@ -0,0 +1,409 @@
+"""
+This file contains the walk-forward (expanding window) engine used by main.Iterative_Performance.
+
+The data is loaded once into a ManagerUniverse. The engine then advances the in-sample window one month at a time
+and keeps running statistics for every program (counts, sums, sums of squares, growth, omega gains/losses,
+gain to pain sums) and for every head/program pair (overlap counts, sums, sums of squares and cross-products).
+Each step only adds the new month's rows to these sums, so the metrics and the correlation matrix of the window
+are available without recomputing them from the whole history.
+
+The weighted drawdown area is also kept from running state: each program's VAMI and peak, its max. drawdown so far,
+and the weighted area of two restarted drawdown curves (the one since the program's last recovery and the one of
+its max. drawdown's duration, see calc_weighted_drawdown_areas). Both areas are updated in O(1) per month because
+the normalized exponential weights only rescale the running area by 1 / base when the curve gets one month longer.
+
+If the universe scores stability (see ManagerUniverse.stability_window), the rolling Sharpe ratios are calculated
+once on the whole panel (each only depends on the months before it), and the running sums of those in the window
+give its standard deviation.
+
+Pop to drop depends on the percentiles of the whole window, which have no running form, so it is still calculated
+with the batched kernel on the window (a view over the panel). It is the only metric whose cost per step grows
+with the history.
+"""
+
+from itertools import chain
+import math
+import numpy as np
+import pandas as pd
+
+from DataParser import load_benchmark
+from Entities import to_months
+from ManagerUniverse import ManagerUniverse, OMEGA_ANNUALIZED_THRESHOLD
+from StatsCalculations import calc_pop_to_drops, calc_rolling_metrics
+
+# Base of the exponential weights of the weighted drawdown area (see calc_weighted_drawdown_area)
+DRAWDOWN_BASE = math.e
+
+
+class WalkForward:
+    """
+    Runs the main algorithm on an expanding window, weighting each next month's returns with scores based on
+    the months before it.
+
+    Instance Attributes:
+    - universe: the ManagerUniverse holding every program's full timeseries
+    - panel: the universe's ReturnsPanel (dates x programs)
+    - benchmark_path: filepath to the benchmark CSV used for gain to pain (defaults to the universe's first benchmark)
+    - end: number of panel rows in the current in-sample window
+    """
+    universe: ManagerUniverse
+    benchmark_path: str
+    end: int
+
+    def __init__(self, universe: ManagerUniverse, benchmark_path=None) -> None:
+        self.universe = universe
+        self.benchmark_path = benchmark_path or next(iter(universe.benchmarks.values()))
+        self.panel = universe.get_panel(full_timeseries=True)
+        self._months = to_months(self.panel.dates)
+        self.programs = list(chain(universe._emerging_programs, universe._other_programs))
+        self.heads = np.arange(len(universe._emerging_programs))
+        self._name_ids = universe.get_name_ids()
+
+        # Benchmark down months, aligned on the panel's dates. Months without benchmark data are never counted.
+        benchmark = load_benchmark(self.benchmark_path, cache_dir=universe.cache_dir)
+        self._benchmark_down = benchmark.down_mask(self.panel.dates)
+
+        # Pearson correlation and volatility are shift-invariant, so the running sums are kept on rors centred on
+        # each program's mean over the whole panel to keep them well-conditioned.
+        counts = self.panel.get_counts()
+        means = np.divide(np.where(self.panel.mask, self.panel.rors, 0.0).sum(axis=0), counts,
+                          out=np.zeros(len(counts)), where=counts > 0)
+        self._centred = np.where(self.panel.mask, self.panel.rors - means, 0.0)
+
+        # Rolling Sharpe ratios of the stability measure, nan where unknown
+        self._rolling_sharpe = None
+        if universe.stability_window:
+            self._rolling_sharpe = calc_rolling_metrics(self.panel.rors, self.panel.mask, universe.stability_window,
+                                                        OMEGA_ANNUALIZED_THRESHOLD)['sharpe_ratio']
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Empties the in-sample window and all running statistics.
+        """
+        programs = len(self.programs)
+        heads = len(self.heads)
+        self.end = 0
+
+        self._counts = np.zeros(programs)
+        self._sums = np.zeros(programs)
+        self._sums_sq = np.zeros(programs)
+        self._growth = np.ones(programs)
+        self._omega_gains = np.zeros(programs)
+        self._omega_losses = np.zeros(programs)
+        self._gtp_gains = np.zeros(programs)
+        self._gtp_pains = np.zeros(programs)
+        self._stability_counts = np.zeros(programs)
+        self._stability_sums = np.zeros(programs)
+        self._stability_sums_sq = np.zeros(programs)
+
+        # Drawdown state. Each curve is a (4 x programs) array of the VAMI, peak, weighted area and length of a
+        # drawdown curve restarted at some month (see _start_curves): _episode restarts at each recovery after the
+        # first month, _max_curve at the start of the max. drawdown's duration and stops when it recovers.
+        self._vami = np.ones(programs)
+        self._peaks = np.ones(programs)
+        self._trough_drawdowns = np.full(programs, np.inf)
+        self._recovered = np.zeros(programs, dtype=bool)
+        self._max_curve_open = np.zeros(programs, dtype=bool)
+        self._episode = np.zeros((4, programs))
+        self._max_curve = np.zeros((4, programs))
+
+        self._overlap = np.zeros((heads, programs))
+        self._sum_xy = np.zeros((heads, programs))
+        self._sum_x = np.zeros((heads, programs))
+        self._sum_y = np.zeros((heads, programs))
+        self._sum_xx = np.zeros((heads, programs))
+        self._sum_yy = np.zeros((heads, programs))
+
+    def advance(self, end_date) -> None:
+        """
+        Expands the in-sample window to end with end_date's month (inclusive), adding the new rows to the running
+        statistics. Rows are matched by month (see Entities.to_months), so the panel's dates may be any day of
+        their month.
+
+        Parameters:
+            end_date: New end date of the in-sample window. Must not be before the current end date.
+        """
+        end = int(np.searchsorted(self._months, to_months(np.datetime64(pd.Timestamp(end_date))), side='right'))
+        if end <= self.end:
+            return
+
+        rows = slice(self.end, end)
+        mask = self.panel.mask[rows]
+        available = mask.astype(float)
+        rors = np.where(mask, self.panel.rors[rows], 0.0)
+        centred = self._centred[rows]
+
+        # Program statistics
+        self._advance_drawdowns(mask, rors)
+        self._counts += available.sum(axis=0)
+        self._sums += centred.sum(axis=0)
+        self._sums_sq += (centred ** 2).sum(axis=0)
+        self._growth *= np.prod(np.where(mask, 1.0 + rors, 1.0), axis=0)
+
+        monthly_threshold = math.pow((1 + OMEGA_ANNUALIZED_THRESHOLD), 1 / 12) - 1
+        differences = rors - monthly_threshold
+        self._omega_gains += np.where(mask & (differences > 0), differences, 0.0).sum(axis=0)
+        self._omega_losses += np.where(mask & (differences < 0), -differences, 0.0).sum(axis=0)
+
+        down = mask & self._benchmark_down[rows, None]
+        self._gtp_gains += np.where(down & (rors > 0), rors, 0.0).sum(axis=0)
+        self._gtp_pains += np.where(down & (rors < 0), -rors, 0.0).sum(axis=0)
+
+        if self._rolling_sharpe is not None:
+            rolling_sharpe = self._rolling_sharpe[rows]
+            finite = np.isfinite(rolling_sharpe)
+            rolling_sharpe = np.where(finite, rolling_sharpe, 0.0)
+            self._stability_counts += finite.sum(axis=0)
+            self._stability_sums += rolling_sharpe.sum(axis=0)
+            self._stability_sums_sq += (rolling_sharpe ** 2).sum(axis=0)
+
+        # Head x program correlation sums
+        head_available = available[:, self.heads]
+        head_centred = centred[:, self.heads]
+        self._overlap += head_available.T @ available
+        self._sum_xy += head_centred.T @ centred
+        self._sum_x += head_centred.T @ available
+        self._sum_y += head_available.T @ centred
+        self._sum_xx += (head_centred ** 2).T @ available
+        self._sum_yy += head_available.T @ centred ** 2
+
+        self.end = end
+
+    @staticmethod
+    def _start_curves(curves: np.ndarray, columns: np.ndarray, growth: np.ndarray) -> None:
+        """Restarts the drawdown curves of the given columns (boolean mask) at a month with growth 1 + ror."""
+        vami = growth[columns]
+        peaks = np.maximum(vami, 1.0)
+        curves[:, columns] = [vami, peaks, np.abs(vami / peaks - 1), np.ones(len(vami))]
+
+    @staticmethod
+    def _extend_curves(curves: np.ndarray, columns: np.ndarray, growth: np.ndarray) -> None:
+        """
+        Adds a month with growth 1 + ror to the drawdown curves of the given columns (boolean mask). The weight
+        of each earlier month is divided by DRAWDOWN_BASE, and the new month's unnormalized weight is 1.
+        """
+        vami = curves[0, columns] * growth[columns]
+        peaks = np.maximum(curves[1, columns], vami)
+        areas = curves[2, columns] / DRAWDOWN_BASE + np.abs(vami / peaks - 1)
+        curves[:, columns] = [vami, peaks, areas, curves[3, columns] + 1]
+
+    def _advance_drawdowns(self, mask: np.ndarray, rors: np.ndarray) -> None:
+        """
+        Adds new rows to the drawdown state, one month at a time, following calc_weighted_drawdown_areas with
+        whole=False and duration=True: the max. drawdown is the first lowest drawdown, its duration starts at
+        the last recovery (drawdown of 0, not counting a program's first month) at or before it, or at the
+        trough if there is none, and ends before the first recovery after it.
+
+        Parameters:
+            mask: (new rows x programs) availability matrix.
+            rors: (new rows x programs) matrix of rors, 0 where unavailable.
+        """
+        positions = self._counts.copy()
+        for available, growth in zip(mask, 1.0 + rors):
+            self._vami[available] *= growth[available]
+            self._peaks = np.maximum(self._peaks, self._vami)
+            drawdowns = np.where(available, self._vami / self._peaks - 1, np.nan)
+
+            recovered = drawdowns == 0
+            self._max_curve_open &= ~(recovered & (self._trough_drawdowns < 0))
+            self._extend_curves(self._max_curve, available & self._max_curve_open, growth)
+
+            restarted = recovered & (positions >= 1)
+            self._extend_curves(self._episode, available & self._recovered & ~restarted, growth)
+            self._start_curves(self._episode, restarted, growth)
+            self._recovered |= restarted
+
+            troughs = drawdowns < self._trough_drawdowns
+            self._trough_drawdowns[troughs] = drawdowns[troughs]
+            self._max_curve_open |= troughs
+            self._max_curve[:, troughs & self._recovered] = self._episode[:, troughs & self._recovered]
+            self._start_curves(self._max_curve, troughs & ~self._recovered, growth)
+            positions += available
+
+    def get_weighted_drawdown_areas(self) -> np.ndarray:
+        """
+        Returns the weighted drawdown area of the max. drawdown duration of every program on the in-sample window
+        (see calc_weighted_drawdown_areas), from the running drawdown state. nan for programs with fewer than 2
+        rors.
+        """
+        lengths = self._max_curve[3]
+        # Sum of the unnormalized weights of a curve of each length: sum(DRAWDOWN_BASE ** -k for k < length)
+        weight_sums = -np.expm1(-lengths * math.log(DRAWDOWN_BASE)) / -np.expm1(-math.log(DRAWDOWN_BASE))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            areas = np.where(lengths < 2, 0.0, self._max_curve[2] / weight_sums)
+        return np.where(self._counts >= 2, areas, np.nan)
+
+    def get_counts(self) -> np.ndarray:
+        """Returns the number of rors of each program in the in-sample window."""
+        return self._counts
+
+    def get_metrics(self) -> dict:
+        """
+        Calculates every program's metrics on the in-sample window. All but pop to drop come from the running
+        statistics; pop to drop is calculated on the whole window (see the module docstring).
+
+        Returns:
+            dict: Arrays (one value per program) for 'omega_score', 'sharpe_ratio', 'max_drawdown' (weighted
+                drawdown area), 'pop_to_drop', 'gain_to_pain', 'volatility' and, if the universe scores it,
+                'stability' (see calc_rolling_stabilities).
+        """
+        counts = self._counts
+        rors, mask = self.panel.rors[:self.end], self.panel.mask[:self.end]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            volatility = np.sqrt(np.maximum(self._sums_sq / counts - (self._sums / counts) ** 2, 0.0))
+            ann_return = self._growth ** (12 / counts) - 1
+            metrics = {
+                'omega_score': np.where(self._omega_losses == 0, np.inf, self._omega_gains / self._omega_losses),
+                'sharpe_ratio': np.where(counts >= 2, ann_return / (volatility * np.sqrt(12)), np.nan),
+                'max_drawdown': self.get_weighted_drawdown_areas(),
+                'pop_to_drop': calc_pop_to_drops(rors, mask, 95, 5),
+                'gain_to_pain': np.where(self._gtp_pains == 0, np.inf, self._gtp_gains / self._gtp_pains),
+                'volatility': volatility,
+            }
+            if self._rolling_sharpe is not None:
+                stability_counts = self._stability_counts
+                stability_means = self._stability_sums / stability_counts
+                stabilities = np.sqrt(np.maximum(self._stability_sums_sq / stability_counts - stability_means ** 2,
+                                                 0.0))
+                metrics['stability'] = np.where(stability_counts >= 2, stabilities, np.nan)
+        return metrics
+
+    def get_correlation_matrix(self) -> np.ndarray:
+        """
+        Returns the (heads x programs) Pearson correlation matrix of the in-sample window, from the running sums.
+        Pairs with fewer than 2 overlapping dates have a correlation of 0 (see calc_pearson_correlation_matrix).
+        """
+        overlap = self._overlap
+        with np.errstate(divide='ignore', invalid='ignore'):
+            covariance = self._sum_xy - self._sum_x * self._sum_y / overlap
+            variance_x = self._sum_xx - self._sum_x ** 2 / overlap
+            variance_y = self._sum_yy - self._sum_y ** 2 / overlap
+            correlation = covariance / np.sqrt(variance_x * variance_y)
+        correlation[overlap < 2] = 0
+        return correlation
+
+    def score(self) -> tuple:
+        """
+        Scores and weights the emerging programs on the in-sample window. Programs with fewer than 2 rors in the
+        window are left out, as in ManagerUniverse.populate_programs.
+
+        Each head gets one cluster score, from the in-sample window only: ManagerUniverse.ratings_df blends it with
+        a second score from the full window, but here the full window would include the out-of-sample months. The
+        overall score is therefore assign_score of the in-sample score, i.e. ratings_df with w=1.
+
+        Returns:
+            np.ndarray: Indices of the scored emerging programs.
+            pd.DataFrame: Ratings of the scored programs (same columns as ManagerUniverse.ratings_df).
+            np.ndarray: EMP, volatility and equal weights of the scored programs (3 x programs).
+        """
+        universe = self.universe
+        active = self._counts >= 2
+        active_heads = self.heads[active[self.heads]]
+        metrics = self.get_metrics()
+
+        for column in np.flatnonzero(active):
+            program = self.programs[column]
+            program.omega_score = metrics['omega_score'][column]
+            program.sharpe_ratio = metrics['sharpe_ratio'][column]
+            program.max_drawdown = metrics['max_drawdown'][column]
+            program.pop_to_drop = metrics['pop_to_drop'][column]
+            program.gain_to_pain = metrics['gain_to_pain'][column]
+            if 'stability' in metrics:
+                program.stability = metrics['stability'][column]
+
+        # Clusters of the active programs, as in ManagerUniverse.populate_clusters
+        corr_matrix = self.get_correlation_matrix()
+        names = self._name_ids
+        members = active & (corr_matrix[active_heads] > universe.corr) & (names[None, :] != names[active_heads, None])
+        members[np.arange(len(active_heads)), active_heads] = True
+        for head_column in active_heads:
+            self.programs[head_column].scores = []
+        universe.set_clusters(active_heads, members)
+        universe.assign_scores()
+
+        # The in-sample cluster score is the only score of each head (see above)
+        scores = np.array([universe.assign_score(self.programs[column].scores[0]) for column in active_heads])
+        emp_weights = scores / np.sum(scores)
+        inv_vol = metrics['volatility'][active_heads]
+        inv_vol = np.divide(1, inv_vol, out=np.zeros(len(inv_vol)), where=inv_vol != 0)
+        vol_weights = inv_vol / np.sum(inv_vol) if np.sum(inv_vol) != 0 else np.full(len(inv_vol), 1 / len(inv_vol))
+        equal_weights = np.full(len(active_heads), 1 / len(active_heads)) if len(active_heads) else np.zeros(0)
+
+        for i, column in enumerate(active_heads):
+            program = self.programs[column]
+            program.overall_score = scores[i]
+            program.overall_weight = emp_weights[i]
+            program.vol_weight = vol_weights[i]
+
+        ratings_df = pd.DataFrame({
+            "Name": [self.programs[column].name for column in active_heads],
+            "Omega Value": metrics['omega_score'][active_heads],
+            "Sharpe Ratio": metrics['sharpe_ratio'][active_heads],
+            "Max Drawdown": metrics['max_drawdown'][active_heads],
+            "Score": scores,
+            "Weights": emp_weights,
+        }).set_index("Name")
+
+        return active_heads, ratings_df, np.vstack([emp_weights, vol_weights, equal_weights])
+
+    def run(self, start_date, end_date) -> tuple:
+        """
+        Walks forward month by month. For each month m from start_date up to (but not including) end_date, the
+        programs are scored on the window ending with m and the weights are applied to the returns of the month
+        after m (out-of-sample). The panel's rows are matched by month, so month-end dates work as well as the 1st.
+
+        Parameters:
+            start_date: End date of the first in-sample window, a string in 'YYYY-MM-DD' format.
+            end_date: Last out-of-sample month, a string in 'YYYY-MM-DD' format.
+
+        Returns:
+            list(pd.Dataframe): The out-of-sample EMP, volatility and equal weighted returns of every emerging
+                program. Rows are months, columns are programs.
+            pd.Dataframe: The ratings of the last in-sample window.
+        """
+        self.reset()
+        trace = self.universe.trace
+        date_range = pd.date_range(start=pd.Timestamp(start_date), end=pd.Timestamp(end_date), freq='MS')
+        heads = self.heads
+        dates = []
+        weighted = [[], [], []]
+        ratings_df = pd.DataFrame()
+
+        for i in range(len(date_range) - 1):
+            with trace.stage('advance'):
+                self.advance(date_range[i])
+            with trace.stage('score'):
+                active_heads, ratings_df, weights = self.score()
+            trace.count('windows_scored')
+            # Summed over the windows: a program is dropped from every window with fewer than 2 of its rors
+            trace.count('programs_dropped', len(self.programs) - np.count_nonzero(self._counts >= 2))
+
+            test_month = to_months(np.datetime64(date_range[i + 1]))
+            test_row = np.searchsorted(self._months, test_month)
+            if test_row == len(self._months) or self._months[test_row] != test_month:
+                trace.event('no_test_returns', date_range[i + 1].strftime('%Y-%m-%d'))
+                continue
+            available = self.panel.mask[test_row, active_heads]
+            if not available.any():
+                trace.event('no_test_returns', date_range[i + 1].strftime('%Y-%m-%d'))
+                continue
+
+            test_rors = np.full(len(heads), np.nan)
+            test_rors[active_heads[available]] = self.panel.rors[test_row, active_heads[available]]
+            for j in range(3):
+                row = np.full(len(heads), np.nan)
+                row[active_heads] = weights[j] * test_rors[active_heads]
+                weighted[j].append(row)
+            dates.append(date_range[i + 1])
+
+        names = [self.programs[column].name for column in heads]
+        suffixes = [' Weighted Returns', ' Weighted Returns', ' Equal Weighted Returns']
+        df_list = []
+        for j in range(3):
+            df = pd.DataFrame(np.array(weighted[j]).reshape(len(dates), len(heads)),
+                              index=pd.DatetimeIndex(dates, name='Date'),
+                              columns=[name + suffixes[j] for name in names])
+            df_list.append(df.dropna(axis=1, how='all'))
+
+        return df_list, ratings_df
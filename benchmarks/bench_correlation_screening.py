@@ -0,0 +1,91 @@
+"""
+Benchmarks the sketch screening of the blockwise correlations (calc_screened_correlation_neighbors) against the
+exact blockwise correlations (calc_correlation_neighbors) on synthetic rors (see synthetic_universe.py), on the
+in-sample (all but the last 12 periods) and full windows.
+
+For each scale and recall target, it reports the time of both, the speedup, the margin of each window, the share
+of pairs whose exact correlation was calculated and the recall: the fraction of the exact pairs above the
+threshold that the screening found. Every screened pair is also checked to be an exact pair.
+
+The screening pays off when most pairs are far below the threshold. With few dates (monthly data), the
+exact correlations are already cheap, so the speedup is small.
+
+How to run (from the project folder):
+python benchmarks/bench_correlation_screening.py --programs 1000 3000 --years 20
+"""
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from StatsCalculations import calc_correlation_neighbors, calc_screened_correlation_neighbors
+from synthetic_universe import generate_returns
+
+THRESHOLD = 0.5
+RECALLS = [0.9, 0.99, 1.0]
+
+
+def get_pairs(neighbors) -> set:
+    """Returns the (row, column) pairs of one window's neighbors."""
+    rows, columns, _ = neighbors
+    return set(zip(rows.tolist(), columns.tolist()))
+
+
+def run_benchmark(num_programs, years, periods_per_year=12, recalls=RECALLS,
+                  threshold=THRESHOLD, seed=0):
+    """
+    Times the exact and screened correlations of one synthetic universe.
+
+    Returns:
+        list: One dict per recall target.
+    """
+    # generate_returns makes 12 periods a year, so ask for the same number of periods
+    rors = generate_returns(num_programs, years * periods_per_year // 12, seed=seed)
+    mask = ~np.isnan(rors)
+    rors = np.nan_to_num(rors)
+    ends = [len(rors) - periods_per_year, len(rors)]
+
+    start = time.perf_counter()
+    exact = calc_correlation_neighbors(rors, mask, ends, threshold)
+    exact_seconds = time.perf_counter() - start
+
+    results = []
+    for recall in recalls:
+        start = time.perf_counter()
+        screened, margins, num_candidates = calc_screened_correlation_neighbors(
+            rors, mask, ends, threshold, recall=recall, seed=seed)
+        screened_seconds = time.perf_counter() - start
+
+        recalls_found = []
+        for exact_window, screened_window in zip(exact, screened):
+            exact_pairs, screened_pairs = get_pairs(exact_window), get_pairs(screened_window)
+            assert screened_pairs <= exact_pairs
+            recalls_found.append(len(screened_pairs) / len(exact_pairs) if exact_pairs else 1.0)
+
+        results.append({'programs': num_programs, 'periods': len(rors), 'recall_target': recall,
+                         'exact_seconds': exact_seconds, 'screened_seconds': screened_seconds,
+                         'speedup': exact_seconds / screened_seconds, 'margins': margins,
+                         'candidates': num_candidates / num_programs ** 2, 'recalls': recalls_found})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--programs', type=int, nargs='+', default=[1000, 3000])
+    parser.add_argument('--years', type=int, default=20)
+    parser.add_argument('--periods-per-year', type=int, default=12, help='12 for monthly data, 252 for daily data.')
+    parser.add_argument('--recalls', type=float, nargs='+', default=RECALLS)
+    args = parser.parse_args()
+
+    print(f"{'programs':>8} {'periods':>7} {'target':>6} {'exact s':>8} {'screened s':>10} {'speedup':>7} "
+          f"{'candidates':>10} {'margins':>13} {'recalls':>13}")
+    for num_programs in args.programs:
+        for row in run_benchmark(num_programs, args.years, args.periods_per_year, args.recalls):
+            print(f"{row['programs']:>8} {row['periods']:>7} {row['recall_target']:>6} "
+                  f"{row['exact_seconds']:>8.3f} {row['screened_seconds']:>10.3f} {row['speedup']:>7.2f} "
+                  f"{row['candidates']:>10.2%} " + ' '.join(f'{margin:>6.3f}' for margin in row['margins'])
+                  + ' ' + ' '.join(f'{recall:>6.4f}' for recall in row['recalls']))
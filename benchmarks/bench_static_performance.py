@@ -0,0 +1,156 @@
+"""
+Benchmarks each stage of main.Static_Performance on synthetic universes (see synthetic_universe.py). The stages
+are the ones recorded by the run's Trace (see Trace.py):
+
+- load: parsing every program CSV into a ManagerUniverse
+- prepare: restricting the universe to the date window and calculating both windows' metrics and correlations,
+  split into prepare/metrics (every program's metrics) and prepare/correlation (the correlation matrices)
+- stats: setting each program's metrics of both passes
+- clustering: thresholding the correlation matrices into the clusters of both passes
+- scoring: assigning scores and building the ratings dataframe
+- portfolio: building the weighted portfolios
+
+The timings (best of --repeat runs) are written to a JSON file together with the scale, the commit and the library
+versions. Passing an earlier file with --compare prints the ratio of every stage to it, so regressions between
+versions stand out.
+
+How to run (from the project folder):
+python benchmarks/bench_static_performance.py --scales small medium --output benchmarks/results.json
+"""
+
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from main import Static_Performance
+from Trace import Trace
+from synthetic_universe import generate_universe
+
+STAGES = ['load', 'prepare', 'prepare/metrics', 'prepare/correlation', 'stats', 'clustering', 'scoring', 'portfolio']
+TOP_STAGES = [name for name in STAGES if '/' not in name]  # Stages that add up to the run's total
+
+# name: (programs, years)
+SCALES = {
+    'tiny': (10, 5),
+    'small': (100, 10),
+    'medium': (1000, 20),
+    'large': (5000, 30),
+    'xlarge': (10000, 50),
+}
+
+END_DATE = '2024-10-01'
+CORRELATION = 0.5
+
+
+def time_stages(emerging_programs, other_programs, start_date, end_date, corr=CORRELATION):
+    """
+    Runs Static_Performance (see main.py) once with a Trace, and reads the time of each stage from it.
+
+    Returns:
+        dict: Seconds spent in each stage of STAGES.
+        int: Number of emerging programs scored.
+    """
+    trace = Trace()
+    _, scores_df = Static_Performance(corr, start_date, end_date, emerging_programs, other_programs, trace=trace)
+    timings = {name: trace.stages.get(name, {}).get('seconds', 0.0) for name in STAGES}
+    return timings, len(scores_df)
+
+
+def get_commit():
+    """Returns the current git commit of the project, or None outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(scales, repeat=3, data_dir=None):
+    """
+    Times every stage on each scale.
+
+    Parameters:
+        scales: Names of scales in SCALES.
+        repeat: Number of runs per scale. The best time of each stage is kept.
+        data_dir: Folder of the generated universes. Defaults to a folder in the system's temporary folder, so
+            the CSVs are only generated once.
+
+    Returns:
+        dict: The benchmark's environment and one result per scale.
+    """
+    data_dir = data_dir or os.path.join(tempfile.gettempdir(), 'emp_benchmark')
+    results = []
+    for scale in scales:
+        num_programs, years = SCALES[scale]
+        emerging_programs, other_programs = generate_universe(os.path.join(data_dir, scale), num_programs, years,
+                                                              end_date=END_DATE)
+        # In-sample window: the whole history but the last year
+        start_date = (pd.Timestamp(END_DATE) - pd.DateOffset(years=years)).strftime('%Y-%m-%d')
+        end_date = (pd.Timestamp(END_DATE) - pd.DateOffset(years=1)).strftime('%Y-%m-%d')
+
+        runs = [time_stages(emerging_programs, other_programs, start_date, end_date) for _ in range(repeat)]
+        timings = {name: min(run[0][name] for run in runs) for name in STAGES}
+        results.append({'scale': scale, 'programs': num_programs, 'years': years, 'emerging': runs[0][1],
+                        'seconds': timings, 'total_seconds': sum(timings[name] for name in TOP_STAGES)})
+
+    return {
+        'benchmark': 'static_performance',
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(report, previous):
+    """
+    Prints the ratio of every stage's time to an earlier report, for the scales in both reports.
+    """
+    previous_results = {result['scale']: result for result in previous['results']}
+    print(f"Compared to {previous.get('commit')} ({previous.get('date')}):")
+    for result in report['results']:
+        if result['scale'] not in previous_results:
+            continue
+        before = previous_results[result['scale']]['seconds']
+        ratios = [f"{name} x{result['seconds'][name] / before[name]:.2f}" for name in STAGES if before.get(name)]
+        print(f"{result['scale']:>8}: " + ', '.join(ratios))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', nargs='+', default=['tiny', 'small', 'medium'], choices=list(SCALES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--data-dir', default=None)
+    parser.add_argument('--output', default='benchmark_static_performance.json')
+    parser.add_argument('--compare', default=None, help='An earlier output file to compare to.')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    data_dir = args.data_dir and os.path.abspath(args.data_dir)
+    previous = args.compare and os.path.abspath(args.compare)
+    os.chdir(ROOT)  # The benchmark (S&P 500) CSV is read from data/sp500.csv
+    report = run_benchmark(args.scales, args.repeat, data_dir)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{'scale':>8} {'programs':>9} {'years':>6} " + ' '.join(f'{name:>19}' for name in STAGES))
+    for result in report['results']:
+        print(f"{result['scale']:>8} {result['programs']:>9} {result['years']:>6} "
+              + ' '.join(f"{result['seconds'][name]:>19.4f}" for name in STAGES))
+    if previous:
+        with open(previous) as f:
+            compare(report, json.load(f))
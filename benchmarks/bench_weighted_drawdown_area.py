@@ -0,0 +1,66 @@
+"""
+Benchmarks calc_weighted_drawdown_area against the previous implementation, which summed base ** (i + 1)
+in a Python loop. Series shorter than StatsCalculations.SHORT_SERIES_LENGTH use plain powers of the base, longer
+ones the shifted weights, so the lengths around it show the cost of the switch.
+
+How to run (from the project folder):
+python benchmarks/bench_weighted_drawdown_area.py
+"""
+
+import math
+import os
+import sys
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from StatsCalculations import calc_drawdown_series, calc_weighted_drawdown_area
+
+LENGTHS = [12, 24, 60, 120, 360, 599, 600, 700, 720, 2520, 10000]
+
+
+def legacy_weighted_drawdown_area(rors: np.array, base: float = math.e) -> float:
+    """
+    The previous calc_weighted_drawdown_area (whole drawdown curve only), kept for comparison.
+    """
+    dd_series = calc_drawdown_series(rors)
+    if dd_series is None:
+        return 0
+
+    weight_sum = sum(base ** (i + 1) for i in range(len(dd_series)))
+    weighted_area = 0
+    for i, dd in enumerate(dd_series):
+        weight = (base ** (i + 1)) / weight_sum
+        weighted_area += abs(dd) * weight
+
+    return weighted_area
+
+
+def run_benchmark(number=200, seed=0):
+    """
+    Times both implementations on random monthly rors of each length in LENGTHS.
+
+    Returns:
+        list(dict): One row per length with both timings and results.
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+    for length in LENGTHS:
+        rors = rng.normal(0.005, 0.04, length)
+        current = calc_weighted_drawdown_area(rors, whole=True, duration=False)
+        current_time = timeit.timeit(lambda: calc_weighted_drawdown_area(rors, True, False), number=number) / number
+        try:
+            legacy = legacy_weighted_drawdown_area(rors)
+            legacy_time = timeit.timeit(lambda: legacy_weighted_drawdown_area(rors), number=number) / number
+        except OverflowError:
+            legacy, legacy_time = float('nan'), float('nan')
+        results.append({'length': length, 'current': current, 'legacy': legacy,
+                        'current_ms': current_time * 1000, 'legacy_ms': legacy_time * 1000})
+    return results
+
+
+if __name__ == '__main__':
+    print(f"{'length':>8} {'current':>12} {'legacy':>12} {'current ms':>11} {'legacy ms':>11}")
+    for row in run_benchmark():
+        print(f"{row['length']:>8} {row['current']:>12.6f} {row['legacy']:>12.6f} "
+              f"{row['current_ms']:>11.3f} {row['legacy_ms']:>11.3f}")
@@ -0,0 +1,124 @@
+"""
+Generates a synthetic universe of programs for the benchmarks. Each program is written to its own CSV in the
+same 'Manager,Fund,Date,Change' format as the files in the data folder.
+
+The programs are split into blocks of correlated programs (a common block factor plus noise), and each program
+starts on a random month, so histories are ragged like the real data. Every block_size-th program is an emerging
+program, so the emerging programs are spread over the blocks.
+
+How to run (from the project folder):
+python benchmarks/synthetic_universe.py OUTPUT_FOLDER --programs 1000 --years 20
+"""
+
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+
+MIN_HISTORY = 24  # Shortest history of a program, in months
+MANIFEST = 'manifest.json'
+
+
+def generate_returns(num_programs, years, block_size=10, block_corr=0.6, seed=0):
+    """
+    Generates monthly rors for every program.
+
+    Parameters:
+        num_programs: Number of programs.
+        years: Number of years of the longest history.
+        block_size: Number of programs per block of correlated programs.
+        block_corr: Correlation between two programs of the same block.
+        seed: Seed of the random generator.
+
+    Returns:
+        np.ndarray: (months x programs) matrix of rors. Months before a program's start are nan.
+    """
+    rng = np.random.default_rng(seed)
+    months = years * 12
+    num_blocks = -(-num_programs // block_size)
+
+    factors = rng.standard_normal((months, num_blocks))
+    noise = rng.standard_normal((months, num_programs))
+    blocks = np.arange(num_programs) // block_size
+    standard = np.sqrt(block_corr) * factors[:, blocks] + np.sqrt(1 - block_corr) * noise
+
+    means = rng.uniform(-0.002, 0.012, num_programs)
+    vols = rng.uniform(0.01, 0.06, num_programs)
+    rors = np.round(means + vols * standard, 4)
+
+    # Ragged start dates
+    starts = rng.integers(0, max(months - MIN_HISTORY, 0) + 1, num_programs)
+    rors[np.arange(months)[:, None] < starts[None, :]] = np.nan
+    return rors
+
+
+def write_program(path, manager, fund, dates, rors):
+    """
+    Writes one program's rors (skipping nan months) to a CSV.
+    """
+    available = ~np.isnan(rors)
+    df = pd.DataFrame({'Manager': manager, 'Fund': fund, 'Date': dates[available], 'Change': rors[available]})
+    df.to_csv(path, index=False, date_format='%Y-%m-%d', float_format='%.4f')
+
+
+def generate_universe(folder, num_programs=100, years=20, block_size=10, block_corr=0.6, end_date='2024-10-01',
+                      seed=0):
+    """
+    Writes a synthetic universe to folder/emerging and folder/other. A folder generated with the same parameters
+    is reused.
+
+    Parameters:
+        folder: Output folder.
+        num_programs: Number of programs (emerging and other).
+        years: Number of years of the longest history.
+        block_size: Number of programs per block of correlated programs.
+        block_corr: Correlation between two programs of the same block.
+        end_date: Last month of every program, a string in 'YYYY-MM-DD' format.
+        seed: Seed of the random generator.
+
+    Returns:
+        str: Folder of the emerging programs' CSVs.
+        str: Folder of the other programs' CSVs.
+    """
+    parameters = {'num_programs': num_programs, 'years': years, 'block_size': block_size,
+                  'block_corr': block_corr, 'end_date': end_date, 'seed': seed}
+    emerging_folder = os.path.join(folder, 'emerging')
+    other_folder = os.path.join(folder, 'other')
+    manifest_path = os.path.join(folder, MANIFEST)
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f) == parameters:
+                return emerging_folder, other_folder
+
+    os.makedirs(emerging_folder, exist_ok=True)
+    os.makedirs(other_folder, exist_ok=True)
+    for sub_folder in (emerging_folder, other_folder):
+        for filename in os.listdir(sub_folder):
+            os.remove(os.path.join(sub_folder, filename))
+
+    rors = generate_returns(num_programs, years, block_size, block_corr, seed)
+    dates = pd.date_range(end=pd.Timestamp(end_date), periods=years * 12, freq='MS').to_numpy()
+    for i in range(num_programs):
+        is_emerging = i % block_size == 0
+        manager = f'Synthetic Manager {i:05d}'
+        fund = f'Synthetic {"Emerging" if is_emerging else "Program"} {i:05d}'
+        path = os.path.join(emerging_folder if is_emerging else other_folder, fund + '.csv')
+        write_program(path, manager, fund, dates, rors[:, i])
+
+    with open(manifest_path, 'w') as f:
+        json.dump(parameters, f)
+    return emerging_folder, other_folder
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folder')
+    parser.add_argument('--programs', type=int, default=100)
+    parser.add_argument('--years', type=int, default=20)
+    parser.add_argument('--block-size', type=int, default=10)
+    parser.add_argument('--block-corr', type=float, default=0.6)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(generate_universe(args.folder, args.programs, args.years, args.block_size, args.block_corr, seed=args.seed))
@@ -7,6 +7,7 @@ import pandas as pd
 import numpy as np
 from StatsCalculations import calc_cumulative_returns, calc_ann_return, calc_sharpe_ratio
 from ManagerUniverse import ManagerUniverse
+from WalkForward import WalkForward
 from datetime import datetime
 
 ####
@@ -32,14 +33,14 @@ def export_portfolio(df, path):
     df.to_csv(file_name, index=False)
 
 
-def calculate_metrics(df):
+def calculate_metrics(df, decimals=3):
     """
     Calculates the cumulative returns, total return, annualized return, annualized standard deviation, 
     and Sharpe ratio of a timeseries. 
 
     Parameters: 
         df (pd.Series): A series of monthly returns.
-        risk_free_rate (float): The risk-free rate used to calculate the Sharpe ratio. 
+        decimals (int): Number of decimals the metrics are rounded to, or None to keep them unrounded.
 
     Returns:
         Tuple (pd.Series, dict)
@@ -54,11 +55,13 @@ def calculate_metrics(df):
     sharpe_ratio = calc_sharpe_ratio(monthly_returns)
     
     metrics = {
-        'Total Ret (%)': round(total_return, 3),
-        'Ann Ret (%)': round(annualized_return, 3),
-        'Ann Std Dev (%)': round(annualized_std, 3),
-        'Sharpe Ratio': round(sharpe_ratio, 3)
+        'Total Ret (%)': total_return,
+        'Ann Ret (%)': annualized_return,
+        'Ann Std Dev (%)': annualized_std,
+        'Sharpe Ratio': sharpe_ratio
     }
+    if decimals is not None:
+        metrics = {name: round(value, decimals) for name, value in metrics.items()}
     return cumulative_returns, metrics
 
 
@@ -88,95 +91,139 @@ def Portfolio_Performance(df_list):
     return plt, output_string
 
 
-def Static_Performance(corr, start_date, end_date, emerging_programs, other_programs):
+def load_universe(emerging_programs, other_programs, corr=0.5, trace=None, cache_dir=None):
     """
-    Runs the main algorithm once based on data from start date to end date.
+    Loads every program's full history once. The result can be restricted to any date window with
+    prepare_universe without reading the CSVs again.
 
     Parameters: 
+        emerging_programs (string): File path to folder containing the emerging programs' csvs.
+        other_programs (string): File path to folder containing other programs' csvs.
         corr (int): The minimum correlation between each program in a cluster.
+        trace (Trace): Records the stages, counters and events of the run (see Trace.py). Disabled if None.
+        cache_dir (string): Folder of the on-disk cache of parsed CSVs (e.g. DataParser.CACHE_DIR). Disabled if None.
+
+    Returns:
+        ManagerUniverse: A universe holding every program's full timeseries.
+    """
+    universe = ManagerUniverse(corr, trace=trace, cache_dir=cache_dir)
+    with universe.trace.stage('load'):
+        universe.populate_programs(emerging_programs, is_emerging=True)
+        universe.populate_programs(other_programs, is_emerging=False)
+    return universe
+
+
+def prepare_universe(universe, start_date, end_date):
+    """
+    Restricts a loaded universe to a date window and calculates the metrics and correlation matrices of both
+    the in-sample and full windows. These only depend on the dates, so the result can be scored for any
+    correlation parameter with score_universe.
+
+    Parameters: 
+        universe (ManagerUniverse): A universe returned by load_universe.
         start_date (string): The start date for each program's timeseries.
         end_date (string): The end date for each program's timeseries.
-        emerging_programs (string): File path to folder containing the emerging programs' csvs.
-        other_programs (string): File path to folder containing other programs' csvs.
+
+    Returns:
+        ManagerUniverse: The universe of the date window.
+    """
+    with universe.trace.stage('prepare'):
+        windowed_universe = universe.window(start_date, end_date)
+        windowed_universe.calculate_windows()
+    return windowed_universe
+
+
+def score_universe(universe, corr, w=0.8):
+    """
+    Creates clusters, scores and weighted timeseries for a prepared universe (see prepare_universe).
+    Only the clusters are recalculated for a new correlation parameter; the metrics and correlations are reused.
+
+    Parameters: 
+        universe (ManagerUniverse): A universe returned by prepare_universe.
+        corr (int): The minimum correlation between each program in a cluster.
+        w (float): The weight of the first score (two-step weighting system).
 
     Returns:
         list(pd.Dataframe): A list of dataframes. Each dataframe has every program's weighted timeseries.
         pd.Dataframe: A dataFrame of programs, performance measures, and scores.
     """
-    # Create universe and run main algorithm
-    universe = ManagerUniverse(corr)
-    # Populate the universe with all programs
-    universe.populate_programs(emerging_programs, is_emerging=True, start_date=start_date, end_date=end_date)
-    universe.populate_programs(other_programs, is_emerging=False, start_date=start_date, end_date=end_date)
-    # Create clusters and evaluate programs based on the program's timeseries up to a specified date
-    universe.perform_program_stats_calculations(full_timeseries=False)
-    universe.populate_clusters(full_timeseries=False)
-    universe.assign_scores()
-    # Create clusters and evaluate programs based on the program's full timeseries
-    universe.perform_program_stats_calculations(full_timeseries=True)
-    universe.populate_clusters(full_timeseries=True)
-    universe.assign_scores()
+    universe.corr = corr
+    trace = universe.trace
+    for program in universe._emerging_programs:
+        program.scores = []
+    # Create clusters and evaluate programs based on the program's timeseries up to a specified date,
+    # then based on the program's full timeseries
+    for full_timeseries in (False, True):
+        with trace.stage('stats'):
+            universe.perform_program_stats_calculations(full_timeseries=full_timeseries)
+        with trace.stage('clustering'):
+            universe.populate_clusters(full_timeseries=full_timeseries)
+        with trace.stage('scoring'):
+            universe.assign_scores()
     # Get dataframes of stats and all weighted timeseries
-    scores_df = universe.ratings_df(w=0.8)
-    EMP_df = universe.weighted_returns_portfolio(iter=False)
-    vol_df = universe.volatility_weighted_returns_portfolio(iter=False)
-    equal_df = universe.equal_weighted_returns_portfolio(iter=False)
+    with trace.stage('scoring'):
+        scores_df = universe.ratings_df(w=w)
+    with trace.stage('portfolio'):
+        portfolios = universe.weighted_portfolios(iter=False)
 
-    df_list = [EMP_df, vol_df, equal_df]
+    df_list = [portfolios['EMP'], portfolios['Vol'], portfolios['Equal']]
 
     return df_list, scores_df
 
 
-def Iterative_Performance(corr, start_date, end_date, emerging_programs, other_programs):
+def Static_Performance(corr, start_date, end_date, emerging_programs, other_programs, trace=None):
     """
-    Iteratively runs the main algorithm, treating each data point as validation data. 
-    I.e., for each month's returns, give it a weight based on performance from previous months.  
-
-    Note: this function currently causes errors. This was also what the original code in UI_EMP.py was doing.
-    Ranjan has since decided to use the Static_Performance method for now.
+    Runs the main algorithm once based on data from start date to end date.
 
     Parameters: 
         corr (int): The minimum correlation between each program in a cluster.
         start_date (string): The start date for each program's timeseries.
         end_date (string): The end date for each program's timeseries.
+        emerging_programs (string): File path to folder containing the emerging programs' csvs.
+        other_programs (string): File path to folder containing other programs' csvs.
+        trace (Trace): Records the stages, counters and events of the run, e.g. to save them with
+            trace.to_json(path). Disabled if None.
 
     Returns:
         list(pd.Dataframe): A list of dataframes. Each dataframe has every program's weighted timeseries.
         pd.Dataframe: A dataFrame of programs, performance measures, and scores.
     """
-    start_date_input = pd.to_datetime('2022-01-01')
-    end_date_input = pd.to_datetime('2024-04-01')
-
-    # Generate date range based on user input
-    date_range = pd.date_range(start=start_date_input, end=end_date_input, freq='MS')
+    # Create universe with all programs and run main algorithm
+    universe = load_universe(emerging_programs, other_programs, corr, trace=trace)
+    universe = prepare_universe(universe, start_date, end_date)
+    return score_universe(universe, corr)
 
-    # Initialize dataframes and variables
-    EMP_df = pd.DataFrame()
-    vol_df = pd.DataFrame()
-    equal_df = pd.DataFrame()
-    scores_df = pd.DataFrame()
-    start_date = '2003-01-01' 
 
-    for i in range(len(date_range) - 1):
-        end_date = date_range[i].strftime('%Y-%m-%d')
-        test_date = date_range[i+1].strftime('%Y-%m-%d')
+def Iterative_Performance(corr, start_date, end_date, emerging_programs, other_programs, train_start_date='2003-01-01',
+                          trace=None):
+    """
+    Iteratively runs the main algorithm, treating each data point as validation data. 
+    I.e., for each month's returns, give it a weight based on performance from previous months.  
 
-        universe = ManagerUniverse(corr)
-        universe.populate_programs(emerging_programs, is_emerging=True, start_date=start_date, end_date=end_date, test_start_date=test_date, test_end_date=test_date)
-        universe.populate_programs(other_programs, is_emerging=False, start_date=start_date, end_date=end_date)
-        universe.perform_program_stats_calculations()
-        universe.populate_clusters()
+    The data is loaded once and walked forward with WalkForward, which updates the metrics and correlations
+    of the expanding in-sample window from running statistics instead of rebuilding the universe every month.
 
-        scores_df = universe.ratings_df()
-        emp_sample = universe.weighted_returns_portfolio(iter=True)
-        vol_sample = universe.volatility_weighted_returns_portfolio(iter=True)
-        equal_sample = universe.equal_weighted_returns_portfolio(iter=True)
+    Parameters: 
+        corr (int): The minimum correlation between each program in a cluster.
+        start_date (string): End date of the first in-sample window (e.g. '2022-01-01').
+        end_date (string): Last out-of-sample month (e.g. '2024-04-01').
+        emerging_programs (string): File path to folder containing the emerging programs' csvs.
+        other_programs (string): File path to folder containing other programs' csvs.
+        train_start_date (string): Start date of every in-sample window.
+        trace (Trace): Records the stages, counters and events of the run, e.g. to save them with
+            trace.to_json(path). Disabled if None.
 
-        EMP_df = pd.concat([EMP_df, emp_sample])
-        vol_df = pd.concat([vol_df, vol_sample])
-        equal_df = pd.concat([equal_df, equal_sample])
+    Returns:
+        list(pd.Dataframe): A list of dataframes. Each dataframe has every program's weighted out-of-sample timeseries.
+        pd.Dataframe: A dataFrame of programs, performance measures, and scores for the last in-sample window.
+    """
+    universe = ManagerUniverse(corr, trace=trace)
+    with universe.trace.stage('load'):
+        universe.populate_programs(emerging_programs, is_emerging=True, start_date=train_start_date)
+        universe.populate_programs(other_programs, is_emerging=False, start_date=train_start_date)
 
-    df_list = [EMP_df, vol_df, equal_df]
+    walk_forward = WalkForward(universe)
+    df_list, scores_df = walk_forward.run(start_date, end_date)
     return df_list, scores_df
 
 